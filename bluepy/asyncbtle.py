@@ -0,0 +1,452 @@
+"""asyncio versions of btle.Scanner and btle.Peripheral
+
+Each object still runs its own bluepy-helper, but instead of blocking in
+_waitResp() the helper's stdout is registered with the running event loop.
+Responses complete futures in the order their commands were sent, and
+scan results and notifications are delivered to the delegate and to an
+async iterator, so one loop can drive many devices without threads.
+
+    async with AsyncPeripheral() as p:
+        await p.connect("c4:be:84:70:6c:8f")
+        services = await p.discover()
+        data = await p.readCharacteristic(0x25)
+        async for (hnd, data) in p:
+            ...
+"""
+import asyncio
+import binascii
+import collections
+import os
+import subprocess
+import warnings
+
+from . import btle
+from .btle import (BluepyHelper, Scanner, Service, Characteristic, Descriptor,
+                   ScanEntry, UUID, DBG, ADDR_TYPE_PUBLIC, ADDR_TYPE_RANDOM,
+                   BTLEException, BTLEInternalError, BTLEDisconnectError,
+                   BTLEManagementError, BTLEGattError)
+
+# Events held for a slow async iterator; the oldest are dropped beyond this
+EVENT_QUEUE_SIZE = 1024
+
+
+class AsyncBluepyHelper(BluepyHelper):
+    def __init__(self):
+        BluepyHelper.__init__(self)
+        self._loop = None
+        self._pending = collections.deque() # (wantType, accept, future, op)
+        self._events = None
+
+    async def _startHelper(self, iface=None):
+        if self._helper is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        if self._replay is not None:
+            DBG("Replaying ", self._replay.path)
+            self._helper = self._replay.start()
+        else:
+            DBG("Running ", btle.helperExe)
+            self._stderr = open(os.devnull, "w")
+            self._helper = subprocess.Popen(btle._helperArgs(iface),
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=self._stderr,
+                                            preexec_fn = btle.preexec_function)
+        if self._recorder is not None:
+            self._recorder.started()
+        self._rxbuf = bytearray()
+        self._rxpos = 0
+        self._metrics.helperStarted()
+        self._loop.add_reader(self._helper.stdout.fileno(), self._onReadable)
+        if btle.BinaryFraming:
+            # Older helpers answer 'bin' with a badcmd error; stay on text
+            rsp = await self._request("bin on\n", ['bin', 'err'])
+            self._framed = (rsp['rsp'][0] == 'bin')
+            DBG("Binary framing", "on" if self._framed else "not supported")
+
+    def _stopHelper(self):
+        self._closeHelper(BTLEInternalError("Helper stopped"))
+
+    def _closeHelper(self, exc):
+        # Shuts down the helper (if still running), fails anything
+        # waiting on it with exc and ends the event iterator
+        if self._helper is not None:
+            DBG("Stopping ", btle.helperExe)
+            self._loop.remove_reader(self._helper.stdout.fileno())
+            try:
+                self._helper.stdin.write(b"quit\n")
+                self._helper.stdin.flush()
+            except (OSError, ValueError):
+                pass # already gone
+            self._helper.wait()
+            self._helper.stdin.close()
+            self._helper.stdout.close()
+            self._helper = None
+            self._framed = False
+            if self._recorder is not None:
+                self._recorder.flush()
+        if self._stderr is not None:
+            self._stderr.close()
+            self._stderr = None
+        while self._pending:
+            self._settle(self._pending.popleft(), exc=exc)
+        self._putEvent(None)
+
+    def _request(self, cmd, wantType, accept=None):
+        # Sends cmd and returns a future for the first response of one of
+        # wantType (for which accept(resp) is true, if given)
+        self._writeCmd(cmd)
+        # Timed until its future is settled, not per thread
+        (op, self._local.op) = (self._local.op, None)
+        fut = self._loop.create_future()
+        self._pending.append((wantType, accept, fut, op))
+        return fut
+
+    def _settle(self, pending, resp=None, exc=None):
+        (_, _, fut, op) = pending
+        if op is not None:
+            self._metrics.done(op[0], op[1], exc is not None)
+        if fut.done():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(resp)
+
+    async def _mgmtCmd(self, cmd):
+        rsp = await self._request(cmd + "\n", ['mgmt'])
+        if rsp['code'][0] != 'success':
+            self._stopHelper()
+            raise BTLEManagementError("Failed to execute management command '%s'" % (cmd), rsp)
+
+    async def status(self):
+        return await self._request("stat\n", ['stat'])
+
+    def _onReadable(self):
+        try:
+            data = os.read(self._helper.stdout.fileno(), 65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._closeHelper(BTLEInternalError("Helper exited"))
+            return
+        self._metrics.bytesIn += len(data)
+        if self._rxpos:
+            del self._rxbuf[:self._rxpos]
+            self._rxpos = 0
+        self._rxbuf += data
+        while self._helper is not None:
+            msg = self._nextMsg()
+            if msg is None:
+                break
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        self._dispatchResp(BluepyHelper.parseMsg(msg))
+
+    def _dispatchResp(self, resp):
+        if 'rsp' not in resp:
+            self._fail(BTLEInternalError("No response type indicator", resp))
+            return
+
+        respType = resp['rsp'][0]
+        if self._pending:
+            (wantType, accept) = self._pending[0][:2]
+            if respType in wantType and (accept is None or accept(resp)):
+                self._settle(self._pending.popleft(), resp)
+                return
+
+        if respType == 'ntfy' or respType == 'ind':
+            self._metrics.notifications += 1
+            hnd = resp['hnd'][0]
+            data = resp['d'][0]
+            self._notified(hnd, data)
+            self._putEvent((hnd, data))
+        elif respType == 'stat':
+            if 'state' in resp and len(resp['state']) > 0 and resp['state'][0] == 'disc':
+                self._unsolicitedDisc(resp)
+        elif respType == 'err':
+            self._fail(BluepyHelper._respError(resp))
+        elif respType == 'scan':
+            # Scan response when we weren't interested. Ignore it
+            pass
+        else:
+            self._fail(BTLEInternalError("Unexpected response (%s)" % respType, resp))
+
+    def _unsolicitedDisc(self, resp):
+        self._closeHelper(BTLEDisconnectError("Device disconnected", resp))
+
+    def _fail(self, exc):
+        # Fails the oldest outstanding request; with none, nobody asked
+        if not self._pending:
+            DBG("Dropped:", exc)
+            return
+        self._settle(self._pending.popleft(), exc=exc)
+
+    def _putEvent(self, event):
+        if self._events is None:
+            return
+        if self._events.full():
+            self._events.get_nowait()
+        self._events.put_nowait(event)
+
+    async def events(self):
+        # Yields events until the helper stops. Only events arriving
+        # while iterating are seen.
+        if self._helper is None:
+            return
+        queue = self._events = asyncio.Queue(EVENT_QUEUE_SIZE)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            if self._events is queue:
+                self._events = None
+
+    def __aiter__(self):
+        return self.events()
+
+
+class AsyncPeripheral(AsyncBluepyHelper):
+    def __init__(self):
+        AsyncBluepyHelper.__init__(self)
+        self._serviceMap = None # Indexed by UUID
+        (self.deviceAddr, self.addrType, self.iface) = (None, None, None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.disconnect()
+
+    async def connect(self, addr, addrType=ADDR_TYPE_PUBLIC, iface=None):
+        if isinstance(addr, ScanEntry):
+            (addr, addrType, iface) = (addr.addr, addr.addrType, addr.iface)
+        if len(addr.split(":")) != 6:
+            raise ValueError("Expected MAC address, got %s" % repr(addr))
+        if addrType not in (ADDR_TYPE_PUBLIC, ADDR_TYPE_RANDOM):
+            raise ValueError("Expected address type public or random, got {}".format(addrType))
+        await self._startHelper(iface)
+        self.addr = addr
+        self.addrType = addrType
+        self.iface = iface
+        if iface is not None:
+            cmd = "conn %s %s %s\n" % (addr, addrType, "hci"+str(iface))
+        else:
+            cmd = "conn %s %s\n" % (addr, addrType)
+        rsp = await self._request(cmd, ['stat'],
+                                  lambda r: r['state'][0] != 'tryconn')
+        if rsp['state'][0] != 'conn':
+            self._stopHelper()
+            raise BTLEDisconnectError("Failed to connect to peripheral %s, addr type: %s" % (addr, addrType), rsp)
+
+    async def disconnect(self):
+        if self._helper is None:
+            return
+        await self._request("disc\n", ['stat'])
+        self._stopHelper()
+
+    async def getState(self):
+        status = await self.status()
+        return status['state'][0]
+
+    async def discoverServices(self):
+        rsp = await self._request("svcs\n", ['find'])
+        starts = rsp['hstart']
+        ends   = rsp['hend']
+        uuids  = rsp['uuid']
+        nSvcs = len(uuids)
+        assert(len(starts)==nSvcs and len(ends)==nSvcs)
+        self._serviceMap = {}
+        for i in range(nSvcs):
+            self._serviceMap[UUID(uuids[i])] = Service(self, uuids[i], starts[i], ends[i])
+        return self._serviceMap
+
+    async def getServiceByUUID(self, uuidVal):
+        uuid = UUID(uuidVal)
+        if self._serviceMap is not None and uuid in self._serviceMap:
+            return self._serviceMap[uuid]
+        rsp = await self._request("svcs %s\n" % uuid, ['find'])
+        if 'hstart' not in rsp:
+            raise BTLEGattError("Service %s not found" % (uuid.getCommonName()), rsp)
+        svc = Service(self, uuid, rsp['hstart'][0], rsp['hend'][0])
+        if self._serviceMap is None:
+            self._serviceMap = {}
+        self._serviceMap[uuid] = svc
+        return svc
+
+    async def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        cmd = 'char %X %X' % (startHnd, endHnd)
+        if uuid:
+            cmd += ' %s' % UUID(uuid)
+        rsp = await self._request(cmd + "\n", ['find'])
+        nChars = len(rsp.get('hnd', []))
+        chars = [Characteristic(self, rsp['uuid'][i], rsp['hnd'][i],
+                                rsp['props'][i], rsp['vhnd'][i])
+                 for i in range(nChars)]
+        if not uuid:
+            btle._linkCharacteristics(chars, endHnd)
+        return chars
+
+    async def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        resp = await self._request("desc %X %X\n" % (startHnd, endHnd), ['desc'])
+        ndesc = len(resp.get('hnd', []))
+        return [Descriptor(self, resp['uuid'][i], resp['hnd'][i]) for i in range(ndesc)]
+
+    async def discover(self):
+        # Services with their characteristics filled in, so that
+        # Service.getCharacteristics() needs no further round trips.
+        # Requests for all services are in flight at once.
+        svcs = list((await self.discoverServices()).values())
+        charLists = await asyncio.gather(
+            *[self.getCharacteristics(s.hndStart, s.hndEnd) for s in svcs])
+        for (svc, chars) in zip(svcs, charLists):
+            svc.chars = chars
+        return svcs
+
+    async def readCharacteristic(self, handle):
+        resp = await self._request("rd %X\n" % handle, ['rd'])
+        return resp['d'][0]
+
+    read = readCharacteristic
+
+    async def writeCharacteristic(self, handle, val, withResponse=False):
+        cmd = "wrr" if withResponse else "wr"
+        return await self._request("%s %X %s\n" % (cmd, handle, binascii.b2a_hex(val).decode('utf-8')), ['wr'])
+
+    write = writeCharacteristic
+
+    async def setSecurityLevel(self, level):
+        return await self._request("secu %s\n" % level, ['stat'])
+
+    async def setMTU(self, mtu):
+        return await self._request("mtu %x\n" % mtu, ['stat'])
+
+    async def pair(self):
+        await self._mgmtCmd("pair")
+
+    async def unpair(self):
+        await self._mgmtCmd("unpair")
+
+
+class AsyncScanner(AsyncBluepyHelper):
+    def __init__(self, iface=0):
+        AsyncBluepyHelper.__init__(self)
+        self.scanned = {}
+        self.iface=iface
+        self.passive=False
+        self._scanning = False
+        self._addrNames = {}
+        self._filter = None
+        self._filterSeen = set()
+        self._helperFilters = False
+        self._scanParams = None
+
+    # Scan report decoding and bookkeeping, filters and scan parameters
+    # are shared with Scanner
+    _cmd = Scanner._cmd
+    _addrName = Scanner._addrName
+    _scanRecord = Scanner._scanRecord
+    _respRecord = Scanner._respRecord
+    _foundDevice = Scanner._foundDevice
+    clear = Scanner.clear
+    getDevices = Scanner.getDevices
+    setFilter = Scanner.setFilter
+    _filterCmd = Scanner._filterCmd
+    _passes = Scanner._passes
+    _advertisedUUIDs = staticmethod(Scanner._advertisedUUIDs)
+    setScanParameters = Scanner.setScanParameters
+    _scanParamsCmd = Scanner._scanParamsCmd
+
+    async def _probeFilter(self):
+        # As Scanner._probeFilter()
+        try:
+            rsp = await self._request(self._filterCmd() + "\n", ['mgmt'])
+        except BTLEException as e:
+            DBG("Helper can't filter adverts:", e)
+            return False
+        if rsp['code'][0] != 'success':
+            raise BTLEManagementError("Bad advert filter", rsp)
+        return True
+
+    def _sendScanCmd(self, cmd):
+        # For setFilter() while scanning: the reply is not waited for
+        self._request(cmd + "\n", ['mgmt']).add_done_callback(self._filterSet)
+
+    def _filterSet(self, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        code = fut.result()['code'][0]
+        if code != 'success':
+            DBG("Helper rejected the advert filter:", code)
+            warnings.warn("bluepy-helper rejected the advert filter (%s), so adverts "
+                          "are filtered in Python" % code, RuntimeWarning)
+
+    async def _setScanParams(self):
+        try:
+            await self._mgmtCmd(self._scanParamsCmd())
+        except BTLEManagementError:
+            raise
+        except BTLEException:
+            self._stopHelper()
+            raise BTLEInternalError("bluepy-helper can't set scan parameters (rebuild it?)")
+
+    async def start(self, passive=False):
+        self.passive = passive
+        await self._startHelper(iface=self.iface)
+        await self._mgmtCmd("le on")
+        self._helperFilters = await self._probeFilter()
+        if not self._helperFilters and self._filter is not None:
+            btle._helperLacks("advert filtering", "adverts are filtered in Python")
+        if self._scanParams is not None:
+            await self._setScanParams()
+        rsp = await self._request(self._cmd()+"\n", ['mgmt'])
+        if rsp["code"][0] == "busy":
+            # Sometimes previous scan still ongoing
+            await self._mgmtCmd(self._cmd()+"end")
+            await self._mgmtCmd(self._cmd())
+        elif rsp["code"][0] != "success":
+            self._stopHelper()
+            raise BTLEManagementError("Failed to execute management command '%s'" % (self._cmd()), rsp)
+        self._scanning = True
+
+    async def stop(self):
+        self._scanning = False
+        if self._helper is None:
+            return
+        await self._mgmtCmd(self._cmd()+"end")
+        self._stopHelper()
+
+    async def scan(self, timeout=10, passive=False):
+        self.clear()
+        await self.start(passive=passive)
+        await asyncio.sleep(timeout)
+        await self.stop()
+        return self.getDevices()
+
+    def _dispatch(self, msg):
+        rec = self._scanRecord(msg)
+        if rec is None:
+            resp = BluepyHelper.parseMsg(msg)
+            if resp.get('rsp', [None])[0] != 'scan':
+                self._dispatchResp(resp)
+                return
+            rec = self._respRecord(resp)
+        self._metrics.adverts += 1
+        if self._filter is not None and not self._passes(rec):
+            return
+        self._putEvent(self._foundDevice(rec))
+
+    def _unsolicitedDisc(self, resp):
+        # if scan ended, restart it
+        if self._scanning:
+            self._request(self._cmd()+"\n", ['mgmt']).add_done_callback(self._restarted)
+
+    def _restarted(self, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        if fut.result()['code'][0] != 'success':
+            DBG("Scan restart failed:", fut.result()['code'][0])
@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+"""Microbenchmarks for the btle hot paths, needing no hardware
+
+Times response parsing, ScanEntry updates and lookups, UUIDs, assigned
+number names, characteristic lookup by UUID, Scanner.process() end to
+end over a synthetic advert stream (this script stands in for
+bluepy-helper), and discovering a whole GATT database from simhelper.py,
+walked a request at a time and with Peripheral.discoverAll().
+
+Each benchmark reports operations per second (best of several runs),
+the memory one operation allocates at its peak, what stays allocated
+per operation, and the peak over a whole run.
+
+The inputs are fixed, so results from different trees can be compared:
+
+    python bluepy/benchmark.py -o new.json
+    python bluepy/benchmark.py --tree /path/to/old/checkout -o old.json
+    python bluepy/benchmark.py --compare old.json new.json
+
+--tree benchmarks the bluepy package of another checkout (any commit:
+benchmarks for features it doesn't have are skipped), --only picks
+benchmarks by name prefix and --quick cuts the counts by ten.
+"""
+from __future__ import print_function
+
+import sys
+import os
+import gc
+import json
+import time
+import random
+import select
+import struct
+import binascii
+import bisect
+import platform
+import subprocess
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None # Python 2: timings only
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+# Set (to "count devices seed") when this script runs as the helper
+STREAM_ENV = "BLUEPY_BENCH_STREAM"
+
+SEED = 1
+DEVICES = 200
+btle = None # The module under test, see loadBtle()
+
+
+def _ad(adType, data):
+    return struct.pack('<BB', len(data)+1, adType) + data
+
+def syntheticAdverts(count, devices=DEVICES, seed=SEED):
+    # Yields (addr, type, rssi, flag, data) as bluepy-helper reports them
+    # (rssi positive), for a fixed set of devices: adverts with flags,
+    # services and a name alternate with scan responses whose service
+    # and manufacturer data change now and then
+    rnd = random.Random(seed)
+    devs = []
+    for i in range(devices):
+        addr = struct.pack('>HI', 0xC0BE, i)
+        adv = (_ad(0x01, b'\x06') +
+               _ad(0x03, struct.pack('<HH', 0x180F, 0x181A)) +
+               _ad(0x09, ("bench-%04d" % i).encode('utf-8')))
+        devs.append((addr, 1 + (i % 2), adv, rnd.randint(40, 95)))
+    for k in range(count):
+        (addr, addrType, adv, rssi) = devs[rnd.randrange(devices)]
+        rssi = max(30, min(100, rssi + rnd.randint(-3, 3)))
+        if k % 2:
+            data = adv
+        else:
+            gen = (k // (4 * devices)) % 256
+            data = (_ad(0x16, struct.pack('<HB', 0x180F, 100 - gen % 100)) +
+                    _ad(0xFF, struct.pack('<HBB', 0x004C, gen, addrType)) +
+                    _ad(0x0A, b'\x04'))
+        yield (addr, addrType, rssi, 0 if addrType == 1 else 0x4, data)
+
+def _scanLine(rec):
+    (addr, addrType, rssi, flag, data) = rec
+    return "rsp=$scan\x1eaddr=b%s\x1etype=h%X\x1erssi=h%X\x1eflag=h%X\x1ed=b%s\n" % (
+        binascii.b2a_hex(addr).decode('utf-8').upper(), addrType, rssi, flag,
+        binascii.b2a_hex(data).decode('utf-8').upper())
+
+def _resp(rec):
+    (addr, addrType, rssi, flag, data) = rec
+    return { 'rsp' : ['scan'], 'addr' : [addr], 'type' : [addrType],
+             'rssi' : [rssi], 'flag' : [flag], 'd' : [data] }
+
+
+# The helper end of the Scanner benchmarks: answers commands the way
+# bluepy-helper does and, once scanning, writes adverts as fast as the
+# pipe takes them, so the Scanner is what sets the pace
+
+_RSPS = ('err', 'stat', 'ntfy', 'ind', 'find', 'desc', 'rd', 'wr',
+         'mgmt', 'scan', 'oob', 'bin', 'sent')
+_TAGS = ('rsp', 'code', 'estat', 'emsg', 'hnd', 'uuid', 'd', 'state',
+         'sec', 'mtu', 'dst', 'hstart', 'hend', 'props', 'vhnd', 'addr',
+         'type', 'rssi', 'flag', 'cid')
+
+def _frame(rsp, items):
+    payload = b''
+    for (tag, vtype, val) in items:
+        if vtype == 'h':
+            val = struct.pack('<I', val)
+        elif vtype != 'b':
+            val = val.encode('utf-8')
+        payload += struct.pack('<BBH', _TAGS.index(tag), ord(vtype), len(val)) + val
+    return struct.pack('<BBH', 0xBE, _RSPS.index(rsp), len(payload)) + payload
+
+def _scanFrame(rec):
+    (addr, addrType, rssi, flag, data) = rec
+    return _frame('scan', [('addr', 'b', addr), ('type', 'h', addrType),
+                           ('rssi', 'h', rssi), ('flag', 'h', flag), ('d', 'b', data)])
+
+def streamHelper(spec):
+    (count, devices, seed) = [int(x) for x in spec.split()]
+    recs = list(syntheticAdverts(count, devices, seed))
+    (inFd, outFd) = (sys.stdin.fileno(), sys.stdout.fileno())
+    framed = False
+    stream = None # While scanning: the adverts, sent over and over
+    pos = 0
+    buf = b''
+
+    def encode():
+        # Ahead of scanning, as it takes a while
+        msgs = [_scanFrame(rec) if framed else _scanLine(rec).encode('utf-8')
+                for rec in recs]
+        ends = []
+        for msg in msgs:
+            ends.append(len(msg) + (ends[-1] if ends else 0))
+        return (b''.join(msgs), ends)
+
+    def send(data):
+        while data:
+            data = data[os.write(outFd, data):]
+
+    def reply(rsp, **items):
+        if framed:
+            send(_frame(rsp, [(tag, '$', val) for (tag, val) in items.items()]))
+        else:
+            send(("rsp=$%s" % rsp + "".join(["\x1e%s=$%s" % kv for kv in items.items()])
+                  + "\n").encode('utf-8'))
+
+    encoded = encode()
+    while True:
+        # Like a radio, the adverts keep coming until the scan ends; a
+        # reader that has what it wants is never left waiting on a
+        # quiet pipe
+        if stream is not None and not select.select([inFd], [], [], 0)[0]:
+            chunk = stream[pos:pos+65536]
+            send(chunk)
+            pos = (pos + len(chunk)) % len(stream)
+            continue
+        data = os.read(inFd, 4096)
+        if not data:
+            return
+        buf += data
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            args = line.decode('utf-8').split()
+            if not args:
+                continue
+            cmd = args[0]
+            if cmd == 'quit':
+                return
+            elif cmd == 'bin':
+                framed = (len(args) < 2 or args[1] == 'on')
+                encoded = encode()
+                reply('bin', code='success')
+            elif cmd in ('scan', 'pasv'):
+                reply('mgmt', code='success')
+                (stream, ends) = encoded
+                pos = 0
+            elif cmd in ('scanend', 'pasvend'):
+                # Ends on a whole advert, for the reply to follow
+                if stream is not None and pos:
+                    send(stream[pos:ends[bisect.bisect_left(ends, pos)]])
+                stream = None
+                reply('mgmt', code='success')
+            elif cmd in ('le', 'filt', 'scanp'):
+                reply('mgmt', code='success')
+            elif cmd == 'stat':
+                reply('stat', state='disc')
+            else:
+                reply('err', code='badcmd')
+
+
+# Benchmarks: each factory takes nothing and returns run(n), which does
+# n operations (and may return its own timing, in seconds), or None
+# when the tree under test doesn't have what it measures
+
+BENCHMARKS = []
+
+def benchmark(name, count, perOp=True):
+    def register(factory):
+        BENCHMARKS.append((name, count, perOp, factory))
+        return factory
+    return register
+
+@benchmark("parseResp.scan", 50000)
+def benchParseScan():
+    line = _scanLine(next(syntheticAdverts(1)))
+    parse = btle.BluepyHelper.parseResp
+    def run(n):
+        for _ in range(n):
+            parse(line)
+    return run
+
+@benchmark("parseResp.find", 20000)
+def benchParseFind():
+    items = ["rsp=$find"]
+    for h in range(2, 40, 3):
+        items += ["hnd=h%X" % h, "props=h12", "vhnd=h%X" % (h+1),
+                  "uuid='0000%04x-0000-1000-8000-00805f9b34fb" % (0x2A00 + h)]
+    line = "\x1e".join(items) + "\n"
+    parse = btle.BluepyHelper.parseResp
+    def run(n):
+        for _ in range(n):
+            parse(line)
+    return run
+
+@benchmark("parseFrame.scan", 50000)
+def benchParseFrame():
+    parse = getattr(btle.BluepyHelper, 'parseFrame', None)
+    if parse is None or not hasattr(btle, '_frameRsps'):
+        return None
+    frame = _scanFrame(next(syntheticAdverts(1)))
+    (rspCode, payload) = (struct.unpack_from('<B', frame, 1)[0], frame[4:])
+    def run(n):
+        for _ in range(n):
+            parse(rspCode, payload)
+    return run
+
+@benchmark("scanEntry.update", 50000)
+def benchScanEntryUpdate():
+    # Adverts from a few devices in turn, as a busy scan delivers them
+    resps = [_resp(rec) for rec in syntheticAdverts(1000, devices=10)]
+    entries = {}
+    for resp in resps:
+        entries.setdefault(resp['addr'][0], btle.ScanEntry(resp['addr'][0], 0))
+    work = [(entries[resp['addr'][0]], resp) for resp in resps]
+    def run(n):
+        for i in range(n):
+            (dev, resp) = work[i % 1000]
+            dev._update(resp)
+    return run
+
+@benchmark("scanEntry.getScanData", 50000)
+def benchGetScanData():
+    dev = btle.ScanEntry(None, 0)
+    dev._update(_resp(next(syntheticAdverts(1))))
+    def run(n):
+        for _ in range(n):
+            dev.getScanData()
+    return run
+
+@benchmark("scanEntry.getValueText", 100000)
+def benchGetValueText():
+    dev = btle.ScanEntry(None, 0)
+    recs = syntheticAdverts(2)
+    dev._update(_resp(next(recs)))
+    dev._update(_resp(next(recs)))
+    def run(n):
+        for _ in range(n):
+            dev.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME)
+            dev.getValueText(btle.ScanEntry.MANUFACTURER)
+    return run
+
+@benchmark("uuid.fromInt", 100000)
+def benchUUIDInt():
+    UUID = btle.UUID
+    def run(n):
+        for i in range(n):
+            UUID(0x2A00 + (i & 0xFF))
+    return run
+
+@benchmark("uuid.fromStr", 100000)
+def benchUUIDStr():
+    UUID = btle.UUID
+    strs = ["%08x-0000-1000-8000-00805f9b34fb" % (0x2A00 + i) for i in range(256)] + \
+           ["6e400%03x-b5a3-f393-e0a9-e50e24dcca9e" % i for i in range(256)]
+    def run(n):
+        for i in range(n):
+            UUID(strs[i & 511])
+    return run
+
+@benchmark("uuid.eq", 200000)
+def benchUUIDEq():
+    UUID = btle.UUID
+    pairs = [(UUID(0x2A00 + i), UUID("%08x-0000-1000-8000-00805f9b34fb" % (0x2A00 + i % 8)))
+             for i in range(16)]
+    def run(n):
+        for i in range(n):
+            (a, b) = pairs[i & 15]
+            a == b
+    return run
+
+@benchmark("uuid.dictLookup", 200000)
+def benchUUIDDict():
+    UUID = btle.UUID
+    table = dict((UUID(0x2A00 + i), i) for i in range(64))
+    keys = [UUID(0x2A00 + i) for i in range(64)]
+    def run(n):
+        for i in range(n):
+            table[keys[i & 63]]
+    return run
+
+@benchmark("assignedNumbers.getCommonName", 100000)
+def benchCommonName():
+    names = btle.AssignedNumbers
+    uuids = [btle.UUID(u) for u in (0x1800, 0x180F, 0x2A19, 0x2902, 0x2A00, 0x1234)]
+    def run(n):
+        for i in range(n):
+            names.getCommonName(uuids[i % 6])
+    return run
+
+@benchmark("assignedNumbers.attr", 200000)
+def benchNumbersAttr():
+    names = btle.AssignedNumbers
+    def run(n):
+        for _ in range(n):
+            names.batteryLevel
+            names.deviceName
+    return run
+
+@benchmark("service.getCharacteristics", 50000)
+def benchGetCharacteristics():
+    # A preloaded service, so no peripheral is asked; by 16-bit number
+    # and by UUID
+    svc = btle.Service(None, 0x180F, 1, 64)
+    svc.chars = [btle.Characteristic(None, btle.UUID(0x2A00 + i), 2 + 3*i, 0x12, 3 + 3*i)
+                 for i in range(20)]
+    wanted = (0x2A13, btle.UUID(0x2A05), "00002a11-0000-1000-8000-00805f9b34fb")
+    def run(n):
+        for i in range(n):
+            svc.getCharacteristics(wanted[i % 3])
+    return run
+
+def _scannerRun(framed):
+    here = os.path.abspath(__file__)
+    if here.endswith(('.pyc', '.pyo')):
+        here = here[:-1]
+
+    class _Done(Exception):
+        pass
+
+    class _Counter(btle.DefaultDelegate):
+        def __init__(self, stop):
+            btle.DefaultDelegate.__init__(self)
+            self.left = stop
+
+        def handleDiscovery(self, dev, isNewDev, isNewData):
+            self.left -= 1
+            if self.left <= 0:
+                raise _Done()
+
+    def run(n):
+        saved = (btle.helperExe, getattr(btle, 'BinaryFraming', None))
+        os.environ[STREAM_ENV] = "%d %d %d" % (n, DEVICES, SEED)
+        btle.helperExe = here
+        if framed:
+            btle.BinaryFraming = True
+        scanner = btle.Scanner().withDelegate(_Counter(n))
+        try:
+            scanner.start()
+            start = _timer()
+            try:
+                scanner.process(60.0)
+            except _Done:
+                pass
+            elapsed = _timer() - start
+            scanner.stop()
+        finally:
+            scanner._stopHelper()
+            btle.helperExe = saved[0]
+            if framed:
+                btle.BinaryFraming = saved[1]
+            del os.environ[STREAM_ENV]
+        if len(scanner.scanned) != DEVICES:
+            raise RuntimeError("Scanner saw %d devices, not %d" % (len(scanner.scanned), DEVICES))
+        return elapsed
+    return run
+
+@benchmark("scanner.process.text", 100000, perOp=False)
+def benchScannerText():
+    return _scannerRun(False)
+
+@benchmark("scanner.process.binary", 100000, perOp=False)
+def benchScannerBinary():
+    if not hasattr(btle, 'BinaryFraming'):
+        return None
+    return _scannerRun(True)
+
+def _gattRun(dump):
+    # Discovers the database of a simhelper.py device (this checkout's,
+    # so older trees can be measured too) n times over one connection
+    sim = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simhelper.py')
+    config = {'devices': 1, 'advRate': 1.0, 'connectable': 1.0,
+              'services': 4, 'chars': 6}
+
+    def forget(p):
+        # Drops what discovery found, so each operation starts afresh
+        p._serviceMap = None
+        if hasattr(p, '_resetIndex'):
+            p._resetIndex()
+
+    def run(n):
+        saved = (btle.helperExe, os.environ.get('BLUEPY_SIM'))
+        os.environ['BLUEPY_SIM'] = json.dumps(config)
+        btle.helperExe = sim
+        try:
+            p = btle.Peripheral("c0:5e:00:00:00:00", btle.ADDR_TYPE_RANDOM)
+        finally:
+            btle.helperExe = saved[0]
+            if saved[1] is None:
+                del os.environ['BLUEPY_SIM']
+            else:
+                os.environ['BLUEPY_SIM'] = saved[1]
+        try:
+            start = _timer()
+            for i in range(n):
+                forget(p)
+                if dump:
+                    svcs = p.discoverAll()
+                else:
+                    svcs = sorted(p.getServices(), key=lambda s: s.hndStart)
+                for svc in svcs:
+                    for ch in svc.getCharacteristics():
+                        ch.getDescriptors()
+            elapsed = _timer() - start
+        finally:
+            p.disconnect()
+        return elapsed
+    return run
+
+@benchmark("gatt.walk", 500)
+def benchGattWalk():
+    return _gattRun(False)
+
+@benchmark("gatt.discoverAll", 500)
+def benchGattDiscoverAll():
+    if not hasattr(btle.Peripheral, 'discoverAll'):
+        return None
+    return _gattRun(True)
+
+
+def measure(run, count, repeat, perOp=True):
+    # Best time of repeat runs, then the same with tracemalloc on: the
+    # peak allocated during a single operation, what n operations leave
+    # allocated, and the peak over them
+    if perOp:
+        run(max(1, count // 20)) # Warm up caches
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = _timer()
+        elapsed = run(count)
+        if elapsed is None:
+            elapsed = _timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = { 'n' : count,
+               'ops_per_s' : count / best,
+               'us_per_op' : best * 1e6 / count }
+    if tracemalloc is not None:
+        gc.collect()
+        if perOp:
+            # Less what the loop itself takes
+            peaks = []
+            for ops in (0, 1):
+                tracemalloc.start()
+                run(ops)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            result['alloc_bytes_per_op'] = max(0, peaks[1] - peaks[0])
+        tracemalloc.start()
+        run(count)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['retained_bytes_per_op'] = float(current) / count
+        result['peak_kib'] = peak / 1024.0
+    return result
+
+
+def loadBtle(tree=None):
+    # The btle of the given checkout, or of the one this script is in
+    global btle
+    root = os.path.abspath(tree) if tree else os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, root)
+    from bluepy import btle as module
+    btle = module
+    return root
+
+def _commit(root):
+    try:
+        out = subprocess.check_output(["git", "-C", root, "describe", "--always", "--dirty"],
+                                      stderr=open(os.devnull, 'w'))
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runAll(root, only=None, quick=False, repeat=5, out=sys.stdout):
+    results = {}
+    for (name, count, perOp, factory) in BENCHMARKS:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        if quick:
+            count = max(1, count // 10)
+        run = factory()
+        if run is None:
+            print("%-32s (not in this tree)" % name, file=out)
+            continue
+        results[name] = res = measure(run, count, repeat if perOp else min(repeat, 3), perOp)
+        print(_format(name, res), file=out)
+        out.flush()
+    return { 'tree' : root,
+             'commit' : _commit(root),
+             'python' : platform.python_version(),
+             'machine' : platform.machine(),
+             'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'results' : results }
+
+def _format(name, res):
+    line = "%-32s %12.0f ops/s %9.3f us/op" % (name, res['ops_per_s'], res['us_per_op'])
+    if 'peak_kib' in res:
+        if 'alloc_bytes_per_op' in res:
+            line += " %7d B/op" % res['alloc_bytes_per_op']
+        else:
+            line += " %7s B/op" % "-"
+        line += " %9.1f B kept/op %9.1f KiB peak" % (res['retained_bytes_per_op'], res['peak_kib'])
+    return line
+
+def compare(old, new, out=sys.stdout):
+    # Speed of new relative to old per benchmark (above 1 is faster)
+    print("%-32s %12s %12s %7s %9s" % ("", old.get('commit') or "old",
+                                        new.get('commit') or "new", "speed", "alloc"), file=out)
+    for name in sorted(set(old['results']) | set(new['results'])):
+        (a, b) = (old['results'].get(name), new['results'].get(name))
+        if a is None or b is None:
+            print("%-32s %12s %12s" % (name, "%.0f" % a['ops_per_s'] if a else "-",
+                                       "%.0f" % b['ops_per_s'] if b else "-"), file=out)
+            continue
+        alloc = ""
+        if a.get('alloc_bytes_per_op') and 'alloc_bytes_per_op' in b:
+            alloc = "%8.2fx" % (float(b['alloc_bytes_per_op']) / a['alloc_bytes_per_op'])
+        print("%-32s %12.0f %12.0f %6.2fx %9s" % (name, a['ops_per_s'], b['ops_per_s'],
+                                                  b['ops_per_s'] / a['ops_per_s'], alloc), file=out)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the btle hot paths")
+    parser.add_argument('-o', '--output', help="Write the results to this JSON file")
+    parser.add_argument('--tree', help="Benchmark the bluepy in this checkout")
+    parser.add_argument('--only', action='append', help="Benchmarks whose names start with this")
+    parser.add_argument('--quick', action='store_true', help="A tenth of the operations")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs to take the best of")
+    parser.add_argument('--compare', nargs='+', metavar='JSON',
+                        help="Compare results: old.json new.json, or old.json with this run")
+    parser.add_argument('--list', action='store_true', help="List the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for (name, count, perOp, factory) in BENCHMARKS:
+            print(name)
+        return
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes one or two result files")
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        compare(old, new)
+        return
+
+    root = loadBtle(args.tree)
+    results = runAll(root, args.only, args.quick, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        print()
+        compare(old, results)
+
+if __name__ == '__main__':
+    if os.environ.get(STREAM_ENV):
+        # Started by Scanner as its helper (with the interface argument)
+        streamHelper(os.environ[STREAM_ENV])
+    else:
+        main(sys.argv[1:])
@@ -24,13 +24,13 @@ else:
 
 
 def dump_services(dev):
-    services = sorted(dev.services, key=lambda s: s.hndStart)
+    services = dev.discoverAll()
     for s in services:
         print ("\t%04x: %s" % (s.hndStart, s))
         if s.hndStart == s.hndEnd:
             continue
         chars = s.getCharacteristics()
-        for i, c in enumerate(chars):
+        for c in chars:
             props = c.propertiesToString()
             h = c.getHandle()
             if 'READ' in props:
@@ -48,7 +48,7 @@ def dump_services(dev):
 
             while True:
                 h += 1
-                if h > s.hndEnd or (i < len(chars) - 1 and h >= chars[i + 1].getHandle() - 1):
+                if h > c.getEndHandle():
                     break
                 try:
                     val = dev.readCharacteristic(h)
@@ -68,16 +68,9 @@ static void try_open(void) {
 #endif
 #endif
 
-static GIOChannel *iochannel = NULL;
-static GAttrib *attrib = NULL;
 static GMainLoop *event_loop;
 
-static gchar *opt_src = NULL;
-static gchar *opt_dst = NULL;
-static gchar *opt_dst_type = NULL;
-static gchar *opt_sec_level = NULL;
 static const int opt_psm = 0;
-static int opt_mtu = 0;
 static int start;
 static int end;
 
@@ -87,21 +80,56 @@ static struct mgmt *mgmt_master = NULL;
 static int hci_dd = -1;
 static GIOChannel *hci_io = NULL;
 
+struct conn;
+
 struct characteristic_data {
+    struct conn *conn;
     uint16_t orig_start;
     uint16_t start;
     uint16_t end;
     bt_uuid_t uuid;
 };
 
+struct read_blob_data {
+    struct conn *conn;
+    uint16_t handle;
+    uint16_t offset;
+    GByteArray *value;
+};
+
 static void cmd_help(int argcp, char **argvp);
 
-static enum state {
+enum state {
     STATE_DISCONNECTED=0,
     STATE_CONNECTING=1,
     STATE_CONNECTED=2,
     STATE_SCANNING=3,
-} conn_state;
+};
+
+/*
+ * Connection slots. A command acts on slot 0 unless it is prefixed with
+ * "@<slot>", and responses for any other slot carry a "cid" item, so one
+ * helper can hold several LE connections at once. Scanning always uses
+ * slot 0.
+ */
+#define MAX_CONNS 8
+
+struct conn {
+    unsigned int id;
+    GIOChannel *iochannel;
+    GAttrib *attrib;
+    enum state state;
+    gchar *src;
+    gchar *dst;
+    gchar *dst_type;
+    gchar *sec_level;
+    int mtu;
+};
+
+static struct conn conns[MAX_CONNS];
+
+/* Slot of the command or callback being handled */
+static struct conn *cur = &conns[0];
 
 
 static const char
@@ -123,7 +151,8 @@ static const char
   *tag_ADDR       = "addr",
   *tag_TYPE       = "type",
   *tag_RSSI       = "rssi",
-  *tag_FLAG       = "flag";
+  *tag_FLAG       = "flag",
+  *tag_CONN       = "cid";
 
 static const char
   *rsp_ERROR     = "err",
@@ -136,7 +165,10 @@ static const char
   *rsp_WRITE     = "wr",
   *rsp_MGMT      = "mgmt",
   *rsp_SCAN      = "scan",
-  *rsp_OOB       = "oob";
+  *rsp_OOB       = "oob",
+  *rsp_BINARY    = "bin",
+  *rsp_SENT      = "sent",
+  *rsp_GATT      = "gatt";
 
 static const char
   *err_CONN_FAIL = "connfail",
@@ -151,6 +183,7 @@ static const char
   *err_BAD_STATE = "badstate",
   *err_BUSY      = "busy",
   *err_NO_MGMT   = "nomgmt",
+  *err_FRAME     = "eframe",   /* Response would not fit a frame */
   *err_SUCCESS   = "success";
 
 static const char
@@ -162,28 +195,140 @@ static const char
 // delimits fields in response message
 #define RESP_DELIM "\x1e"
 
+/*
+ * Binary framing, switched on with the "bin" command. Each response is
+ * sent as one frame:
+ *
+ *   magic (1) | response type (1) | payload length (2, LE)
+ *
+ * and the payload is a sequence of items:
+ *
+ *   tag (1) | value type (1) | value length (2, LE) | value
+ *
+ * Response types and tags are indexes into frame_rsps[] and frame_tags[]
+ * (bluepy/btle.py keeps the same tables). Value types are the same
+ * characters used as prefixes in the text protocol; 'h' values are
+ * 4-byte LE integers and 'b' values are raw bytes instead of hex.
+ * Lines starting with '#' are still written as text. A response that
+ * won't fit in a frame is replaced by an 'err' with code 'eframe'.
+ */
+#define FRAME_MAGIC       0xBE
+#define FRAME_HDR_LEN     4
+#define FRAME_ITEM_HDR_LEN 4
+#define FRAME_MAX_PAYLOAD 0xFFFF
+
+static const char **frame_rsps[] = {
+  &rsp_ERROR, &rsp_STATUS, &rsp_NOTIFY, &rsp_IND, &rsp_DISCOVERY,
+  &rsp_DESCRIPTORS, &rsp_READ, &rsp_WRITE, &rsp_MGMT, &rsp_SCAN,
+  &rsp_OOB, &rsp_BINARY, &rsp_SENT, &rsp_GATT,
+  NULL
+};
+
+static const char **frame_tags[] = {
+  &tag_RESPONSE, &tag_ERRCODE, &tag_ERRSTAT, &tag_ERRMSG, &tag_HANDLE,
+  &tag_UUID, &tag_DATA, &tag_CONNSTATE, &tag_SEC_LEVEL, &tag_MTU,
+  &tag_DEVICE, &tag_RANGE_START, &tag_RANGE_END, &tag_PROPERTIES,
+  &tag_VALUE_HANDLE, &tag_ADDR, &tag_TYPE, &tag_RSSI, &tag_FLAG,
+  &tag_CONN,
+  NULL
+};
+
+static bool opt_binary = FALSE;
+static uint8_t frame_buf[FRAME_HDR_LEN + FRAME_MAX_PAYLOAD];
+static size_t frame_len;
+/* Set when the frame being built can't be sent as it is; resp_end()
+ * sends an 'eframe' error in its place */
+static bool frame_failed;
+
+static uint8_t frame_code(const char ***table, const char *name)
+{
+  int i;
+
+  for (i = 0; table[i]; i++)
+    if (*table[i] == name)
+      return i;
+
+  DBG("no frame code for '%s'", name);
+  frame_failed = TRUE;
+  return 0xFF;
+}
+
+static void frame_item(const char *tag, char vtype, const void *val, size_t len)
+{
+  uint8_t *p = frame_buf + frame_len;
+  uint8_t code;
+
+  if (frame_failed)
+    return;
+
+  if (frame_len + FRAME_ITEM_HDR_LEN + len > sizeof(frame_buf)) {
+    DBG("frame overflow at '%s'", tag);
+    frame_failed = TRUE;
+    return;
+  }
+
+  code = frame_code(frame_tags, tag);
+  if (frame_failed)
+    return;
+
+  p[0] = code;
+  p[1] = vtype;
+  bt_put_le16(len, p + 2);
+  memcpy(p + FRAME_ITEM_HDR_LEN, val, len);
+  frame_len += FRAME_ITEM_HDR_LEN + len;
+}
+
+static void send_uint(const char *tag, unsigned int val);
+
 static void resp_begin(const char *rsptype)
 {
-  printf("%s=$%s", tag_RESPONSE, rsptype);
+  if (opt_binary) {
+    frame_failed = FALSE;
+    frame_buf[0] = FRAME_MAGIC;
+    frame_buf[1] = frame_code(frame_rsps, rsptype);
+    frame_len = FRAME_HDR_LEN;
+  } else {
+    printf("%s=$%s", tag_RESPONSE, rsptype);
+  }
+  if (cur->id)
+    send_uint(tag_CONN, cur->id);
 }
 
 static void send_sym(const char *tag, const char *val)
 {
+  if (opt_binary) {
+    frame_item(tag, '$', val, strlen(val));
+    return;
+  }
   printf(RESP_DELIM "%s=$%s", tag, val);
 }
 
 static void send_uint(const char *tag, unsigned int val)
 {
+  if (opt_binary) {
+    uint8_t le[4];
+    bt_put_le32(val, le);
+    frame_item(tag, 'h', le, sizeof(le));
+    return;
+  }
   printf(RESP_DELIM "%s=h%X", tag, val);
 }
 
 static void send_str(const char *tag, const char *val)
 {
+  if (opt_binary) {
+    frame_item(tag, '\'', val, val ? strlen(val) : 0);
+    return;
+  }
   printf(RESP_DELIM "%s='%s", tag, val);
 }
 
 static void send_data(const unsigned char *val, size_t len)
 {
+  if (opt_binary) {
+    frame_item(tag_DATA, 'b', val, len);
+    return;
+  }
   printf(RESP_DELIM "%s=b", tag_DATA);
   while ( len-- > 0 )
     printf("%02X", *val++);
@@ -192,18 +337,39 @@ static void send_data(const unsigned char *val, size_t len)
 static void send_addr(const struct mgmt_addr_info *addr)
 {
     const uint8_t *val = addr->bdaddr.b;
-    printf(RESP_DELIM "%s=b", tag_ADDR);
     int len = 6;
-    /* Human-readable byte order is reverse of bdaddr.b */
-    while ( len-- > 0 )
-        printf("%02X", val[len]);
+
+    if (opt_binary) {
+        uint8_t hr[6];
+        /* Human-readable byte order is reverse of bdaddr.b */
+        while ( len-- > 0 )
+            hr[5 - len] = val[len];
+        frame_item(tag_ADDR, 'b', hr, sizeof(hr));
+    } else {
+        printf(RESP_DELIM "%s=b", tag_ADDR);
+        /* Human-readable byte order is reverse of bdaddr.b */
+        while ( len-- > 0 )
+            printf("%02X", val[len]);
+    }
 
     send_uint(tag_TYPE, addr->type);
 }
 
+static void resp_error(const char *errcode);
+
 static void resp_end()
 {
-  printf("\n");
+  if (opt_binary) {
+    if (frame_failed) {
+      /* Fail the whole response rather than send part of it */
+      resp_error(err_FRAME);
+      return;
+    }
+    bt_put_le16(frame_len - FRAME_HDR_LEN, frame_buf + 2);
+    fwrite(frame_buf, 1, frame_len, stdout);
+  } else {
+    printf("\n");
+  }
   fflush(stdout);
 }
 
@@ -250,21 +416,21 @@ static void resp_mgmt_err(uint8_t status)
 static void cmd_status(int argcp, char **argvp)
 {
   resp_begin(rsp_STATUS);
-  switch(conn_state)
+  switch(cur->state)
   {
     case STATE_CONNECTING:
       send_sym(tag_CONNSTATE, st_CONNECTING);
-      send_str(tag_DEVICE, opt_dst);
+      send_str(tag_DEVICE, cur->dst);
       break;
 
     case STATE_CONNECTED:
       send_sym(tag_CONNSTATE, st_CONNECTED);
-      send_str(tag_DEVICE, opt_dst);
+      send_str(tag_DEVICE, cur->dst);
       break;
 
     case STATE_SCANNING:
       send_sym(tag_CONNSTATE, st_SCANNING);
-      send_str(tag_DEVICE, opt_dst);
+      send_str(tag_DEVICE, cur->dst);
       break;
 
     default:
@@ -272,14 +438,14 @@ static void cmd_status(int argcp, char **argvp)
       break;
   }
 
-  send_uint(tag_MTU, opt_mtu);
-  send_str(tag_SEC_LEVEL, opt_sec_level);
+  send_uint(tag_MTU, cur->mtu);
+  send_str(tag_SEC_LEVEL, cur->sec_level);
   resp_end();
 }
 
 static void set_state(enum state st)
 {
-    conn_state = st;
+    cur->state = st;
     cmd_status(0, NULL);
 }
 
@@ -290,6 +456,8 @@ static void events_handler(const uint8_t *pdu, uint16_t len, gpointer user_data)
     uint16_t handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     evt = pdu[0];
 
     if ( evt != ATT_OP_HANDLE_NOTIFY && evt != ATT_OP_HANDLE_IND )
@@ -309,11 +477,11 @@ static void events_handler(const uint8_t *pdu, uint16_t len, gpointer user_data)
     if (evt == ATT_OP_HANDLE_NOTIFY)
         return;
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_confirmation(opdu, plen);
 
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_find_info_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -323,15 +491,17 @@ static void gatts_find_info_req(const uint8_t *pdu, uint16_t len, gpointer user_
     uint16_t starting_handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len == 5 );
     opcode = pdu[0];
     starting_handle = bt_get_le16(&pdu[1]);
     /* ending_handle = bt_get_le16(&pdu[3]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, starting_handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_find_by_type_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -341,16 +511,18 @@ static void gatts_find_by_type_req(const uint8_t *pdu, uint16_t len, gpointer us
     uint16_t starting_handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len >= 7 );
     opcode = pdu[0];
     starting_handle = bt_get_le16(&pdu[1]);
     /* ending_handle = bt_get_le16(&pdu[3]); */
     /* att_type = bt_get_le16(&pdu[5]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, starting_handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_read_by_type_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -360,6 +532,8 @@ static void gatts_read_by_type_req(const uint8_t *pdu, uint16_t len, gpointer us
     uint16_t starting_handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len == 7 || len == 21 );
     opcode = pdu[0];
     starting_handle = bt_get_le16(&pdu[1]);
@@ -368,10 +542,10 @@ static void gatts_read_by_type_req(const uint8_t *pdu, uint16_t len, gpointer us
         /* att_type = bt_get_le16(&pdu[5]); */
     }
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, starting_handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_read_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -381,14 +555,16 @@ static void gatts_read_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
     uint16_t handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len == 3 );
     opcode = pdu[0];
     handle = bt_get_le16(&pdu[1]);
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_read_blob_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -398,15 +574,17 @@ static void gatts_read_blob_req(const uint8_t *pdu, uint16_t len, gpointer user_
     uint16_t handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len == 5 );
     opcode = pdu[0];
     handle = bt_get_le16(&pdu[1]);
     /* offset = bt_get_le16(&pdu[3]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_read_multi_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -416,15 +594,17 @@ static void gatts_read_multi_req(const uint8_t *pdu, uint16_t len, gpointer user
     uint16_t handle1, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len >= 5 );
     opcode = pdu[0];
     handle1 = bt_get_le16(&pdu[1]);
     /* handle2 = bt_get_le16(&pdu[3]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, handle1, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_read_by_group_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -434,16 +614,18 @@ static void gatts_read_by_group_req(const uint8_t *pdu, uint16_t len, gpointer u
     uint16_t starting_handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len >= 7 );
     opcode = pdu[0];
     starting_handle = bt_get_le16(&pdu[1]);
     /* ending_handle = bt_get_le16(&pdu[3]); */
     /* att_group_type = bt_get_le16(&pdu[5]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, starting_handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_write_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -453,14 +635,16 @@ static void gatts_write_req(const uint8_t *pdu, uint16_t len, gpointer user_data
     uint16_t handle, olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len >= 3 );
     opcode = pdu[0];
     handle = bt_get_le16(&pdu[1]);
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_write_cmd(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -484,15 +668,17 @@ static void gatts_prep_write_req(const uint8_t *pdu, uint16_t len, gpointer user
     uint16_t olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len >= 5 );
     opcode = pdu[0];
     handle = bt_get_le16(&pdu[1]);
     /* offset = bt_get_le16(&pdu[3]); */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, handle, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
 }
 
 static void gatts_exec_write_req(const uint8_t *pdu, uint16_t len, gpointer user_data)
@@ -502,14 +688,26 @@ static void gatts_exec_write_req(const uint8_t *pdu, uint16_t len, gpointer user
     uint16_t olen;
     size_t plen;
 
+    cur = user_data;
+
     assert( len == 5 );
     opcode = pdu[0];
     /* flags = pdu[1]; */
 
-    opdu = g_attrib_get_buffer(attrib, &plen);
+    opdu = g_attrib_get_buffer(cur->attrib, &plen);
     olen = enc_error_resp(opcode, 0, ATT_ECODE_REQ_NOT_SUPP, opdu, plen);
     if (olen > 0)
-        g_attrib_send(attrib, 0, opdu, olen, NULL, NULL, NULL);
+        g_attrib_send(cur->attrib, 0, opdu, olen, NULL, NULL, NULL);
+}
+
+static struct conn *conn_for_io(GIOChannel *io)
+{
+    int i;
+
+    for (i = 0; i < MAX_CONNS; i++)
+        if (conns[i].iochannel == io)
+            return &conns[i];
+    return NULL;
 }
 
 static void connect_cb(GIOChannel *io, GError *err, gpointer user_data)
@@ -519,6 +717,13 @@ static void connect_cb(GIOChannel *io, GError *err, gpointer user_data)
     GError *gerr = NULL;
 
     DBG("io = %p, err = %p", io, err);
+    /* gatt_connect() gives us no user_data */
+    cur = conn_for_io(io);
+    if (cur == NULL) {
+        DBG("no slot for io %p", io);
+        cur = &conns[0];
+        return;
+    }
     if (err) {
         set_state(STATE_DISCONNECTED);
         resp_str_error(err_CONN_FAIL, err->message);
@@ -537,52 +742,56 @@ static void connect_cb(GIOChannel *io, GError *err, gpointer user_data)
     else if (cid == ATT_CID)
         mtu = ATT_DEFAULT_LE_MTU;
 
-    attrib = g_attrib_new(iochannel, mtu, false);
-
-    g_attrib_register(attrib, ATT_OP_HANDLE_NOTIFY, GATTRIB_ALL_HANDLES,
-                        events_handler, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_HANDLE_IND, GATTRIB_ALL_HANDLES,
-                        events_handler, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_FIND_INFO_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_find_info_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_FIND_BY_TYPE_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_find_by_type_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_READ_BY_TYPE_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_read_by_type_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_READ_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_read_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_READ_BLOB_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_read_blob_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_READ_MULTI_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_read_multi_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_READ_BY_GROUP_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_read_by_group_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_WRITE_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_write_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_WRITE_CMD, GATTRIB_ALL_HANDLES,
-                      gatts_write_cmd, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_SIGNED_WRITE_CMD, GATTRIB_ALL_HANDLES,
-                      gatts_signed_write_cmd, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_PREP_WRITE_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_prep_write_req, attrib, NULL);
-    g_attrib_register(attrib, ATT_OP_EXEC_WRITE_REQ, GATTRIB_ALL_HANDLES,
-                      gatts_exec_write_req, attrib, NULL);
+    cur->attrib = g_attrib_new(cur->iochannel, mtu, false);
+
+    g_attrib_register(cur->attrib, ATT_OP_HANDLE_NOTIFY, GATTRIB_ALL_HANDLES,
+                        events_handler, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_HANDLE_IND, GATTRIB_ALL_HANDLES,
+                        events_handler, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_FIND_INFO_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_find_info_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_FIND_BY_TYPE_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_find_by_type_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_READ_BY_TYPE_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_read_by_type_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_READ_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_read_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_READ_BLOB_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_read_blob_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_READ_MULTI_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_read_multi_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_READ_BY_GROUP_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_read_by_group_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_WRITE_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_write_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_WRITE_CMD, GATTRIB_ALL_HANDLES,
+                      gatts_write_cmd, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_SIGNED_WRITE_CMD, GATTRIB_ALL_HANDLES,
+                      gatts_signed_write_cmd, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_PREP_WRITE_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_prep_write_req, cur, NULL);
+    g_attrib_register(cur->attrib, ATT_OP_EXEC_WRITE_REQ, GATTRIB_ALL_HANDLES,
+                      gatts_exec_write_req, cur, NULL);
 
     set_state(STATE_CONNECTED);
 }
 
 static void disconnect_io()
 {
-    if (conn_state == STATE_DISCONNECTED)
+    GAttrib *attrib;
+
+    if (cur->state == STATE_DISCONNECTED)
         return;
 
+    /* Cleared first, so char_write_sent() can tell */
+    attrib = cur->attrib;
+    cur->attrib = NULL;
     g_attrib_unref(attrib);
-    attrib = NULL;
-    opt_mtu = 0;
+    cur->mtu = 0;
 
-    g_io_channel_shutdown(iochannel, FALSE, NULL);
-    g_io_channel_unref(iochannel);
-    iochannel = NULL;
+    g_io_channel_shutdown(cur->iochannel, FALSE, NULL);
+    g_io_channel_unref(cur->iochannel);
+    cur->iochannel = NULL;
 
     set_state(STATE_DISCONNECTED);
 }
@@ -591,6 +800,8 @@ static void primary_all_cb(uint8_t status, GSList *services, void *user_data)
 {
     GSList *l;
 
+    cur = user_data;
+
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -613,6 +824,8 @@ static void primary_by_uuid_cb(uint8_t status, GSList *ranges, void *user_data)
 {
     GSList *l;
 
+    cur = user_data;
+
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -633,6 +846,8 @@ static void included_cb(uint8_t status, GSList *includes, void *user_data)
 {
     GSList *l;
 
+    cur = user_data;
+
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -655,6 +870,8 @@ static void char_cb(uint8_t status, GSList *characteristics, void *user_data)
 {
     GSList *l;
 
+    cur = user_data;
+
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -677,6 +894,8 @@ static void char_desc_cb(uint8_t status, GSList *descriptors, void *user_data)
 {
     GSList *l;
 
+    cur = user_data;
+
     if (status != 0) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -693,12 +912,178 @@ static void char_desc_cb(uint8_t status, GSList *descriptors, void *user_data)
         resp_end();
 }
 
+/* The whole database in one response, for 'dump': primary services,
+ * then every characteristic, then the descriptors between each value
+ * handle and the next declaration (or the end of its service) */
+struct discover_all {
+    struct conn *conn;
+    GSList *services;   /* of struct gatt_primary */
+    GSList *chars;      /* of struct gatt_char */
+    GSList *descs;      /* of struct gatt_desc */
+    GSList *next;       /* Characteristic to find descriptors for */
+};
+
+static void discover_all_free(struct discover_all *da)
+{
+    g_slist_free_full(da->services, g_free);
+    g_slist_free_full(da->chars, g_free);
+    g_slist_free_full(da->descs, g_free);
+    g_free(da);
+}
+
+/* gatt_discover_*() free their lists once the callback returns */
+static GSList *copy_list(GSList *list, GSList *to, size_t size)
+{
+    for (; list; list = list->next)
+        to = g_slist_prepend(to, g_memdup(list->data, size));
+    return to;
+}
+
+static void discover_all_done(struct discover_all *da)
+{
+    GSList *l;
+
+    /* Tags repeat across the three parts: 'uuid' lists the services',
+     * then the characteristics', then the descriptors'; 'hnd' lists the
+     * characteristics' then the descriptors' */
+    resp_begin(rsp_GATT);
+    for (l = da->services; l; l = l->next) {
+        struct gatt_primary *prim = l->data;
+        send_uint(tag_RANGE_START, prim->range.start);
+        send_uint(tag_RANGE_END, prim->range.end);
+        send_str(tag_UUID, prim->uuid);
+    }
+    for (l = da->chars; l; l = l->next) {
+        struct gatt_char *chars = l->data;
+        send_uint(tag_HANDLE, chars->handle);
+        send_uint(tag_PROPERTIES, chars->properties);
+        send_uint(tag_VALUE_HANDLE, chars->value_handle);
+        send_str(tag_UUID, chars->uuid);
+    }
+    for (l = da->descs; l; l = l->next) {
+        struct gatt_desc *desc = l->data;
+        send_uint(tag_HANDLE, desc->handle);
+        send_str(tag_UUID, desc->uuid);
+    }
+    resp_end();
+    discover_all_free(da);
+}
+
+static void discover_all_desc_cb(uint8_t status, GSList *descriptors,
+                                 void *user_data);
+
+static void discover_all_next(struct discover_all *da)
+{
+    cur = da->conn;
+
+    if (cur->state != STATE_CONNECTED) {
+        resp_error(err_BAD_STATE);
+        discover_all_free(da);
+        return;
+    }
+
+    while (da->next) {
+        struct gatt_char *chr = da->next->data;
+        int end = 0xffff;
+        GSList *l;
+
+        da->next = da->next->next;
+        if (da->next)
+            end = ((struct gatt_char *)da->next->data)->handle - 1;
+        for (l = da->services; l; l = l->next) {
+            struct gatt_primary *prim = l->data;
+            if (prim->range.start <= chr->handle &&
+                chr->handle <= prim->range.end && prim->range.end < end)
+                end = prim->range.end;
+        }
+        if (chr->value_handle < end) {
+            if (!gatt_discover_desc(cur->attrib, chr->value_handle + 1, end,
+                                    NULL, discover_all_desc_cb, da)) {
+                resp_error(err_SEND_FAIL);
+                discover_all_free(da);
+            }
+            return;
+        }
+    }
+
+    da->descs = g_slist_reverse(da->descs);
+    discover_all_done(da);
+}
+
+static void discover_all_desc_cb(uint8_t status, GSList *descriptors,
+                                 void *user_data)
+{
+    struct discover_all *da = user_data;
+
+    cur = da->conn;
+
+    if (status != 0 && status != ATT_ECODE_ATTR_NOT_FOUND) {
+        DBG("status returned error : %s (0x%02x)",
+            att_ecode2str(status), status);
+        resp_att_error(status);
+        discover_all_free(da);
+        return;
+    }
+
+    da->descs = copy_list(descriptors, da->descs, sizeof(struct gatt_desc));
+    discover_all_next(da);
+}
+
+static void discover_all_char_cb(uint8_t status, GSList *characteristics,
+                                 void *user_data)
+{
+    struct discover_all *da = user_data;
+
+    cur = da->conn;
+
+    if (status != 0 && status != ATT_ECODE_ATTR_NOT_FOUND) {
+        DBG("status returned error : %s (0x%02x)",
+            att_ecode2str(status), status);
+        resp_att_error(status);
+        discover_all_free(da);
+        return;
+    }
+
+    da->chars = g_slist_reverse(copy_list(characteristics, NULL,
+                                          sizeof(struct gatt_char)));
+    da->next = da->chars;
+    discover_all_next(da);
+}
+
+static void discover_all_primary_cb(uint8_t status, GSList *services,
+                                    void *user_data)
+{
+    struct discover_all *da = user_data;
+
+    cur = da->conn;
+
+    if (status) {
+        DBG("status returned error : %s (0x%02x)",
+            att_ecode2str(status), status);
+        resp_att_error(status);
+        discover_all_free(da);
+        return;
+    }
+
+    da->services = g_slist_reverse(copy_list(services, NULL,
+                                             sizeof(struct gatt_primary)));
+    /* One characteristic discovery over the whole table rather than one
+     * per service; responses pack across service boundaries */
+    if (!gatt_discover_char(cur->attrib, 0x0001, 0xffff, NULL,
+                            discover_all_char_cb, da)) {
+        resp_error(err_SEND_FAIL);
+        discover_all_free(da);
+    }
+}
+
 static void char_read_cb(guint8 status, const guint8 *pdu, guint16 plen,
                             gpointer user_data)
 {
     uint8_t value[plen];
     ssize_t vlen;
 
+    cur = user_data;
+
     if (status != 0) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -724,6 +1109,8 @@ static void char_read_by_uuid_cb(guint8 status, const guint8 *pdu,
     struct att_data_list *list;
     int i;
 
+    cur = char_data->conn;
+
     if (status == ATT_ECODE_ATTR_NOT_FOUND &&
                 char_data->start != char_data->orig_start)
     {
@@ -771,8 +1158,9 @@ static gboolean channel_watcher(GIOChannel *chan, GIOCondition cond,
 {
     DBG("chan = %p", chan);
 
+    cur = user_data;
     // in case of quick disconnection/reconnection, do not mix them
-    if (chan == iochannel)
+    if (chan == cur->iochannel)
         disconnect_io();
 
     return FALSE;
@@ -781,43 +1169,43 @@ static gboolean channel_watcher(GIOChannel *chan, GIOCondition cond,
 static void cmd_connect(int argcp, char **argvp)
 {
     GError *gerr = NULL;
-    if (conn_state != STATE_DISCONNECTED)
+    if (cur->state != STATE_DISCONNECTED)
         return;
 
     if (argcp > 1) {
-        g_free(opt_dst);
-        opt_dst = g_strdup(argvp[1]);
+        g_free(cur->dst);
+        cur->dst = g_strdup(argvp[1]);
 
-        g_free(opt_dst_type);
+        g_free(cur->dst_type);
         if (argcp > 2)
-            opt_dst_type = g_strdup(argvp[2]);
+            cur->dst_type = g_strdup(argvp[2]);
         else
-            opt_dst_type = g_strdup("public");
-        g_free(opt_src);
+            cur->dst_type = g_strdup("public");
+        g_free(cur->src);
         if (argcp > 3) {
-            opt_src = g_strdup(argvp[3]);
+            cur->src = g_strdup(argvp[3]);
         } else {
-            opt_src = NULL;
+            cur->src = NULL;
         }
     }
 
-    if (opt_dst == NULL) {
+    if (cur->dst == NULL) {
         resp_error(err_BAD_PARAM);
         return;
     }
 
     set_state(STATE_CONNECTING);
-    iochannel = gatt_connect(opt_src, opt_dst, opt_dst_type, opt_sec_level,
-                        opt_psm, opt_mtu, connect_cb, &gerr);
+    cur->iochannel = gatt_connect(cur->src, cur->dst, cur->dst_type, cur->sec_level,
+                        opt_psm, cur->mtu, connect_cb, &gerr);
 
-    DBG("gatt_connect returned %p", iochannel);
-    if (iochannel == NULL)
+    DBG("gatt_connect returned %p", cur->iochannel);
+    if (cur->iochannel == NULL)
     {
         set_state(STATE_DISCONNECTED);
         g_error_free(gerr);
         }
     else
-        g_io_add_watch(iochannel, G_IO_HUP, channel_watcher, NULL);
+        g_io_add_watch(cur->iochannel, G_IO_HUP, channel_watcher, cur);
 }
 
 static void cmd_disconnect(int argcp, char **argvp)
@@ -830,13 +1218,13 @@ static void cmd_primary(int argcp, char **argvp)
 {
     bt_uuid_t uuid;
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
 
     if (argcp == 1) {
-        gatt_discover_primary(attrib, NULL, primary_all_cb, NULL);
+        gatt_discover_primary(cur->attrib, NULL, primary_all_cb, cur);
         return;
     }
 
@@ -845,7 +1233,7 @@ static void cmd_primary(int argcp, char **argvp)
         return;
     }
 
-    gatt_discover_primary(attrib, &uuid, primary_by_uuid_cb, NULL);
+    gatt_discover_primary(cur->attrib, &uuid, primary_by_uuid_cb, cur);
 }
 
 static int strtohandle(const char *src)
@@ -866,7 +1254,7 @@ static void cmd_included(int argcp, char **argvp)
     int start = 0x0001;
     int end = 0xffff;
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -888,7 +1276,7 @@ static void cmd_included(int argcp, char **argvp)
         }
     }
 
-    gatt_find_included(attrib, start, end, included_cb, NULL);
+    gatt_find_included(cur->attrib, start, end, included_cb, cur);
 }
 
 static void cmd_char(int argcp, char **argvp)
@@ -896,7 +1284,7 @@ static void cmd_char(int argcp, char **argvp)
     int start = 0x0001;
     int end = 0xffff;
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -925,16 +1313,16 @@ static void cmd_char(int argcp, char **argvp)
             return;
         }
 
-        gatt_discover_char(attrib, start, end, &uuid, char_cb, NULL);
+        gatt_discover_char(cur->attrib, start, end, &uuid, char_cb, cur);
         return;
     }
 
-    gatt_discover_char(attrib, start, end, NULL, char_cb, NULL);
+    gatt_discover_char(cur->attrib, start, end, NULL, char_cb, cur);
 }
 
 static void cmd_char_desc(int argcp, char **argvp)
 {
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -957,14 +1345,107 @@ static void cmd_char_desc(int argcp, char **argvp)
     } else
         end = 0xffff;
 
-    gatt_discover_desc(attrib, start, end, NULL, char_desc_cb, NULL);
+    gatt_discover_desc(cur->attrib, start, end, NULL, char_desc_cb, cur);
+}
+
+static void cmd_discover_all(int argcp, char **argvp)
+{
+    struct discover_all *da;
+
+    if (cur->state != STATE_CONNECTED) {
+        resp_error(err_BAD_STATE);
+        return;
+    }
+
+    da = g_new0(struct discover_all, 1);
+    da->conn = cur;
+    if (!gatt_discover_primary(cur->attrib, NULL, discover_all_primary_cb, da)) {
+        resp_error(err_SEND_FAIL);
+        discover_all_free(da);
+    }
 }
 
 static void cmd_read_hnd(int argcp, char **argvp)
 {
     int handle;
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
+        resp_error(err_BAD_STATE);
+        return;
+    }
+
+    if (argcp < 2) {
+        resp_error(err_BAD_PARAM);
+        return;
+    }
+
+    handle = strtohandle(argvp[1]);
+    if (handle < 0) {
+        resp_error(err_BAD_PARAM);
+        return;
+    }
+
+    gatt_read_char(cur->attrib, handle, char_read_cb, cur);
+}
+
+/* Reads the rest of a value from an offset with Read Blob requests,
+ * for as long as they come back full, and replies with all of it */
+static void read_blob_cb(guint8 status, const guint8 *pdu, guint16 plen,
+                            gpointer user_data)
+{
+    struct read_blob_data *rb = user_data;
+    uint8_t *buf;
+    size_t buflen;
+    guint16 olen;
+
+    cur = rb->conn;
+
+    if (status == ATT_ECODE_INVALID_OFFSET && rb->value->len > 0)
+        goto done; /* The last response was full by chance */
+
+    if (status != 0) {
+        DBG("status returned error : %s (0x%02x)",
+            att_ecode2str(status), status);
+        resp_att_error(status);
+        goto free;
+    }
+
+    if (plen < 1 || pdu[0] != ATT_OP_READ_BLOB_RESP) {
+        resp_error(err_DECODING);
+        goto free;
+    }
+
+    g_byte_array_append(rb->value, pdu + 1, plen - 1);
+
+    buf = g_attrib_get_buffer(cur->attrib, &buflen);
+    if (plen == buflen && rb->value->len < ATT_MAX_VALUE_LEN) {
+        olen = enc_read_blob_req(rb->handle, rb->offset + rb->value->len,
+                    buf, buflen);
+        if (g_attrib_send(cur->attrib, 0, buf, olen, read_blob_cb, rb, NULL))
+            return;
+        resp_error(err_SEND_FAIL);
+        goto free;
+    }
+
+done:
+    resp_begin(rsp_READ);
+    send_data(rb->value->data, rb->value->len);
+    resp_end();
+free:
+    g_byte_array_free(rb->value, TRUE);
+    g_free(rb);
+}
+
+static void cmd_read_long(int argcp, char **argvp)
+{
+    struct read_blob_data *rb;
+    uint8_t *buf;
+    size_t buflen;
+    guint16 plen;
+    int handle;
+    long offset = 0;
+
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -980,7 +1461,35 @@ static void cmd_read_hnd(int argcp, char **argvp)
         return;
     }
 
-    gatt_read_char(attrib, handle, char_read_cb, attrib);
+    if (argcp > 2) {
+        errno = 0;
+        offset = strtol(argvp[2], NULL, 16);
+        if (errno != 0 || offset < 0 || offset > ATT_MAX_VALUE_LEN) {
+            resp_error(err_BAD_PARAM);
+            return;
+        }
+    }
+
+    /* From the start, gatt_read_char() already carries on with Read
+     * Blob requests while the responses are full */
+    if (offset == 0) {
+        gatt_read_char(cur->attrib, handle, char_read_cb, cur);
+        return;
+    }
+
+    rb = g_new0(struct read_blob_data, 1);
+    rb->conn = cur;
+    rb->handle = handle;
+    rb->offset = offset;
+    rb->value = g_byte_array_new();
+
+    buf = g_attrib_get_buffer(cur->attrib, &buflen);
+    plen = enc_read_blob_req(handle, offset, buf, buflen);
+    if (!g_attrib_send(cur->attrib, 0, buf, plen, read_blob_cb, rb, NULL)) {
+        g_byte_array_free(rb->value, TRUE);
+        g_free(rb);
+        resp_error(err_SEND_FAIL);
+    }
 }
 
 static void cmd_read_uuid(int argcp, char **argvp)
@@ -990,7 +1499,7 @@ static void cmd_read_uuid(int argcp, char **argvp)
     int end = 0xffff;
     bt_uuid_t uuid;
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -1018,18 +1527,21 @@ static void cmd_read_uuid(int argcp, char **argvp)
     }
 
     char_data = g_new(struct characteristic_data, 1);
+    char_data->conn = cur;
     char_data->orig_start = start;
     char_data->start = start;
     char_data->end = end;
     char_data->uuid = uuid;
 
-    gatt_read_char_by_uuid(attrib, start, end, &char_data->uuid,
+    gatt_read_char_by_uuid(cur->attrib, start, end, &char_data->uuid,
                     char_read_by_uuid_cb, char_data);
 }
 
 static void char_write_req_cb(guint8 status, const guint8 *pdu, guint16 plen,
                             gpointer user_data)
 {
+    cur = user_data;
+
     if (status != 0) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
@@ -1046,45 +1558,90 @@ static void char_write_req_cb(guint8 status, const guint8 *pdu, guint16 plen,
     resp_end();
 }
 
+/* A streamed write ('wrs') has no reply of its own. Instead a 'sent'
+ * message follows once GAttrib has handed it to the socket (or with an
+ * error code, once it has failed), returning a credit: the client keeps
+ * a bounded window of writes in flight, and the kernel's own flow
+ * control reaches it. 'sent' comes unasked, like 'ntfy', so other
+ * commands can be answered meanwhile. */
+static void resp_sent(const char *errcode)
+{
+    resp_begin(rsp_SENT);
+    send_sym(tag_ERRCODE, errcode);
+    resp_end();
+}
+
+static void char_write_sent(gpointer user_data)
+{
+    struct conn *c = user_data;
+
+    /* Writes dropped on disconnection get no credit; 'stat' follows */
+    if (c->attrib == NULL)
+        return;
+    cur = c;
+    resp_sent(err_SUCCESS);
+}
+
+enum write_mode {
+    WRITE_CMD,
+    WRITE_REQ,
+    WRITE_STREAM,
+};
+
+static void resp_write_error(enum write_mode mode, const char *errcode)
+{
+    if (mode == WRITE_STREAM)
+        resp_sent(errcode);
+    else
+        resp_error(errcode);
+}
 
-static void cmd_char_write_common(int argcp, char **argvp, int with_response)
+static void cmd_char_write_common(int argcp, char **argvp, enum write_mode mode)
 {
     uint8_t *value = NULL;
     size_t plen;
     int handle;
 
-    if (conn_state != STATE_CONNECTED) {
-        resp_error(err_BAD_STATE);
+    /* Clients send a bare 'wrs' to check the helper has it */
+    if (argcp < 2) {
+        resp_error(err_BAD_PARAM);
         return;
     }
 
-    if (argcp < 2) {
-        resp_error(err_BAD_PARAM);
+    if (cur->state != STATE_CONNECTED) {
+        resp_write_error(mode, err_BAD_STATE);
         return;
     }
 
     handle = strtohandle(argvp[1]);
     if (handle <= 0) {
-        resp_error(err_BAD_PARAM);
+        resp_write_error(mode, err_BAD_PARAM);
         return;
     }
 
     if (argcp >= 3) {
       plen = gatt_attr_data_from_string(argvp[2], &value);
       if (plen == 0) {
-          resp_error(err_BAD_PARAM);
+          resp_write_error(mode, err_BAD_PARAM);
           return;
       }
     } else {
       plen = 0;
     }
 
-    if (with_response)
-        gatt_write_char(attrib, handle, value, plen,
-                    char_write_req_cb, NULL);
+    if (mode == WRITE_REQ)
+        gatt_write_char(cur->attrib, handle, value, plen,
+                    char_write_req_cb, cur);
+    else if (mode == WRITE_STREAM)
+    {
+        /* On failure GAttrib won't call char_write_sent() */
+        if (!gatt_write_cmd(cur->attrib, handle, value, plen,
+                    char_write_sent, cur))
+            resp_sent(err_SEND_FAIL);
+    }
     else
     {
-        gatt_write_cmd(attrib, handle, value, plen, NULL, NULL);
+        gatt_write_cmd(cur->attrib, handle, value, plen, NULL, NULL);
         resp_begin(rsp_WRITE);
         resp_end();
     }
@@ -1094,12 +1651,17 @@ static void cmd_char_write_common(int argcp, char **argvp, int with_response)
 
 static void cmd_char_write(int argcp, char **argvp)
 {
-  cmd_char_write_common(argcp, argvp, 0);
+  cmd_char_write_common(argcp, argvp, WRITE_CMD);
 }
 
 static void cmd_char_write_rsp(int argcp, char **argvp)
 {
-  cmd_char_write_common(argcp, argvp, 1);
+  cmd_char_write_common(argcp, argvp, WRITE_REQ);
+}
+
+static void cmd_char_write_stream(int argcp, char **argvp)
+{
+  cmd_char_write_common(argcp, argvp, WRITE_STREAM);
 }
 
 static void cmd_sec_level(int argcp, char **argvp)
@@ -1123,15 +1685,15 @@ static void cmd_sec_level(int argcp, char **argvp)
         return;
     }
 
-    g_free(opt_sec_level);
-    opt_sec_level = g_strdup(argvp[1]);
+    g_free(cur->sec_level);
+    cur->sec_level = g_strdup(argvp[1]);
 
-    if (conn_state != STATE_CONNECTED)
+    if (cur->state != STATE_CONNECTED)
         return;
 
     assert(!opt_psm);
 
-    bt_io_set(iochannel, &gerr,
+    bt_io_set(cur->iochannel, &gerr,
             BT_IO_OPT_SEC_LEVEL, sec_level,
             BT_IO_OPT_INVALID);
     if (gerr) {
@@ -1151,35 +1713,41 @@ static void exchange_mtu_cb(guint8 status, const guint8 *pdu, guint16 plen,
 {
     uint16_t mtu;
 
+    cur = user_data;
+
     if (status != 0) {
         DBG("status returned error : %s (0x%02x)",
             att_ecode2str(status), status);
+        /* Still the default MTU; it may be tried again */
+        cur->mtu = 0;
         resp_att_error(status);
         return;
     }
 
     if (!dec_mtu_resp(pdu, plen, &mtu)) {
+        cur->mtu = 0;
         resp_error(err_DECODING);
         return;
     }
 
-    mtu = MIN(mtu, opt_mtu);
+    mtu = MIN(mtu, cur->mtu);
     /* Set new value for MTU in client */
-    if (g_attrib_set_mtu(attrib, mtu))
+    if (g_attrib_set_mtu(cur->attrib, mtu))
     {
-        opt_mtu = mtu;
+        cur->mtu = mtu;
         cmd_status(0, NULL);
     }
     else
     {
         printf("# Error exchanging MTU\n");
+        cur->mtu = 0;
         resp_error(err_CALL_FAIL);
     }
 }
 
 static void cmd_mtu(int argcp, char **argvp)
 {
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_error(err_BAD_STATE);
         return;
     }
@@ -1191,25 +1759,27 @@ static void cmd_mtu(int argcp, char **argvp)
         return;
     }
 
-    if (opt_mtu) {
+    if (cur->mtu) {
         resp_error(err_BAD_STATE);
         /* Can only set once per connection */
         return;
     }
 
     errno = 0;
-    opt_mtu = strtoll(argvp[1], NULL, 16);
-    if (errno != 0 || opt_mtu < ATT_DEFAULT_LE_MTU) {
+    cur->mtu = strtoll(argvp[1], NULL, 16);
+    if (errno != 0 || cur->mtu < ATT_DEFAULT_LE_MTU) {
         resp_error(err_BAD_PARAM);
         return;
     }
 
-    gatt_exchange_mtu(attrib, opt_mtu, exchange_mtu_cb, NULL);
+    gatt_exchange_mtu(cur->attrib, cur->mtu, exchange_mtu_cb, cur);
 }
 
 static void set_mode_complete(uint8_t status, uint16_t length,
                     const void *param, void *user_data)
 {
+    cur = user_data;
+
     if (status != MGMT_STATUS_SUCCESS) {
         DBG("status returned error : %s (0x%02x)",
             mgmt_errstr(status), status);
@@ -1243,7 +1813,7 @@ static bool set_mode(uint16_t opcode, char *p_mode)
     // at this time only index 0 is supported
     if (mgmt_send(mgmt_master, opcode,
             mgmt_ind, sizeof(cp), &cp,
-            set_mode_complete, NULL, NULL) == 0) {
+            set_mode_complete, cur, NULL) == 0) {
         resp_mgmt(err_SUCCESS);
     }
     return true;
@@ -1267,6 +1837,8 @@ static void add_remote_oob_data_complete(uint8_t status, uint16_t len,
 {
     const struct mgmt_addr_info *rp = param;
     char str[18];
+
+    cur = user_data;
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             mgmt_errstr(status), status);
@@ -1344,7 +1916,7 @@ static bool add_remote_oob_data(uint16_t index, const bdaddr_t *bdaddr,
     }
     if (mgmt_send(mgmt_master, MGMT_OP_ADD_REMOTE_OOB_DATA, mgmt_ind, sizeof(cp), &cp,
                         add_remote_oob_data_complete,
-                        NULL, NULL) == 0) {
+                        cur, NULL) == 0) {
         resp_error(err_SEND_FAIL);
         g_free(oob);
         return false;
@@ -1400,6 +1972,8 @@ static void read_local_oob_data_complete(uint8_t status, uint16_t len,
     uint32_t eir_len = rp->eir_len;
     unsigned int i;
 
+    cur = user_data;
+
     if (status) {
         DBG("status returned error : %s (0x%02x)",
             mgmt_errstr(status), status);
@@ -1427,7 +2001,7 @@ static bool read_local_oob_data(uint16_t index)
     cp.type = 6;
     if (mgmt_send(mgmt_master, MGMT_OP_READ_LOCAL_OOB_EXT_DATA, mgmt_ind, sizeof(cp), &cp,
                         read_local_oob_data_complete,
-                        NULL, NULL) == 0) {
+                        cur, NULL) == 0) {
         resp_error(err_SEND_FAIL);
         return false;
     }
@@ -1456,6 +2030,8 @@ static void cmd_pairable(int argcp, char **argvp)
 static void pair_device_complete(uint8_t status, uint16_t length,
                     const void *param, void *user_data)
 {
+    cur = user_data;
+
     if (status != MGMT_STATUS_SUCCESS) {
         DBG("status returned error : %s (0x%02x)",
                 mgmt_errstr(status), status);
@@ -1478,17 +2054,17 @@ static void cmd_pair(int argcp, char **argvp)
         return;
     }
 
-    if (conn_state != STATE_CONNECTED) {
+    if (cur->state != STATE_CONNECTED) {
         resp_mgmt(err_BAD_STATE);
         return;
     }
 
-    if (str2ba(opt_dst, &bdaddr)) {
+    if (str2ba(cur->dst, &bdaddr)) {
         resp_mgmt(err_NOT_FOUND);
         return;
     }
 
-    if (!memcmp(opt_dst_type, "public", 6)) {
+    if (!memcmp(cur->dst_type, "public", 6)) {
         addr_type = BDADDR_LE_PUBLIC;
     }
 
@@ -1499,9 +2075,9 @@ static void cmd_pair(int argcp, char **argvp)
 
     if (mgmt_send(mgmt_master, MGMT_OP_PAIR_DEVICE,
             mgmt_ind, sizeof(cp), &cp,
-                pair_device_complete, NULL,
+                pair_device_complete, cur,
                 NULL) == 0) {
-        DBG("mgmt_send(MGMT_OP_PAIR_DEVICE) failed for %s for hci%u", opt_dst, mgmt_ind);
+        DBG("mgmt_send(MGMT_OP_PAIR_DEVICE) failed for %s for hci%u", cur->dst, mgmt_ind);
         resp_mgmt(err_SEND_FAIL);
         return;
     }
@@ -1510,6 +2086,8 @@ static void cmd_pair(int argcp, char **argvp)
 static void unpair_device_complete(uint8_t status, uint16_t length,
                     const void *param, void *user_data)
 {
+    cur = user_data;
+
     if (status != MGMT_STATUS_SUCCESS) {
         DBG("status returned error : %s (0x%02x)",
                 mgmt_errstr(status), status);
@@ -1531,13 +2109,13 @@ static void cmd_unpair(int argcp, char **argvp)
         return;
     }
 
-    if (str2ba(opt_dst, &bdaddr)) {
+    if (str2ba(cur->dst, &bdaddr)) {
         DBG("str2ba failed");
         resp_mgmt(err_NOT_FOUND);
         return;
     }
 
-    if (!memcmp(opt_dst_type, "public", 6)) {
+    if (!memcmp(cur->dst_type, "public", 6)) {
         addr_type = BDADDR_LE_PUBLIC;
     }
 
@@ -1548,9 +2126,9 @@ static void cmd_unpair(int argcp, char **argvp)
 
     if (mgmt_send(mgmt_master, MGMT_OP_UNPAIR_DEVICE,
             mgmt_ind, sizeof(cp), &cp,
-            unpair_device_complete, NULL,
+            unpair_device_complete, cur,
                 NULL) == 0) {
-        DBG("mgmt_send(MGMT_OP_UNPAIR_DEVICE) failed for %s for hci%u", opt_dst, mgmt_ind);
+        DBG("mgmt_send(MGMT_OP_UNPAIR_DEVICE) failed for %s for hci%u", cur->dst, mgmt_ind);
         resp_mgmt(err_SEND_FAIL);
         return;
     }
@@ -1558,6 +2136,8 @@ static void cmd_unpair(int argcp, char **argvp)
 
 static void scan_cb(uint8_t status, uint16_t length, const void *param, void *user_data)
 {
+    cur = user_data;
+
     if (status != MGMT_STATUS_SUCCESS) {
         DBG("Scan error: %s (0x%02x)", mgmt_errstr(status), status);
         if (status==MGMT_STATUS_BUSY)
@@ -1571,6 +2151,207 @@ static void scan_cb(uint8_t status, uint16_t length, const void *param, void *us
 }
 
 // Unlike Bluez, we follow BT 4.0 spec which renammed Device Discovery by Scan
+/*
+ * Advert filter, set by 'filt'. Scan reports failing it are dropped
+ * here rather than sent. Each test is skipped when unset; service UUIDs
+ * (kept as little-endian 128-bit values, as they appear in adverts)
+ * match the AD service lists and service data. Devices passed on their
+ * UUIDs are remembered so their scan responses get through too, as are
+ * devices seen advertising connectably when only those are wanted: HCI
+ * scan responses don't say, and go with the device's adverts.
+ */
+#define FILT_SEEN 64
+
+static struct {
+    gboolean have_rssi;
+    int min_rssi;
+    gboolean connectable;
+    bdaddr_t *addrs;
+    int n_addrs;
+    uint8_t (*uuids)[16];
+    int n_uuids;
+    bdaddr_t seen[FILT_SEEN];
+    int n_seen;
+    bdaddr_t conn[FILT_SEEN];
+    int n_conn;
+} filt;
+
+static const uint8_t base_uuid_le[16] = {
+    0xFB, 0x34, 0x9B, 0x5F, 0x80, 0x00, 0x00, 0x80,
+    0x00, 0x10, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00 };
+
+static gboolean filt_uuid_match(const uint8_t *val, int width)
+{
+    uint8_t u[16];
+    int i;
+
+    if (width == 16) {
+        memcpy(u, val, 16);
+    } else {
+        memcpy(u, base_uuid_le, 16);
+        memcpy(u + 12, val, width);
+    }
+    for (i = 0; i < filt.n_uuids; i++)
+        if (!memcmp(u, filt.uuids[i], 16))
+            return TRUE;
+    return FALSE;
+}
+
+static gboolean filt_ad_match(const uint8_t *data, int len)
+{
+    int pos = 0;
+
+    while (pos + 2 <= len) {
+        int sdlen = data[pos];
+        const uint8_t *val = data + pos + 2;
+        int vlen = MIN(sdlen - 1, len - pos - 2);
+        int width = 0, i;
+
+        switch (data[pos + 1]) {
+        case 0x02: case 0x03: width = 2; break;
+        case 0x04: case 0x05: width = 4; break;
+        case 0x06: case 0x07: width = 16; break;
+        case 0x16:
+            if (vlen >= 2 && filt_uuid_match(val, 2)) return TRUE;
+            break;
+        case 0x20:
+            if (vlen >= 4 && filt_uuid_match(val, 4)) return TRUE;
+            break;
+        case 0x21:
+            if (vlen >= 16 && filt_uuid_match(val, 16)) return TRUE;
+            break;
+        }
+        for (i = 0; width && i + width <= vlen; i += width)
+            if (filt_uuid_match(val + i, width))
+                return TRUE;
+        pos += sdlen + 1;
+    }
+    return FALSE;
+}
+
+static gboolean filt_pass(const bdaddr_t *addr, int rssi, gboolean connectable,
+                          const uint8_t *data, int len)
+{
+    int i;
+
+    if (filt.have_rssi && rssi < filt.min_rssi)
+        return FALSE;
+    if (filt.connectable && !connectable)
+        return FALSE;
+    if (filt.n_addrs) {
+        for (i = 0; i < filt.n_addrs; i++)
+            if (!bacmp(addr, &filt.addrs[i]))
+                break;
+        if (i == filt.n_addrs)
+            return FALSE;
+    }
+    if (filt.n_uuids) {
+        for (i = 0; i < filt.n_seen && i < FILT_SEEN; i++)
+            if (!bacmp(addr, &filt.seen[i]))
+                return TRUE;
+        if (!filt_ad_match(data, len))
+            return FALSE;
+        bacpy(&filt.seen[filt.n_seen++ % FILT_SEEN], addr);
+    }
+    return TRUE;
+}
+
+/* HCI advertising report event types */
+#define ADV_IND         0x00
+#define ADV_DIRECT_IND  0x01
+#define SCAN_RSP        0x04
+
+static gboolean filt_hci_connectable(const bdaddr_t *addr, uint8_t evt_type)
+{
+    int i, n = MIN(filt.n_conn, FILT_SEEN);
+
+    for (i = 0; i < n; i++)
+        if (!bacmp(addr, &filt.conn[i]))
+            break;
+    if (evt_type == SCAN_RSP)
+        return i < n;
+    if (evt_type == ADV_IND || evt_type == ADV_DIRECT_IND) {
+        if (i == n)
+            bacpy(&filt.conn[filt.n_conn++ % FILT_SEEN], addr);
+        return TRUE;
+    }
+    if (i < n)
+        bacpy(&filt.conn[i], BDADDR_ANY);
+    return FALSE;
+}
+
+static void filt_clear(void)
+{
+    g_free(filt.addrs);
+    g_free(filt.uuids);
+    memset(&filt, 0, sizeof(filt));
+}
+
+static int filt_parse_uuid(const char *s, uint8_t *le)
+{
+    int i;
+
+    if (strlen(s) != 32)
+        return -1;
+    for (i = 0; i < 16; i++) {
+        unsigned int b;
+        if (sscanf(s + 2 * i, "%2x", &b) != 1)
+            return -1;
+        le[15 - i] = b;
+    }
+    return 0;
+}
+
+static void cmd_filter(int argcp, char **argvp)
+{
+    int i, j;
+
+    filt_clear();
+    for (i = 1; i < argcp; i++) {
+        char *val = strchr(argvp[i], '=');
+        gchar **items;
+        int n;
+
+        if (!val)
+            goto badparam;
+        *val++ = '\0';
+        if (!strcmp(argvp[i], "rssi")) {
+            filt.have_rssi = TRUE;
+            filt.min_rssi = atoi(val);
+            continue;
+        }
+        if (!strcmp(argvp[i], "conn")) {
+            filt.connectable = (atoi(val) != 0);
+            continue;
+        }
+
+        items = g_strsplit(val, ",", -1);
+        n = g_strv_length(items);
+        if (!strcmp(argvp[i], "addr")) {
+            filt.addrs = g_new0(bdaddr_t, n);
+            for (j = 0; j < n; j++)
+                if (str2ba(items[j], &filt.addrs[filt.n_addrs++]))
+                    break;
+        } else if (!strcmp(argvp[i], "uuid")) {
+            filt.uuids = g_malloc0(n * sizeof(*filt.uuids));
+            for (j = 0; j < n; j++)
+                if (filt_parse_uuid(items[j], filt.uuids[filt.n_uuids++]))
+                    break;
+        } else {
+            j = -1;
+        }
+        g_strfreev(items);
+        if (j != n)
+            goto badparam;
+    }
+    resp_mgmt(err_SUCCESS);
+    return;
+
+badparam:
+    filt_clear();
+    resp_mgmt(err_BAD_PARAM);
+}
+
 static void scan(bool start)
 {
     // mgmt_cp_start_discovery and mgmt_cp_stop_discovery are the same
@@ -1582,10 +2363,15 @@ static void scan(bool start)
         return;
     }
 
+    if (cur->id) {
+        resp_mgmt(err_BAD_PARAM);
+        return;
+    }
+
     DBG("Scan %s", start? "start" : "stop");
 
     if (mgmt_send(mgmt_master, opcode, mgmt_ind, sizeof(cp),
-        &cp, scan_cb, NULL, NULL) == 0)
+        &cp, scan_cb, cur, NULL) == 0)
     {
         DBG("mgmt_send(MGMT_OP_%s_DISCOVERY) failed", start? "START" : "STOP");
         resp_mgmt(err_SEND_FAIL);
@@ -1622,6 +2408,7 @@ static gboolean hci_monitor_cb(GIOChannel *chan, GIOCondition cond, gpointer use
     GError *err= NULL;
     int r;
 
+    cur = &conns[0];
     if ((r= g_io_channel_read_chars(chan, (gchar *) buf, 1, &len, &err)) != G_IO_STATUS_NORMAL) {
         if (err) DBG("reading pkt type reports state %d: %s", r, err->message);
         //andy: stop passive scan
@@ -1647,7 +2434,7 @@ static gboolean hci_monitor_cb(GIOChannel *chan, GIOCondition cond, gpointer use
                     if (lescan->enable) {
                         DBG("Start of passive scan.");
                     } else {
-                        if (conn_state == STATE_SCANNING) {
+                        if (cur->state == STATE_SCANNING) {
                             set_state(STATE_DISCONNECTED);
                         }
                         DBG("End of passive scan - removing watch.");
@@ -1704,7 +2491,11 @@ static gboolean hci_monitor_cb(GIOChannel *chan, GIOCondition cond, gpointer use
                                     DBG("buf: %02x", ev->data[i]);
                             }
 
-                            if (conn_state == STATE_SCANNING) {
+                            if (cur->state == STATE_SCANNING &&
+                                filt_pass(&ev->bdaddr, (int8_t) rssi,
+                                          !filt.connectable ||
+                                              filt_hci_connectable(&ev->bdaddr, ev->evt_type),
+                                          ev->data, ev->length)) {
                                 resp_begin(rsp_SCAN);
                                 send_addr(&addr);
                                 send_uint(tag_RSSI, 256-rssi);
@@ -1740,20 +2531,89 @@ static gboolean hci_monitor_cb(GIOChannel *chan, GIOCondition cond, gpointer use
 
 
 // perform a passive scan, i.e. report ADV_IND packets but do not request SCN_RSP packets
+/* Parameters for scans run directly on HCI ('pasv'), set by 'scanp' */
+static struct {
+    uint8_t scan_type;      /* 0x00 passive, 0x01 active */
+    uint16_t interval;      /* 0.625ms units */
+    uint16_t window;
+    uint8_t filter_dup;
+    uint8_t own_type;
+} scan_params = { 0x00, 0x0010, 0x0010, 0x00, LE_PUBLIC_ADDRESS };
+
+static void cmd_scan_params(int argcp, char **argvp)
+{
+    uint8_t scan_type = 0x00, filter_dup = 0x00, own_type = LE_PUBLIC_ADDRESS;
+    long interval = 0x0010, window = 0x0010;
+    int i;
+
+    for (i = 1; i < argcp; i++) {
+        char *val = strchr(argvp[i], '=');
+        char *end;
+        long n;
+
+        if (!val)
+            goto badparam;
+        *val++ = '\0';
+        n = strtol(val, &end, 0);
+        if (*end) {
+            if (!strcmp(argvp[i], "own") && !strcmp(val, "random"))
+                n = LE_RANDOM_ADDRESS;
+            else if (!strcmp(argvp[i], "own") && !strcmp(val, "public"))
+                n = LE_PUBLIC_ADDRESS;
+            else
+                goto badparam;
+        }
+
+        if (!strcmp(argvp[i], "active"))
+            scan_type = n ? 0x01 : 0x00;
+        else if (!strcmp(argvp[i], "interval"))
+            interval = n;
+        else if (!strcmp(argvp[i], "window"))
+            window = n;
+        else if (!strcmp(argvp[i], "dup"))
+            filter_dup = n ? 0x01 : 0x00;
+        else if (!strcmp(argvp[i], "own"))
+            own_type = n;
+        else
+            goto badparam;
+    }
+
+    /* Ranges from Core spec Vol 2 Part E 7.8.10 */
+    if (interval < 0x0004 || interval > 0x4000 ||
+        window < 0x0004 || window > interval)
+        goto badparam;
+
+    scan_params.scan_type = scan_type;
+    scan_params.interval = interval;
+    scan_params.window = window;
+    scan_params.filter_dup = filter_dup;
+    scan_params.own_type = own_type;
+    resp_mgmt(err_SUCCESS);
+    return;
+
+badparam:
+    resp_mgmt(err_BAD_PARAM);
+}
+
 static void discover(bool start)
 {
     int err;
-    uint8_t own_type = LE_PUBLIC_ADDRESS;
-    uint8_t scan_type = 0x00;  // passive
+    uint8_t own_type = scan_params.own_type;
+    uint8_t scan_type = scan_params.scan_type;
     uint8_t filter_policy = 0x00;
-    uint16_t interval = htobs(0x0010);
-    uint16_t window = htobs(0x0010);
-    uint8_t filter_dup = 0x00;  // do not filter duplicates
+    uint16_t interval = htobs(scan_params.interval);
+    uint16_t window = htobs(scan_params.window);
+    uint8_t filter_dup = scan_params.filter_dup;
 
     struct hci_filter nf, of;
     //struct sigaction sa;
     socklen_t olen;
 
+    if (cur->id) {
+        resp_mgmt(err_BAD_PARAM);
+        return;
+    }
+
     hci_dd = hci_open_dev(mgmt_ind);
     DBG("hcidev handle is 0x%x, mgmt_ind is %d", hci_dd, mgmt_ind);
     if (start) {
@@ -1822,6 +2682,23 @@ static void discover(bool start)
     }
 }
 
+static void cmd_binary(int argcp, char **argvp)
+{
+    if (argcp < 2 || !strcmp(argvp[1], "on"))
+        opt_binary = TRUE;
+    else if (!strcmp(argvp[1], "off"))
+        opt_binary = FALSE;
+    else {
+        resp_error(err_BAD_PARAM);
+        return;
+    }
+
+    /* Acknowledged in the newly selected format */
+    resp_begin(rsp_BINARY);
+    send_sym(tag_ERRCODE, err_SUCCESS);
+    resp_end();
+}
+
 static void cmd_pasvend(int argcp, char **argvp)
 {
     if (1 < argcp) {
@@ -1864,14 +2741,20 @@ static struct {
         "Characteristics Discovery" },
     { "desc",       cmd_char_desc,  "[start hnd] [end hnd]",
         "Characteristics Descriptor Discovery" },
+    { "dump",       cmd_discover_all,   "",
+        "Services, characteristics and descriptors in one response" },
     { "rd",         cmd_read_hnd,   "<handle>",
         "Characteristics Value/Descriptor Read by handle" },
+    { "rdl",        cmd_read_long,  "<handle> [offset]",
+        "Characteristics Value/Descriptor Read by handle, from offset, however long" },
     { "rdu",        cmd_read_uuid,  "<UUID> [start hnd] [end hnd]",
         "Characteristics Value/Descriptor Read by UUID" },
     { "wrr",        cmd_char_write_rsp, "<handle> [<new value>]",
         "Characteristic Value Write (Write Request)" },
     { "wr",         cmd_char_write, "<handle> [<new value>]",
         "Characteristic Value Write (No response)" },
+    { "wrs",        cmd_char_write_stream, "<handle> [<new value>]",
+        "Characteristic Value Write (No response), answered once sent" },
     { "secu",       cmd_sec_level,  "[low | medium | high]",
         "Set security level. Default: low" },
     { "mtu",        cmd_mtu,    "<value>",
@@ -1894,8 +2777,14 @@ static struct {
         "Force scan end" },
     { "pasv",       cmd_pasv,  "",
         "Start passive scan" },
+    { "scanp",      cmd_scan_params,  "[active=1] [interval=<n>] [window=<n>] [dup=1] [own=public|random]",
+        "Set parameters for 'pasv' scans; no arguments restores defaults" },
     { "pasvend",    cmd_pasvend,  "",
         "Force passive scan end" },
+    { "bin",        cmd_binary,  "[on | off]",
+        "Use binary framed responses" },
+    { "filt",       cmd_filter,  "[rssi=<dBm>] [conn=1] [addr=<address>,...] [uuid=<UUID>,...]",
+        "Only report adverts that match; no arguments clears" },
     { NULL, NULL, NULL}
 };
 
@@ -1911,7 +2800,7 @@ static void cmd_help(int argcp, char **argvp)
 
 static void parse_line(char *line_read)
 {
-    gchar **argvp;
+    gchar **argvp, **args;
     int argcp;
     int i;
 
@@ -1920,20 +2809,40 @@ static void parse_line(char *line_read)
     if (*line_read == '\0')
         goto done;
 
+    cur = &conns[0];
     if (!g_shell_parse_argv(line_read, &argcp, &argvp, NULL)) {
         resp_error(err_BAD_CMD);
         goto done;
     }
 
+    /* "@<slot> <command> ..." */
+    args = argvp;
+    if (args[0][0] == '@') {
+        char *e;
+        long id;
+
+        errno = 0;
+        id = strtol(args[0] + 1, &e, 10);
+        if (errno != 0 || *e != '\0' || e == args[0] + 1 ||
+                id < 0 || id >= MAX_CONNS || argcp < 2) {
+            resp_error(err_BAD_PARAM);
+            goto freeargs;
+        }
+        cur = &conns[id];
+        args++;
+        argcp--;
+    }
+
     for (i = 0; commands[i].cmd; i++)
-        if (strcasecmp(commands[i].cmd, argvp[0]) == 0)
+        if (strcasecmp(commands[i].cmd, args[0]) == 0)
             break;
 
     if (commands[i].cmd)
-        commands[i].func(argcp, argvp);
+        commands[i].func(argcp, args);
     else
         resp_error(err_BAD_CMD);
 
+freeargs:
     g_strfreev(argvp);
 
 done:
@@ -1999,6 +2908,7 @@ static void mgmt_scanning(uint16_t index, uint16_t length,
 
     DBG("Scanning (0x%x): %s", ev->type, ev->discovering? "started" : "ended");
 
+    cur = &conns[0];
     set_state(ev->discovering? STATE_SCANNING : STATE_DISCONNECTED);
 }
 
@@ -2010,8 +2920,13 @@ static void mgmt_device_found(uint16_t index, uint16_t length,
     assert(length == sizeof(*ev) + ev->eir_len);
     // DBG("Device found: %02X:%02X:%02X:%02X:%02X:%02X type=%X flags=%X", val[5], val[4], val[3], val[2], val[1], val[0], ev->addr.type, ev->flags);
 
+    cur = &conns[0];
     // Result sometimes sent too early
-    if (conn_state != STATE_SCANNING)
+    if (cur->state != STATE_SCANNING)
+        return;
+    if (!filt_pass(&ev->addr.bdaddr, ev->rssi,
+                   !(ev->flags & MGMT_DEV_FOUND_NOT_CONNECTABLE),
+                   ev->eir, ev->eir_len))
         return;
     //confirm_name(&ev->addr, 1);
 
@@ -2065,12 +2980,13 @@ int main(int argc, char *argv[])
 {
     GIOChannel *pchan;
     gint events;
+    int i;
 
-    opt_sec_level = g_strdup("low");
-
-    opt_src = NULL;
-    opt_dst = NULL;
-    opt_dst_type = g_strdup("public");
+    for (i = 0; i < MAX_CONNS; i++) {
+        conns[i].id = i;
+        conns[i].sec_level = g_strdup("low");
+        conns[i].dst_type = g_strdup("public");
+    }
 
     printf("# " __FILE__ " version " VERSION_STRING " built at " __TIME__ " on " __DATE__ "\n");
 
@@ -2099,14 +3015,20 @@ int main(int argc, char *argv[])
     g_main_loop_run(event_loop);
 
     DBG("Exiting loop");
-    cmd_disconnect(0, NULL);
+    for (i = 0; i < MAX_CONNS; i++) {
+        cur = &conns[i];
+        cmd_disconnect(0, NULL);
+    }
     fflush(stdout);
     g_io_channel_unref(pchan);
     g_main_loop_unref(event_loop);
 
-    g_free(opt_src);
-    g_free(opt_dst);
-    g_free(opt_sec_level);
+    for (i = 0; i < MAX_CONNS; i++) {
+        g_free(conns[i].src);
+        g_free(conns[i].dst);
+        g_free(conns[i].dst_type);
+        g_free(conns[i].sec_level);
+    }
 
     mgmt_unregister_index(mgmt_master, mgmt_ind);
     mgmt_cancel_index(mgmt_master, mgmt_ind);
@@ -11,6 +11,26 @@ import binascii
 import select
 import struct
 import signal
+import threading
+import collections
+import bisect
+import array
+import itertools
+import random
+import contextlib
+import warnings
+import json
+import hashlib
+
+try:
+    from sys import intern
+except ImportError:
+    pass  # builtin in Python 2
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 def preexec_function():
     # Ignore the SIGINT signal by setting the handler to the standard
@@ -19,7 +39,33 @@ def preexec_function():
 
 Debugging = False
 script_path = os.path.join(os.path.abspath(os.path.dirname(__file__)))
-helperExe = os.path.join(script_path, "bluepy-helper")
+# BLUEPY_HELPER in the environment runs another helper instead; "sim"
+# selects the simulated one (see simhelper.py)
+simHelperExe = os.path.join(script_path, "simhelper.py")
+helperExe = os.environ.get("BLUEPY_HELPER") or os.path.join(script_path, "bluepy-helper")
+if helperExe == "sim":
+    helperExe = simHelperExe
+
+def _helperArgs(iface=None):
+    # A helper written in Python runs under this interpreter
+    args = [sys.executable, helperExe] if helperExe.endswith(".py") else [helperExe]
+    if iface is not None:
+        args.append(str(iface))
+    return args
+
+# Features found missing from bluepy-helper, each warned about once
+_helperLacking = set()
+
+def _helperLacks(what, fallback):
+    DBG("bluepy-helper has no", what)
+    if what not in _helperLacking:
+        _helperLacking.add(what)
+        warnings.warn("bluepy-helper is out of date, rebuild it: it has no %s, so %s"
+                      % (what, fallback), RuntimeWarning)
+
+# Ask bluepy-helper for binary framed responses (see "bin" command);
+# falls back to the text protocol if the helper doesn't support it
+BinaryFraming = False
 
 SEC_LEVEL_LOW = "low"
 SEC_LEVEL_MEDIUM = "medium"
@@ -28,11 +74,69 @@ SEC_LEVEL_HIGH = "high"
 ADDR_TYPE_PUBLIC = "public"
 ADDR_TYPE_RANDOM = "random"
 
+# ATT MTUs: the LE default, and the most a 512-byte value needs
+ATT_DEFAULT_MTU = 23
+ATT_MAX_MTU = 517
+
+OVERFLOW_DROP_OLDEST = "oldest"
+OVERFLOW_DROP_NEWEST = "newest"
+
 def DBG(*args):
     if Debugging:
         msg = " ".join([str(a) for a in args])
         print(msg)
 
+# Binary frame layout, must match bluepy-helper.c:
+#   header: magic, response type, payload length
+#   item:   tag, value type, value length, value
+FRAME_MAGIC = 0xBE
+_frameHeader = struct.Struct('<BBH')
+_frameItem = struct.Struct('<BBH')
+_frameUint = struct.Struct('<I')
+_frameMagic = struct.pack('<B', FRAME_MAGIC)
+
+# Indexed by the codes in frame_rsps[] and frame_tags[]
+_frameRsps = ('err', 'stat', 'ntfy', 'ind', 'find', 'desc', 'rd', 'wr',
+              'mgmt', 'scan', 'oob', 'bin', 'sent', 'gatt')
+_frameTags = ('rsp', 'code', 'estat', 'emsg', 'hnd', 'uuid', 'd', 'state',
+              'sec', 'mtu', 'dst', 'hstart', 'hend', 'props', 'vhnd',
+              'addr', 'type', 'rssi', 'flag', 'cid')
+
+_VT_SYM = ord('$')
+_VT_STR = ord("'")
+_VT_UINT = ord('h')
+_VT_DATA = ord('b')
+_COMMENT = ord('#')
+
+# Scan reports as bluepy-helper sends them: addr, type, rssi, flag[, d]
+_scanLinePrefix = b'rsp=$scan\x1e'
+_scanFrameCode = _frameRsps.index('scan')
+_scanFrame = struct.Struct('<4s6s4sI4sI4sI')
+_scanFrameHdrs = (_frameItem.pack(_frameTags.index('addr'), _VT_DATA, 6),
+                  _frameItem.pack(_frameTags.index('type'), _VT_UINT, 4),
+                  _frameItem.pack(_frameTags.index('rssi'), _VT_UINT, 4),
+                  _frameItem.pack(_frameTags.index('flag'), _VT_UINT, 4))
+_scanFrameData = _frameTags.index('d')
+
+
+# Messages that arrive on their own rather than answering a command
+_untimedRsps = ('ntfy', 'ind', 'scan', 'sent')
+
+# Requests a supervised Peripheral sends again after restoring a session.
+# Others (writes) may have reached the device before the helper failed.
+_replayableCmds = ('stat', 'svcs', 'incl', 'char', 'desc', 'dump', 'rd',
+                   'rdl', 'rdu', 'mtu')
+
+# What bluepy-helper answers each command with, if not an 'err', so the
+# reader thread can tell answers from messages sent on their own. Any
+# response answers a command not listed.
+_cmdRsps = { 'stat' : 'stat', 'conn' : 'stat', 'disc' : 'stat', 'secu' : 'stat',
+             'mtu' : 'stat', 'svcs' : 'find', 'incl' : 'find', 'char' : 'find',
+             'desc' : 'desc', 'dump' : 'gatt', 'rd' : 'rd', 'rdl' : 'rd', 'rdu' : 'rd',
+             'wr' : 'wr', 'wrr' : 'wr', 'bin' : 'bin', 'local_oob' : 'oob',
+             'le' : 'mgmt', 'pairable' : 'mgmt', 'pair' : 'mgmt', 'unpair' : 'mgmt',
+             'scan' : 'mgmt', 'scanend' : 'mgmt', 'pasv' : 'mgmt', 'pasvend' : 'mgmt',
+             'scanp' : 'mgmt', 'filt' : 'mgmt' }
 
 class BTLEException(Exception):
     """Base class for all Bluepy exceptions"""
@@ -83,68 +187,161 @@ class BTLEGattError(BTLEException):
 
 
 
-class UUID:
-    def __init__(self, val, commonName=None):
+_uuidTail = binascii.a2b_hex("00001000800000805F9B34FB")
+_uuidCache = {}
+
+def _internUUID(key, uuid):
+    # Bounded like the other caches: cleared when full
+    if len(_uuidCache) >= 4096:
+        _uuidCache.clear()
+    _uuidCache[key] = uuid
+
+class UUID(object):
+    # UUID(x) returns one shared instance for each value, whichever of
+    # its int, str or bytes forms x is, so repeated lookups and
+    # comparisons allocate nothing. Instances made with a commonName
+    # (the assigned numbers table) are kept separate.
+    __slots__ = ('binVal', 'commonName', '_short', '_hash', '_str', '_name')
+
+    def __new__(cls, val, commonName=None):
         '''We accept: 32-digit hex strings, with and without '-' characters,
-           4 to 8 digit hex strings, and integers'''
-        if isinstance(val, int):
-            if (val < 0) or (val > 0xFFFFFFFF):
-                raise ValueError(
-                    "Short form UUIDs must be in range 0..0xFFFFFFFF")
-            val = "%04X" % val
-        elif isinstance(val, self.__class__):
-            val = str(val)
+           4 to 8 digit hex strings, integers and 16-byte binary values'''
+        key = None
+        if commonName is None and isinstance(val, (str, int, UUID)):
+            # Other types may not be hashable; they take the long way
+            uuid = _uuidCache.get(val)
+            if uuid is not None:
+                return uuid
+            key = val
+
+        if isinstance(val, UUID):
+            binVal = val.binVal
+        elif isinstance(val, bytes) and len(val) == 16:
+            binVal = val
         else:
-            val = str(val)  # Do our best
+            if isinstance(val, int):
+                if (val < 0) or (val > 0xFFFFFFFF):
+                    raise ValueError(
+                        "Short form UUIDs must be in range 0..0xFFFFFFFF")
+                val = "%04X" % val
+            else:
+                val = str(val)  # Do our best
 
-        val = val.replace("-", "")
-        if len(val) <= 8:  # Short form
-            val = ("0" * (8 - len(val))) + val + "00001000800000805F9B34FB"
+            val = val.replace("-", "")
+            if len(val) <= 8:  # Short form
+                val = ("0" * (8 - len(val))) + val + "00001000800000805F9B34FB"
 
-        self.binVal = binascii.a2b_hex(val.encode('utf-8'))
-        if len(self.binVal) != 16:
-            raise ValueError(
-                "UUID must be 16 bytes, got '%s' (len=%d)" % (val,
-                                                              len(self.binVal)))
+            binVal = binascii.a2b_hex(val.encode('utf-8'))
+            if len(binVal) != 16:
+                raise ValueError(
+                    "UUID must be 16 bytes, got '%s' (len=%d)" % (val,
+                                                                  len(binVal)))
+
+        if commonName is None:
+            uuid = _uuidCache.get(binVal)
+            if uuid is None:
+                uuid = cls._make(binVal, None)
+                _internUUID(binVal, uuid)
+            if key is not None:
+                _internUUID(key, uuid)
+            return uuid
+        return cls._make(binVal, commonName)
+
+    @classmethod
+    def _make(cls, binVal, commonName):
+        self = object.__new__(cls)
+        self.binVal = binVal
         self.commonName = commonName
+        self._hash = hash(binVal)
+        # Value of a short form UUID, for comparing with ints
+        if binVal[4:] == _uuidTail:
+            self._short = struct.unpack('>I', binVal[:4])[0]
+        else:
+            self._short = None
+        self._str = None
+        self._name = None
+        return self
+
+    def __reduce__(self):
+        return (UUID, (self.binVal, self.commonName))
 
     def __str__(self):
-        s = binascii.b2a_hex(self.binVal).decode('utf-8')
-        return "-".join([s[0:8], s[8:12], s[12:16], s[16:20], s[20:32]])
+        if self._str is None:
+            s = binascii.b2a_hex(self.binVal).decode('utf-8')
+            self._str = "-".join([s[0:8], s[8:12], s[12:16], s[16:20], s[20:32]])
+        return self._str
 
     def __eq__(self, other):
+        if other is self:
+            return True
+        if isinstance(other, UUID):
+            return self.binVal == other.binVal
+        if isinstance(other, int):
+            return self._short == other
         return self.binVal == UUID(other).binVal
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def __cmp__(self, other):
         return cmp(self.binVal, UUID(other).binVal)
 
     def __hash__(self):
-        return hash(self.binVal)
+        return self._hash
 
     def getCommonName(self):
-        s = AssignedNumbers.getCommonName(self)
-        if s:
-            return s
-        s = str(self)
-        if s.endswith("-0000-1000-8000-00805f9b34fb"):
-            s = s[0:8]
-            if s.startswith("0000"):
-                s = s[4:]
-        return s
-
-class Service:
+        if self._name is None:
+            s = AssignedNumbers.getCommonName(self)
+            if not s:
+                s = str(self)
+                if s.endswith("-0000-1000-8000-00805f9b34fb"):
+                    s = s[0:8]
+                    if s.startswith("0000"):
+                        s = s[4:]
+            self._name = s
+        return self._name
+
+GATT_SERVICE_UUID = UUID(0x1801)
+SERVICE_CHANGED_UUID = UUID(0x2A05)
+DATABASE_HASH_UUID = UUID(0x2B2A)
+CCCD_UUID = UUID(0x2902)
+
+def _linkCharacteristics(chars, endHnd):
+    # Each of an unfiltered, handle-ordered list of characteristics ends
+    # just before the next is declared; the last ends at endHnd
+    for i in range(len(chars) - 1):
+        chars[i].hndEnd = chars[i+1].handle - 1
+    if chars:
+        chars[-1].hndEnd = endHnd
+
+def _uuidIndex(objs, index):
+    # (objs, len(objs), {UUID: [obj, ...]}), reusing index if it was made
+    # from objs as they are now; callers may assign or extend lists
+    if index is not None and index[0] is objs and index[1] == len(objs):
+        return index
+    byUUID = {}
+    for obj in objs:
+        byUUID.setdefault(obj.uuid, []).append(obj)
+    return (objs, len(objs), byUUID)
+
+class Service(object):
+    __slots__ = ('peripheral', 'uuid', 'hndStart', 'hndEnd', 'chars', 'descs',
+                 '_charIndex', '_descIndex')
+
     def __init__(self, *args):
         (self.peripheral, uuidVal, self.hndStart, self.hndEnd) = args
         self.uuid = UUID(uuidVal)
         self.chars = None
         self.descs = None
+        self._charIndex = None
+        self._descIndex = None
 
     def getCharacteristics(self, forUUID=None):
         if not self.chars: # Unset, or empty
             self.chars = [] if self.hndEnd <= self.hndStart else self.peripheral.getCharacteristics(self.hndStart, self.hndEnd)
         if forUUID is not None:
-            u = UUID(forUUID)
-            return [ch for ch in self.chars if ch.uuid==u]
+            self._charIndex = _uuidIndex(self.chars, self._charIndex)
+            return list(self._charIndex[2].get(UUID(forUUID), ()))
         return self.chars
 
     def getDescriptors(self, forUUID=None):
@@ -156,8 +353,8 @@ class Service:
             # Note that this does not filter out characteristic value descriptors
             self.descs = [desc for desc in all_descs if desc.uuid != 0x2803]
         if forUUID is not None:
-            u = UUID(forUUID)
-            return [desc for desc in self.descs if desc.uuid == u]
+            self._descIndex = _uuidIndex(self.descs, self._descIndex)
+            return list(self._descIndex[2].get(UUID(forUUID), ()))
         return self.descs
 
     def __str__(self):
@@ -165,7 +362,10 @@ class Service:
                                                                  self.hndStart,
                                                                  self.hndEnd)
 
-class Characteristic:
+class Characteristic(object):
+    __slots__ = ('peripheral', 'uuid', 'handle', 'properties', 'valHandle',
+                 'hndEnd', 'descs', '_descIndex')
+
     # Currently only READ is used in supportsRead function,
     # the rest is included to facilitate supportsXXXX functions if required
     props = {"BROADCAST":    0b00000001,
@@ -191,30 +391,94 @@ class Characteristic:
     def __init__(self, *args):
         (self.peripheral, uuidVal, self.handle, self.properties, self.valHandle) = args
         self.uuid = UUID(uuidVal)
+        self.hndEnd = None # Last handle of ours, see getEndHandle()
         self.descs = None
+        self._descIndex = None
 
-    def read(self):
-        return self.peripheral.readCharacteristic(self.valHandle)
+    def read(self, max_age=None):
+        # With max_age (seconds), a value the Peripheral's value cache
+        # got no longer ago than that will do; see withValueCache()
+        if max_age is None:
+            return self.peripheral.readCharacteristic(self.valHandle)
+        return self.peripheral.readCharacteristic(self.valHandle, max_age)
+
+    def readLong(self, offset=0):
+        return self.peripheral.readLong(self.valHandle, offset)
 
     def write(self, val, withResponse=False):
         return self.peripheral.writeCharacteristic(self.valHandle, val, withResponse)
 
-    def getDescriptors(self, forUUID=None, hndEnd=0xFFFF):
+    def writeStream(self, chunks, window=16):
+        return self.peripheral.writeStream(self.valHandle, chunks, window)
+
+    def subscribe(self, callback=None, batch=1, max_latency=None,
+                  max_queue=1024, overflow=OVERFLOW_DROP_OLDEST):
+        # Enables notifications (or indications) through the CCCD and
+        # returns a Subscription. Values arrive as (timestamp, data)
+        # pairs; callback(items) gets them in lists of up to batch, or
+        # sooner once the oldest has waited max_latency seconds. Without
+        # a callback, collect them with Subscription.get().
+        cccd = self.getDescriptors(forUUID=CCCD_UUID)
+        if not cccd:
+            raise BTLEGattError("Characteristic %s has no CCCD" % self.uuid)
+        if batch < 1 or max_queue < batch:
+            raise ValueError("Need 1 <= batch <= max_queue")
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("Unknown overflow policy %s" % repr(overflow))
+        if self.properties & Characteristic.props["NOTIFY"]:
+            enable = b"\x01\x00"
+        elif self.properties & Characteristic.props["INDICATE"]:
+            enable = b"\x02\x00"
+        else:
+            raise BTLEGattError("Characteristic %s cannot notify" % self.uuid)
+        sub = Subscription(self, cccd[0].handle, callback, batch,
+                           max_latency, max_queue, overflow)
+        # Registered first: the first value may follow the write response
+        subs = self.peripheral._subscriptions
+        subs[self.valHandle] = sub
+        try:
+            self.peripheral.writeCharacteristic(sub.cccdHandle, enable, True)
+        except:
+            subs.pop(self.valHandle, None)
+            raise
+        self.peripheral._cccdWritten(sub.cccdHandle, enable)
+        return sub
+
+    def unsubscribe(self):
+        sub = self.peripheral._subscriptions.pop(self.valHandle, None)
+        if sub is None:
+            return
+        self.peripheral._cccdWritten(sub.cccdHandle, b"\x00\x00")
+        self.peripheral.writeCharacteristic(sub.cccdHandle, b"\x00\x00", True)
+        sub._deliver(None)
+
+    def getDescriptors(self, forUUID=None, hndEnd=None):
         if not self.descs:
             # Descriptors (not counting the value descriptor) begin after
-            # the handle for the value descriptor and stop when we reach
-            # the handle for the next characteristic or service
+            # the handle for the value descriptor and stop at hndEnd, by
+            # default the last handle before the next characteristic
+            if hndEnd is None:
+                hndEnd = self.getEndHandle()
             self.descs = []
-            for desc in self.peripheral.getDescriptors(self.valHandle+1, hndEnd):
-                if desc.uuid in (0x2800, 0x2801, 0x2803):
-                    # Stop if we reach another characteristic or service
-                    break
-                self.descs.append(desc)
+            if hndEnd > self.valHandle:
+                for desc in self.peripheral.getDescriptors(self.valHandle+1, hndEnd):
+                    if desc.uuid in (0x2800, 0x2801, 0x2803):
+                        # Stop if we reach another characteristic or service
+                        break
+                    self.descs.append(desc)
         if forUUID is not None:
-            u = UUID(forUUID)
-            return [desc for desc in self.descs if desc.uuid == u]
+            self._descIndex = _uuidIndex(self.descs, self._descIndex)
+            return list(self._descIndex[2].get(UUID(forUUID), ()))
         return self.descs
 
+    def getEndHandle(self):
+        # Last handle of the declaration, value and descriptors; known
+        # from the next characteristic when listed along with it, else
+        # found through the service holding this one
+        if self.hndEnd is None:
+            self.hndEnd = self.peripheral._characteristicEnd(self)
+        return self.hndEnd
+
     def __str__(self):
         return "Characteristic <%s>" % self.uuid.getCommonName()
 
@@ -234,7 +498,9 @@ class Characteristic:
     def getHandle(self):
         return self.valHandle
 
-class Descriptor:
+class Descriptor(object):
+    __slots__ = ('peripheral', 'uuid', 'handle')
+
     def __init__(self, *args):
         (self.peripheral, uuidVal, self.handle) = args
         self.uuid = UUID(uuidVal)
@@ -248,6 +514,79 @@ class Descriptor:
 
     def write(self, val, withResponse=False):
         self.peripheral.writeCharacteristic(self.handle, val, withResponse)
+        if self.uuid == CCCD_UUID:
+            self.peripheral._cccdWritten(self.handle, val)
+
+class Subscription:
+    """Notifications from one characteristic, see Characteristic.subscribe()"""
+    def __init__(self, char, cccdHandle, callback, batch, maxLatency,
+                 maxQueue, overflow):
+        self.characteristic = char
+        self.cccdHandle = cccdHandle
+        self.callback = callback
+        self.batch = batch
+        self.maxLatency = maxLatency
+        self.maxQueue = maxQueue
+        self.overflow = overflow
+        self.received = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        # The dispatch thread adds while another thread may get()
+        self._lock = threading.Lock()
+
+    def _add(self, stamp, data):
+        with self._lock:
+            self.received += 1
+            if len(self._queue) >= self.maxQueue:
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    return
+                self._queue.popleft()
+            self._queue.append((stamp, data))
+        self._deliver(stamp)
+
+    def _deadline(self):
+        # When the oldest queued value must be delivered, or None
+        if self.callback is None or self.maxLatency is None:
+            return None
+        queue = self._queue
+        return queue[0][0] + self.maxLatency if queue else None
+
+    def _deliver(self, now):
+        # Hands full batches to the callback, and the rest once it is
+        # due (now None: all of it). True if the callback ran.
+        if self.callback is None:
+            return False
+        batches = []
+        with self._lock:
+            queue = self._queue
+            while len(queue) >= self.batch:
+                batches.append([queue.popleft() for i in range(self.batch)])
+            if queue:
+                due = self._deadline()
+                if now is None or (due is not None and now >= due):
+                    batches.append(list(queue))
+                    queue.clear()
+        for items in batches:
+            self.callback(items)
+        return len(batches) > 0
+
+    def get(self, count=None):
+        # Up to count of the queued (timestamp, data) values, oldest first
+        with self._lock:
+            queue = self._queue
+            if count is None or count >= len(queue):
+                items = list(queue)
+                queue.clear()
+            else:
+                items = [queue.popleft() for i in range(count)]
+        return items
+
+    def pending(self):
+        return len(self._queue)
+
+    def cancel(self):
+        self.characteristic.unsubscribe()
 
 class DefaultDelegate:
     def __init__(self):
@@ -259,50 +598,640 @@ class DefaultDelegate:
     def handleDiscovery(self, scanEntry, isNewDev, isNewData):
         DBG("Discovered device", scanEntry.addr)
 
+class _Reply:
+    # A request waiting for its response from the reader thread
+    def __init__(self, verb=None):
+        self.event = threading.Event()
+        self.resp = None
+        self.exc = None
+        self.verb = verb
+        self.started = False # For 'conn': its 'tryconn' has come
+
+    def answeredBy(self, resp):
+        want = _cmdRsps.get(self.verb)
+        respType = resp.get('rsp', [None])[0]
+        if want is None or respType == 'err':
+            return True
+        if self.verb == 'conn' and not self.started:
+            # A 'stat' before its 'tryconn' is about an earlier link
+            return False
+        return respType == want
+
+    def complete(self, resp=None, exc=None):
+        self.resp = resp
+        self.exc = exc
+        self.event.set()
+
+
+# Upper bounds (ms) of the command latency histogram in stats(); one
+# more bucket counts anything slower
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+class _CommandStats:
+    # Counts and latencies of one command verb
+    __slots__ = ('count', 'replies', 'errors', 'total', 'max', 'hist')
+
+    def __init__(self):
+        self.count = 0 # Lines sent
+        self.replies = 0 # Of which timed, up to their response
+        self.errors = 0
+        self.total = 0.0 # ms
+        self.max = 0.0
+        self.hist = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding that percentile (None for
+        # the overflow bucket)
+        want = self.replies * pct / 100.0
+        seen = 0
+        for (i, n) in enumerate(self.hist):
+            seen += n
+            if n and seen >= want:
+                return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+    def summary(self):
+        return { 'count' : self.count,
+                 'replies' : self.replies,
+                 'errors' : self.errors,
+                 'mean_ms' : (self.total / self.replies) if self.replies else None,
+                 'max_ms' : self.max,
+                 'p50_ms' : self.percentile(50),
+                 'p90_ms' : self.percentile(90),
+                 'p99_ms' : self.percentile(99),
+                 'hist' : list(self.hist) }
+
+class _Metrics:
+    # The counters behind BluepyHelper.stats(); a few operations per
+    # command or message, so always on
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.since = time.time()
+            self.commands = {} # _CommandStats by verb
+            self.bytesOut = 0
+            self.bytesIn = 0
+            self.notifications = 0
+            self.adverts = 0
+            self.restarts = 0
+
+    def helperStarted(self):
+        if self._started:
+            self.restarts += 1
+        self._started = True
+
+    def _command(self, verb):
+        cs = self.commands.get(verb)
+        if cs is None:
+            cs = self.commands[verb] = _CommandStats()
+        return cs
+
+    def sent(self, cmd):
+        # Counts each line of cmd by its verb, skipping any slot prefix;
+        # returns the last verb
+        verb = None
+        with self._lock:
+            for line in cmd.splitlines():
+                words = line.split(None, 2)
+                if not words:
+                    continue
+                verb = words[1] if (words[0][0] == '@' and len(words) > 1) else words[0]
+                self._command(verb).count += 1
+        return verb
+
+    def done(self, verb, start, failed=False):
+        ms = (time.time() - start) * 1000.0
+        with self._lock:
+            cs = self._command(verb)
+            cs.replies += 1
+            if failed:
+                cs.errors += 1
+            cs.total += ms
+            if ms > cs.max:
+                cs.max = ms
+            cs.hist[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self.since, 1e-9)
+            return { 'time' : now,
+                     'elapsed' : now - self.since,
+                     'commands' : dict((verb, cs.summary())
+                                       for (verb, cs) in self.commands.items()),
+                     'latency_buckets_ms' : list(LATENCY_BUCKETS_MS),
+                     'notifications' : self.notifications,
+                     'notifications_per_s' : self.notifications / elapsed,
+                     'adverts' : self.adverts,
+                     'adverts_per_s' : self.adverts / elapsed,
+                     'bytes_out' : self.bytesOut,
+                     'bytes_in' : self.bytesIn,
+                     'helper_restarts' : self.restarts }
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+RECORDING_HEADER = b"# bluepy-helper recording 1\n"
+
+class _Recorder:
+    # Writes a helper session to a file, one record per line:
+    #   S <t>             a helper was started
+    #   > <t> <command>   a command line sent to it
+    #   < <t> <line>      a text line it sent
+    #   B <t> <hex>       a binary frame it sent
+    # with t in seconds since recording began
+    def __init__(self, fp):
+        if isinstance(fp, str):
+            fp = open(fp, 'ab')
+        self._fp = fp
+        self._lock = threading.Lock()
+        self._t0 = None
+
+    def record(self, kind, data):
+        now = _monotonic()
+        with self._lock:
+            if self._t0 is None:
+                self._t0 = now
+                self._fp.write(RECORDING_HEADER)
+            self._fp.write(("%s %.6f " % (kind, now - self._t0)).encode('ascii')
+                           + data + b"\n")
+
+    def started(self):
+        self.record('S', b'')
+
+    def sent(self, cmd):
+        for line in cmd.encode('utf-8').splitlines():
+            self.record('>', line)
+
+    def received(self, msg):
+        if msg[0] is None:
+            self.record('<', msg[1])
+        else:
+            frame = _frameHeader.pack(FRAME_MAGIC, msg[0], len(msg[1])) + msg[1]
+            self.record('B', binascii.b2a_hex(frame))
+
+    def flush(self):
+        with self._lock:
+            self._fp.flush()
+
+def readRecording(path):
+    # The sessions in a recording, each a list of (kind, t, data) with
+    # data as the helper wrote it (frames decoded from hex)
+    sessions = []
+    with open(path, 'rb') as fp:
+        for line in fp:
+            line = line.rstrip(b"\n")
+            if not line or line.startswith(b"#"):
+                continue
+            parts = line.split(b" ", 2)
+            (kind, t) = (parts[0].decode('ascii'), float(parts[1]))
+            data = parts[2] if len(parts) > 2 else b''
+            if kind == 'S':
+                sessions.append([])
+                continue
+            if not sessions:
+                raise BTLEInternalError("Recording %s doesn't start with a helper" % path)
+            if kind == 'B':
+                data = binascii.a2b_hex(data)
+            elif kind == '<':
+                data += b"\n"
+            elif kind != '>':
+                raise BTLEInternalError("Bad record %s in %s" % (repr(line), path))
+            sessions[-1].append((kind, t, data))
+    return sessions
+
+class _Replay:
+    # The sessions of a recording, handed out one per helper start
+    def __init__(self, path, speed):
+        self.path = path
+        self.speed = speed
+        self._sessions = collections.deque(readRecording(path))
+
+    def start(self):
+        if not self._sessions:
+            raise BTLEInternalError("No more helper sessions in %s" % self.path)
+        return _ReplayedHelper(self._sessions.popleft(), self.speed)
+
+class _ReplayedHelper:
+    # Stands in for a bluepy-helper subprocess, writing a recorded
+    # session's output to a pipe. Output recorded after a command waits
+    # until that many commands have been written; with a speed, it also
+    # keeps its recorded spacing (divided by speed) from the last one.
+    # After the recording ends the pipe stays open but quiet, as a
+    # helper with nothing to report.
+    def __init__(self, records, speed):
+        self._records = records
+        self._speed = speed
+        self._cond = threading.Condition()
+        self._written = 0 # Command lines from the client
+        self._quit = False
+        self.returncode = None
+        (rfd, self._wfd) = os.pipe()
+        self.stdout = os.fdopen(rfd, 'rb', 0)
+        self.stdin = self
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # The stdin side
+    def write(self, data):
+        with self._cond:
+            for line in data.splitlines():
+                if line == b"quit":
+                    self._quit = True
+                else:
+                    self._written += 1
+            self._cond.notify_all()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    # The Popen side
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.kill()
+        self._thread.join()
+        if self.returncode is None:
+            os.close(self._wfd)
+            self.returncode = 0
+        return self.returncode
+
+    def kill(self):
+        with self._cond:
+            self._quit = True
+            self._cond.notify_all()
+
+    def _run(self):
+        (wanted, anchor) = (0, None)
+        for (kind, t, data) in self._records:
+            if kind == '>':
+                wanted += 1
+                with self._cond:
+                    while self._written < wanted and not self._quit:
+                        self._cond.wait()
+                anchor = (_monotonic(), t)
+                continue
+            if self._speed:
+                if anchor is None:
+                    anchor = (_monotonic(), t)
+                delay = anchor[0] + (t - anchor[1]) / self._speed - _monotonic()
+                if delay > 0:
+                    with self._cond:
+                        if not self._quit:
+                            self._cond.wait(delay)
+            if self._quit or not self._put(data):
+                return
+
+    def _put(self, data):
+        # False if quit while the pipe was full
+        view = memoryview(data)
+        while len(view):
+            if not select.select([], [self._wfd], [], 0.1)[1]:
+                if self._quit:
+                    return False
+                continue
+            view = view[os.write(self._wfd, view):]
+        return True
+
 class BluepyHelper:
     def __init__(self):
         self._helper = None
         self._poller = None
         self._stderr = None
+        self._framed = False
+        self._rxbuf = bytearray()
+        self._rxpos = 0
         self.delegate = DefaultDelegate()
+        # Reader thread mode; see withReaderThread()
+        self._threaded = False
+        self._threads = None
+        self._writeLock = threading.Lock()
+        self._replyLock = threading.Lock()
+        self._replies = collections.deque()
+        self._orphans = collections.deque() # Requests failed by a link loss
+        self._local = threading.local()
+        self._ntfyCond = threading.Condition()
+        self._ntfyCount = 0
+        # Credits returned by 'sent' messages; see writeStream()
+        self._sentCount = 0
+        self._sentError = None
+        self._metrics = _Metrics() # See stats()
+        self._recorder = None # See withRecording()
+        self._replay = None # See withReplay()
 
     def withDelegate(self, delegate_):
         self.delegate = delegate_
         return self
 
+    def stats(self):
+        # Counters since the helper object was made (or resetStats()):
+        # per command verb, lines sent and, for those waited on, the
+        # latency to their response as mean, max, a histogram over
+        # LATENCY_BUCKETS_MS and percentiles taken from it; also
+        # notification and advert counts and rates, bytes each way over
+        # the pipe and helper restarts. Plain values, ready for json.
+        return self._metrics.snapshot()
+
+    def resetStats(self):
+        self._metrics.reset()
+
+    def exportStats(self, fp, **labels):
+        # Appends stats() to fp as one line of JSON, with the address,
+        # interface and any labels given, for collection over time
+        snap = self.stats()
+        snap['source'] = type(self).__name__
+        snap['addr'] = getattr(self, 'addr', None)
+        snap['iface'] = getattr(self, 'iface', None)
+        snap.update(labels)
+        fp.write(json.dumps(snap, sort_keys=True) + "\n")
+        return snap
+
+    def withRecording(self, fp):
+        # Records the helper's traffic to fp (a binary file or a path),
+        # from the next helper start: one recording per helper object.
+        # See readRecording() for the format.
+        self._recorder = _Recorder(fp)
+        return self
+
+    def withReplay(self, path, speed=None):
+        # Runs on a recording instead of bluepy-helper, one recorded
+        # helper session per start. Output is replayed as fast as it
+        # is read, or at speed times its recorded pace (1.0 for real
+        # time); either way, responses wait for their commands. The
+        # commands must be those recorded, with the same BinaryFraming.
+        self._replay = _Replay(path, speed)
+        return self
+
+    def withReaderThread(self):
+        # Reads the helper from a background thread, so several threads
+        # can issue commands at once: each response goes to whichever
+        # request was written first, and notifications are passed to the
+        # delegate from a dispatch thread as they arrive.
+        self._threaded = True
+        if self._helper is not None and self._threads is None:
+            self._startThreads()
+        return self
+
+    def _startThreads(self):
+        ntfyQueue = queue.Queue()
+        self._orphans.clear()
+        self._threads = (threading.Thread(target=self._readerLoop,
+                                          args=(self._helper, ntfyQueue)),
+                         threading.Thread(target=self._dispatchLoop,
+                                          args=(ntfyQueue,)))
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _readerLoop(self, helper, ntfyQueue):
+        exc = BTLEInternalError("Helper exited")
+        try:
+            fd = helper.stdout.fileno()
+            while True:
+                msg = self._nextMsg()
+                if msg is None:
+                    if self._rxpos:
+                        del self._rxbuf[:self._rxpos]
+                        self._rxpos = 0
+                    data = os.read(fd, 65536)
+                    if not data:
+                        break
+                    self._metrics.bytesIn += len(data)
+                    self._rxbuf += data
+                    continue
+                self._routeResp(BluepyHelper.parseMsg(msg), ntfyQueue)
+        except (BTLEException, OSError, ValueError) as e:
+            exc = e
+        finally:
+            with self._replyLock:
+                replies = list(self._replies)
+                self._replies.clear()
+            for reply in replies:
+                reply.complete(exc=exc)
+            ntfyQueue.put(None)
+
+    def _routeResp(self, resp, ntfyQueue):
+        respType = resp.get('rsp', [None])[0]
+        if respType == 'ntfy' or respType == 'ind':
+            ntfyQueue.put((resp['hnd'][0], resp['d'][0]))
+            return
+        if respType == 'scan':
+            return
+        if respType == 'sent':
+            self._creditReturned(resp)
+            return
+        state = resp.get('state', [None])[0] if respType == 'stat' else None
+        with self._replyLock:
+            head = self._replies[0] if self._replies else None
+            if state == 'tryconn':
+                # Progress report; 'conn' or 'disc' follows
+                if head is not None:
+                    head.started = True
+                return
+            if state == 'disc' and head is not None and not head.answeredBy(resp):
+                # The link was lost: every request waiting fails, and the
+                # answers the helper still sends them are dropped
+                replies = list(self._replies)
+                self._replies.clear()
+                self._orphans.extend(replies)
+            else:
+                # Answers to requests failed that way come first
+                while self._orphans and not self._orphans[0].answeredBy(resp):
+                    self._orphans.popleft()
+                if self._orphans:
+                    DBG("Late answer:", resp)
+                    self._orphans.popleft()
+                    return
+                replies = [self._replies.popleft()] if head is not None and \
+                    head.answeredBy(resp) else []
+        for reply in replies:
+            reply.complete(resp)
+        if not replies:
+            # e.g. a link loss while idle; the next request will find out
+            DBG("Unsolicited:", resp)
+
+    def _dispatchLoop(self, ntfyQueue):
+        while True:
+            due = self._nextFlush()
+            try:
+                if due is None:
+                    ntfy = ntfyQueue.get()
+                else:
+                    ntfy = ntfyQueue.get(True, max(0, due - time.time()))
+            except queue.Empty:
+                try:
+                    self._flushDue()
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+                continue
+            if ntfy is None:
+                break
+            try:
+                self._notified(*ntfy)
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+            with self._ntfyCond:
+                self._ntfyCount += 1
+                self._ntfyCond.notify_all()
+        with self._ntfyCond:
+            self._ntfyCond.notify_all()
+
+    def _notified(self, hnd, data):
+        delegate = self.delegate
+        if delegate is not None:
+            delegate.handleNotification(hnd, data)
+
+    def _nextFlush(self):
+        # Earliest time a subscription batch falls due, or None
+        return None
+
+    def _flushDue(self):
+        # Delivers batches that are due; True if any were
+        return False
+
+    def _localReplies(self):
+        # This thread's requests, oldest first
+        if not hasattr(self._local, 'replies'):
+            self._local.replies = collections.deque()
+        return self._local.replies
+
+    def _waitReply(self, wantType, timeout=None, keep=False):
+        # keep: on timeout, the request is still waited for next time
+        replies = self._localReplies()
+        if not replies:
+            raise BTLEInternalError("No request outstanding")
+        reply = replies.popleft()
+        if not reply.event.wait(timeout):
+            # The response will still be taken off the queue in turn
+            DBG("Reply timeout")
+            if keep:
+                replies.appendleft(reply)
+            return None
+        if reply.exc is not None:
+            raise reply.exc
+        return self._checkResp(reply.resp, wantType)
+
+    def _waitDispatched(self, timeout):
+        # True once the dispatch thread has handled another notification
+        end = None if timeout is None else time.time() + timeout
+        with self._ntfyCond:
+            count = self._ntfyCount
+            while self._ntfyCount == count and self._threads is not None:
+                remain = None if end is None else end - time.time()
+                if remain is not None and remain <= 0:
+                    break
+                self._ntfyCond.wait(remain)
+            return self._ntfyCount != count
+
     def _startHelper(self,iface=None):
         if self._helper is None:
-            DBG("Running ", helperExe)
-            self._stderr = open(os.devnull, "w")
-            args=[helperExe]
-            if iface is not None: args.append(str(iface))
-            self._helper = subprocess.Popen(args,
-                                            stdin=subprocess.PIPE,
-                                            stdout=subprocess.PIPE,
-                                            stderr=self._stderr,
-                                            universal_newlines=True,
-                                            preexec_fn = preexec_function)
+            if self._replay is not None:
+                DBG("Replaying ", self._replay.path)
+                self._helper = self._replay.start()
+            else:
+                DBG("Running ", helperExe)
+                self._stderr = open(os.devnull, "w")
+                self._helper = subprocess.Popen(_helperArgs(iface),
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                stderr=self._stderr,
+                                                preexec_fn = preexec_function)
+            if self._recorder is not None:
+                self._recorder.started()
             self._poller = select.poll()
             self._poller.register(self._helper.stdout, select.POLLIN)
+            self._rxbuf = bytearray()
+            self._rxpos = 0
+            self._metrics.helperStarted()
+            if BinaryFraming:
+                self._negotiateFraming()
+            if self._threaded:
+                self._startThreads()
+
+    def _negotiateFraming(self):
+        # Older helpers answer 'bin' with a badcmd error; stay on text
+        # (before any reader thread starts)
+        self._writeCmd("bin on\n")
+        rsp = self._readResp(['bin', 'err'])
+        self._framed = (rsp['rsp'][0] == 'bin')
+        DBG("Binary framing", "on" if self._framed else "not supported")
 
     def _stopHelper(self):
-        if self._helper is not None:
-            DBG("Stopping ", helperExe)
-            self._poller.unregister(self._helper.stdout)
-            self._helper.stdin.write("quit\n")
-            self._helper.stdin.flush()
-            self._helper.wait()
-            self._helper = None
+        with self._writeLock:
+            (threads, self._threads) = (self._threads, None)
+            if self._helper is not None:
+                DBG("Stopping ", helperExe)
+                self._poller.unregister(self._helper.stdout)
+                if self._helper.poll() is None:
+                    try:
+                        self._helper.stdin.write(b"quit\n")
+                        self._helper.stdin.flush()
+                    except (IOError, OSError):
+                        pass # It exited meanwhile
+                self._helper.wait()
+                self._helper = None
+                self._framed = False
+                if self._recorder is not None:
+                    self._recorder.flush()
+        if threads is not None:
+            # The helper has exited, so the reader sees EOF. The dispatch
+            # thread may be the caller, from a delegate.
+            for t in threads:
+                if t is not threading.current_thread():
+                    t.join()
         if self._stderr is not None:
             self._stderr.close()
             self._stderr = None
 
-    def _writeCmd(self, cmd):
-        if self._helper is None:
-            raise BTLEInternalError("Helper not started (did you call connect()?)")
+    def _writeCmd(self, cmd, reply=True):
+        # reply=False for commands the helper doesn't answer in order
         DBG("Sent: ", cmd)
-        self._helper.stdin.write(cmd)
-        self._helper.stdin.flush()
+        with self._writeLock:
+            if self._helper is None:
+                raise BTLEInternalError("Helper not started (did you call connect()?)")
+            verb = self._noteCmd(cmd, reply)
+            if reply and self._threads is not None:
+                # Queued in write order, which is response order
+                reply = _Reply(verb)
+                with self._replyLock:
+                    self._replies.append(reply)
+                self._localReplies().append(reply)
+            if self._recorder is not None:
+                self._recorder.sent(cmd)
+            data = cmd.encode('utf-8')
+            self._metrics.bytesOut += len(data)
+            self._helper.stdin.write(data)
+            self._helper.stdin.flush()
+
+    def _noteCmd(self, cmd, reply):
+        # Counts cmd; if it has a response, times it until _checkResp()
+        # sees that (per thread, as responses are waited for)
+        verb = self._metrics.sent(cmd)
+        self._local.op = (verb, time.time(), cmd) if reply else None
+        return verb
+
+    def _opDone(self, failed=False):
+        op = getattr(self._local, 'op', None)
+        if op is not None:
+            self._local.op = None
+            self._metrics.done(op[0], op[1], failed)
+
+    def _creditReturned(self, resp):
+        # A 'sent' message: a streamed write has gone to the kernel, or
+        # failed
+        with self._ntfyCond:
+            self._sentCount += 1
+            if resp['code'][0] != 'success' and self._sentError is None:
+                self._sentError = resp
+            self._ntfyCond.notify_all()
 
     def _mgmtCmd(self, cmd):
         self._writeCmd(cmd + '\n')
@@ -333,56 +1262,315 @@ class BluepyHelper:
                 resp[tag].append(val)
         return resp
 
-    def _waitResp(self, wantType, timeout=None):
-        while True:
-            if self._helper.poll() is not None:
-                raise BTLEInternalError("Helper exited")
+    @staticmethod
+    def parseFrame(rspCode, payload):
+        try:
+            resp = {'rsp': [_frameRsps[rspCode]]}
+            mv = memoryview(payload)
+            pos = 0
+            while pos < len(mv):
+                (tagCode, vtype, vlen) = _frameItem.unpack_from(mv, pos)
+                pos += _frameItem.size
+                if vtype == _VT_UINT:
+                    val = _frameUint.unpack_from(mv, pos)[0]
+                elif vtype == _VT_DATA:
+                    val = mv[pos:pos+vlen].tobytes()
+                elif vtype == _VT_SYM or vtype == _VT_STR:
+                    val = mv[pos:pos+vlen].tobytes().decode('utf-8')
+                else:
+                    raise BTLEInternalError("Cannot understand frame value type %d" % vtype)
+                pos += vlen
+                tag = _frameTags[tagCode]
+                if tag not in resp:
+                    resp[tag] = [val]
+                else:
+                    resp[tag].append(val)
+        except (IndexError, struct.error):
+            raise BTLEInternalError("Malformed frame %s" % repr(bytes(payload)))
+        return resp
 
-            if timeout:
-                fds = self._poller.poll(timeout*1000)
-                if len(fds) == 0:
-                    DBG("Select timeout")
+    def _readHelper(self, timeout=None):
+        # Read whatever the helper has written so far; several responses
+        # may arrive in one chunk, and a frame may be split across chunks.
+        # Returns False on timeout.
+        if self._helper.poll() is not None:
+            raise BTLEInternalError("Helper exited")
+
+        if timeout is not None:
+            fds = self._poller.poll(timeout*1000)
+            if len(fds) == 0:
+                DBG("Select timeout")
+                return False
+
+        if self._rxpos:
+            del self._rxbuf[:self._rxpos]
+            self._rxpos = 0
+        data = os.read(self._helper.stdout.fileno(), 65536)
+        if not data:
+            raise BTLEInternalError("Helper exited")
+        self._metrics.bytesIn += len(data)
+        self._rxbuf += data
+        return True
+
+    def _nextMsg(self):
+        # Returns the next complete message in the receive buffer as
+        # (frame type, payload) or (None, text line), or None if more
+        # data is needed. Frames and text lines may be interleaved; '#'
+        # comment lines are always text.
+        buf = self._rxbuf
+        while self._rxpos < len(buf):
+            pos = self._rxpos
+            if buf[pos] == FRAME_MAGIC:
+                if len(buf) - pos < _frameHeader.size:
                     return None
-
-            rv = self._helper.stdout.readline()
-            DBG("Got:", repr(rv))
-            if rv.startswith('#') or rv == '\n' or len(rv)==0:
+                (_, rspCode, plen) = _frameHeader.unpack_from(buf, pos)
+                start = pos + _frameHeader.size
+                if len(buf) < start + plen:
+                    return None
+                self._rxpos = start + plen
+                payload = bytes(buf[start:start + plen])
+                DBG("Got frame:", rspCode, repr(payload))
+                if self._recorder is not None:
+                    self._recorder.received((rspCode, payload))
+                return (rspCode, payload)
+
+            nl = buf.find(b'\n', pos)
+            if nl < 0:
+                return None
+            self._rxpos = nl + 1
+            if nl == pos or buf[pos] == _COMMENT:
                 continue
+            line = bytes(buf[pos:nl])
+            DBG("Got:", repr(line))
+            if self._recorder is not None:
+                self._recorder.received((None, line))
+            return (None, line)
+        return None
 
-            resp = BluepyHelper.parseResp(rv)
-            if 'rsp' not in resp:
-                raise BTLEInternalError("No response type indicator", resp)
+    @staticmethod
+    def parseMsg(msg):
+        (rspCode, data) = msg
+        if rspCode is None:
+            return BluepyHelper.parseResp(data.decode('utf-8', 'replace'))
+        return BluepyHelper.parseFrame(rspCode, data)
 
-            respType = resp['rsp'][0]
-            if respType in wantType:
-                return resp
-            elif respType == 'stat':
-                if 'state' in resp and len(resp['state']) > 0 and resp['state'][0] == 'disc':
-                    self._stopHelper()
-                    raise BTLEDisconnectError("Device disconnected", resp)
-            elif respType == 'err':
-                errcode=resp['code'][0]
-                if errcode=='nomgmt':
-                    raise BTLEManagementError("Management not available (permissions problem?)", resp)
-                elif errcode=='atterr':
-                    raise BTLEGattError("Bluetooth command failed", resp)
-                else:
-                    raise BTLEException("Error from bluepy-helper (%s)" % errcode, resp)
-            elif respType == 'scan':
-                # Scan response when we weren't interested. Ignore it
+    @staticmethod
+    def _respError(resp):
+        # Exception for an 'err' response
+        errcode=resp['code'][0]
+        if errcode=='nomgmt':
+            return BTLEManagementError("Management not available (permissions problem?)", resp)
+        elif errcode=='atterr':
+            return BTLEGattError("Bluetooth command failed", resp)
+        else:
+            return BTLEException("Error from bluepy-helper (%s)" % errcode, resp)
+
+    def _checkResp(self, resp, wantType):
+        # Returns resp if it's one of wantType, None if it can be
+        # ignored, and raises for errors and disconnection
+        if 'rsp' not in resp:
+            raise BTLEInternalError("No response type indicator", resp)
+
+        respType = resp['rsp'][0]
+        if respType in wantType:
+            if respType not in _untimedRsps and not (
+                    respType == 'stat' and resp.get('state', [None])[0] == 'tryconn'):
+                self._opDone(respType == 'err')
+            return resp
+        elif respType == 'stat':
+            if 'state' in resp and len(resp['state']) > 0 and resp['state'][0] == 'disc':
+                self._opDone(True)
+                self._stopHelper()
+                raise BTLEDisconnectError("Device disconnected", resp)
+        elif respType == 'err':
+            self._opDone(True)
+            raise BluepyHelper._respError(resp)
+        elif respType == 'scan':
+            # Scan response when we weren't interested. Ignore it
+            pass
+        elif respType == 'sent':
+            self._creditReturned(resp)
+        else:
+            raise BTLEInternalError("Unexpected response (%s)" % respType, resp)
+        return None
+
+    def _waitResp(self, wantType, timeout=None):
+        if self._threaded:
+            return self._waitReply(wantType, timeout)
+        return self._readResp(wantType, timeout)
+
+    def _readResp(self, wantType, timeout=None):
+        while True:
+            msg = self._nextMsg()
+            if msg is None:
+                if not self._readHelper(timeout):
+                    return None
                 continue
-            else:
-                raise BTLEInternalError("Unexpected response (%s)" % respType, resp)
+
+            resp = self._checkResp(BluepyHelper.parseMsg(msg), wantType)
+            if resp is not None:
+                return resp
 
     def status(self):
         self._writeCmd("stat\n")
         return self._waitResp(['stat'])
 
 
+class GattCache:
+    """On-disk cache of device attribute tables"""
+    # One JSON file per device address. An entry holds the device's
+    # database fingerprint, its primary services, and the results of
+    # each characteristic and descriptor query made so far; it is
+    # dropped when the fingerprint no longer matches.
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache', 'bluepy', 'gatt')
+        self.path = path
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, addr):
+        return os.path.join(self.path, addr.replace(':', '').lower() + '.json')
+
+    def load(self, addr):
+        # The stored entry for addr, or None
+        addr = addr.lower()
+        if addr not in self._entries:
+            try:
+                with open(self._file(addr), 'r') as fp:
+                    self._entries[addr] = json.load(fp)
+            except (IOError, OSError, ValueError):
+                self._entries[addr] = None
+        return self._entries[addr]
+
+    def lookup(self, addr, fingerprint):
+        # The entry for addr if it was made for the same attribute
+        # database, else a new empty one
+        entry = self.load(addr)
+        if entry is not None and entry.get('fp') == fingerprint:
+            return entry
+        entry = { 'fp' : fingerprint, 'svcs' : None, 'sc' : None,
+                  'chars' : {}, 'descs' : {} }
+        self._entries[addr.lower()] = entry
+        return entry
+
+    def store(self, addr, entry):
+        addr = addr.lower()
+        self._entries[addr] = entry
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        fname = self._file(addr)
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(entry, fp)
+        os.rename(tmp, fname)
+
+    def flush(self, addr=None):
+        # Forgets addr, or every device
+        if addr is None:
+            addrs = list(self._entries.keys())
+            if os.path.isdir(self.path):
+                for fname in os.listdir(self.path):
+                    if fname.endswith('.json'):
+                        os.remove(os.path.join(self.path, fname))
+        else:
+            addrs = [addr.lower()]
+            if os.path.exists(self._file(addr)):
+                os.remove(self._file(addr))
+        for a in addrs:
+            self._entries[a] = None
+
+    def stats(self):
+        return { 'hits' : self.hits, 'misses' : self.misses }
+
+
+class _ValueCache:
+    # Attribute values by handle, with when each was read or notified;
+    # see Peripheral.withValueCache()
+    def __init__(self):
+        self._values = {} # Indexed by handle: (time, value)
+        self._lock = threading.Lock() # Notified from the dispatch thread
+        self.hits = 0
+        self.misses = 0
+        self.notified = 0
+
+    def get(self, handle, maxAge):
+        with self._lock:
+            entry = self._values.get(handle)
+            if entry is not None and time.time() - entry[0] <= maxAge:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, handle, value, notified=False):
+        with self._lock:
+            self._values[handle] = (time.time(), value)
+            if notified:
+                self.notified += 1
+
+    def drop(self, handle=None):
+        with self._lock:
+            if handle is None:
+                self._values.clear()
+            else:
+                self._values.pop(handle, None)
+
+    def report(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'entries' : len(self._values),
+                     'hits' : self.hits,
+                     'misses' : self.misses,
+                     'hitRate' : float(self.hits) / lookups if lookups else 0.0,
+                     'notified' : self.notified }
+
+
+class _Supervisor:
+    # Settings and record of a Peripheral's helper restarts; see
+    # Peripheral.withSupervision()
+    def __init__(self, maxRestarts, timeout, hangTimeout, backoff):
+        self.maxRestarts = maxRestarts
+        self.timeout = timeout
+        self.hangTimeout = hangTimeout
+        self.backoff = backoff
+        self.lock = threading.RLock() # Held while restoring
+        self.owner = None # The thread restoring, meanwhile
+        self.deadline = None
+        self.generation = 0 # Helpers restored so far
+        self.recoveries = 0
+        self.failures = 0 # Attempts that failed
+        self.lastError = None
+        self.lastRecovery = None # Seconds it took
+
+    def report(self):
+        return { 'recoveries' : self.recoveries,
+                 'failures' : self.failures,
+                 'lastError' : self.lastError,
+                 'lastRecovery' : self.lastRecovery }
+
+
 class Peripheral(BluepyHelper):
     def __init__(self, deviceAddr=None, addrType=ADDR_TYPE_PUBLIC, iface=None):
         BluepyHelper.__init__(self)
         self._serviceMap = None # Indexed by UUID
+        self._cache = None
+        self._cacheEntry = None # Checked entry for this connection
+        self._streamWrites = None # Whether the helper has 'wrs'
+        self._dumps = None # Whether the helper has 'dump'
+        self._wantMTU = None # See withMTU()
+        self._mtu = None # ATT MTU of this connection, once known
+        self._subscriptions = {} # Indexed by value handle
+        self._supervisor = None # See withSupervision()
+        self._values = None # See withValueCache()
+        self._session = False # Connected, and not since disconnect()ed
+        # What a restored session sets again
+        self._secLevel = None
+        self._askedMTU = None
+        self._cccds = {} # Values written, by handle
+        self._resetIndex()
+        self.addr = None # Of the device connected to, or last connected to
         (self.deviceAddr, self.addrType, self.iface) = (None, None, None)
 
         if isinstance(deviceAddr, ScanEntry):
@@ -404,16 +1592,13 @@ class Peripheral(BluepyHelper):
             wantType = [wantType]
 
         while True:
-            resp = self._waitResp(wantType + ['ntfy', 'ind'], timeout)
+            resp = self._supervisedWait(wantType + ['ntfy', 'ind'], timeout)
             if resp is None:
                 return None
 
             respType = resp['rsp'][0]
             if respType == 'ntfy' or respType == 'ind':
-                hnd = resp['hnd'][0]
-                data = resp['d'][0]
-                if self.delegate is not None:
-                    self.delegate.handleNotification(hnd, data)
+                self._notified(resp['hnd'][0], resp['d'][0])
                 if respType not in wantType:
                     continue
             return resp
@@ -424,6 +1609,12 @@ class Peripheral(BluepyHelper):
         if addrType not in (ADDR_TYPE_PUBLIC, ADDR_TYPE_RANDOM):
             raise ValueError("Expected address type public or random, got {}".format(addrType))
         self._startHelper(iface)
+        self._cacheEntry = None
+        self._streamWrites = None
+        self._dumps = None
+        self._mtu = None
+        if addr != self.addr:
+            self._resetIndex()
         self.addr = addr
         self.addrType = addrType
         self.iface = iface
@@ -437,6 +1628,9 @@ class Peripheral(BluepyHelper):
         if rsp['state'][0] != 'conn':
             self._stopHelper()
             raise BTLEDisconnectError("Failed to connect to peripheral %s, addr type: %s" % (addr, addrType), rsp)
+        self._session = True
+        if self._wantMTU is not None:
+            self._exchangeMTU()
 
     def connect(self, addr, addrType=ADDR_TYPE_PUBLIC, iface=None):
         if isinstance(addr, ScanEntry):
@@ -445,16 +1639,304 @@ class Peripheral(BluepyHelper):
             self._connect(addr, addrType, iface)
 
     def disconnect(self):
+        self._session = False
+        (self._secLevel, self._askedMTU, self._cccds) = (None, None, {})
+        if self._values is not None:
+            self._values.drop()
         if self._helper is None:
             return
         # Unregister the delegate first
         self.setDelegate(None)
+        self._cacheEntry = None
+        subs = self._subscriptions
+        self._subscriptions = {}
+        for sub in subs.values():
+            sub._deliver(None)
 
+        if self._supervisor is not None and self._helperDead():
+            self._stopHelper()
+            return
         self._writeCmd("disc\n")
         self._getResp('stat')
         self._stopHelper()
 
-    def discoverServices(self):
+    def withSupervision(self, maxRestarts=3, timeout=30.0, hangTimeout=35.0,
+                        backoff=0.5):
+        # Restarts bluepy-helper when it exits, or when a request has had
+        # no response (and nothing else has come from the helper) for
+        # hangTimeout seconds, or None for never. The device is then
+        # reconnected; the MTU, security level and CCCDs written through
+        # subscribe() or a Descriptor are set again; and the request that
+        # was waiting is sent again. Up to maxRestarts attempts within
+        # timeout seconds, backing off between them; if they all fail
+        # the request raises BTLEDisconnectError. The Peripheral keeps
+        # its services, characteristics, subscriptions and delegate.
+        self._supervisor = _Supervisor(maxRestarts, timeout, hangTimeout, backoff)
+        return self
+
+    def withValueCache(self, enable=True):
+        # Keeps the last value read, notified or indicated for each
+        # handle, so reads given a max_age can be answered without a
+        # round trip while the value is fresh enough. A write drops the
+        # handle's value, and a Service Changed indication all of them.
+        # stats() counts hits and misses under 'valueCache'.
+        self._values = _ValueCache() if enable else None
+        return self
+
+    def stats(self):
+        snap = BluepyHelper.stats(self)
+        if self._supervisor is not None:
+            snap['supervisor'] = self._supervisor.report()
+        if self._values is not None:
+            snap['valueCache'] = self._values.report()
+        return snap
+
+    def _helperDead(self, grace=0.0):
+        # A helper closes its output a moment before it can be reaped,
+        # so one that just did gets grace seconds to finish exiting
+        helper = self._helper
+        end = time.time() + grace
+        while helper is not None and helper.poll() is None:
+            if time.time() >= end:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _recoverable(self, generation=None):
+        # Whether an error from the helper is one a restart fixes (or
+        # has fixed, since generation)
+        sup = self._supervisor
+        return (sup is not None and self._session and
+                sup.owner is not threading.current_thread() and
+                ((generation is not None and generation != sup.generation) or
+                 self._helperDead(0.5)))
+
+    def _writeCmd(self, cmd, reply=True):
+        sup = self._supervisor
+        if sup is None:
+            return BluepyHelper._writeCmd(self, cmd, reply)
+        if sup.owner is not None and sup.owner is not threading.current_thread():
+            with sup.lock:
+                pass # Another thread is restoring the session
+        generation = sup.generation
+        try:
+            BluepyHelper._writeCmd(self, cmd, reply)
+        except (BTLEInternalError, IOError, OSError, ValueError) as e:
+            if not self._recoverable(generation):
+                raise
+            self._recover(generation, e)
+            BluepyHelper._writeCmd(self, cmd, reply)
+
+    def _supervisedWait(self, wantType, timeout=None):
+        # _waitResp(), restoring the session if the helper exits or hangs
+        # and sending again the request that was waiting if that is safe
+        sup = self._supervisor
+        if sup is None:
+            return self._waitResp(wantType, timeout)
+        if sup.owner is threading.current_thread():
+            # Restoring: every wait ends by the deadline
+            remain = max(0.0, sup.deadline - time.time())
+            if timeout is not None and timeout < remain:
+                return self._waitResp(wantType, timeout)
+            resp = self._waitResp(wantType, remain)
+            if resp is None:
+                raise BTLEInternalError("Timed out restoring the session")
+            return resp
+        end = None if timeout is None else time.time() + timeout
+        restarts = 0
+        while True:
+            generation = sup.generation
+            op = getattr(self._local, 'op', None)
+            wait = None if end is None else max(0.0, end - time.time())
+            watch = (op is not None and self._session and sup.hangTimeout is not None and
+                     (wait is None or wait > sup.hangTimeout))
+            seen = self._metrics.bytesIn
+            try:
+                if watch and self._threaded:
+                    resp = self._waitReply(wantType, sup.hangTimeout, keep=True)
+                else:
+                    resp = self._waitResp(wantType, sup.hangTimeout if watch else wait)
+                if resp is not None or not watch:
+                    return resp
+                if self._metrics.bytesIn != seen:
+                    continue # Busy rather than hung
+                DBG("Helper not responding to", op[0])
+                exc = BTLEInternalError("Helper not responding")
+                self._helper.kill()
+            except (BTLEInternalError, IOError, OSError, ValueError) as e:
+                if not self._recoverable(generation):
+                    raise
+                exc = e
+            restarts += 1
+            if restarts > sup.maxRestarts:
+                raise BTLEDisconnectError("bluepy-helper keeps failing (%s)" % exc)
+            self._recover(generation, exc)
+            if self._threaded:
+                # Requests to the old helper, answered with errors
+                self._localReplies().clear()
+            if op is not None and op[0] not in ('conn', 'disc'):
+                if op[0] not in _replayableCmds:
+                    raise BTLEDisconnectError("bluepy-helper failed during '%s', which may or may not have taken effect; the session is restored" % op[0])
+                self._writeCmd(op[2])
+
+    def _recover(self, generation, exc):
+        # Replaces a failed helper and restores the session, unless
+        # another thread has since done so
+        sup = self._supervisor
+        with sup.lock:
+            if sup.generation != generation and not self._helperDead():
+                return
+            DBG("Restoring session with", self.addr, "after:", exc)
+            sup.owner = threading.current_thread()
+            start = time.time()
+            sup.deadline = start + sup.timeout
+            attempts = 0
+            try:
+                while True:
+                    try:
+                        self._killHelper()
+                        if self._threaded:
+                            self._dropReplies()
+                        self._connect(self.addr, self.addrType, self.iface)
+                        self._restoreSession()
+                        break
+                    except (BTLEException, IOError, OSError, ValueError) as e:
+                        DBG("Restore failed:", e)
+                        sup.failures += 1
+                        sup.lastError = str(e)
+                        attempts += 1
+                        remain = sup.deadline - time.time()
+                        if attempts >= sup.maxRestarts or remain <= 0:
+                            self._killHelper()
+                            raise BTLEDisconnectError("Couldn't restore the session with %s after bluepy-helper failed (%s)" % (self.addr, e))
+                        delay = sup.backoff * (2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                        time.sleep(min(remain, delay))
+            finally:
+                sup.owner = None
+            sup.generation += 1
+            sup.recoveries += 1
+            sup.lastError = str(exc)
+            sup.lastRecovery = time.time() - start
+
+    def _dropReplies(self):
+        # Fails requests the old helper left unanswered, including any
+        # written after its reader thread ended
+        with self._replyLock:
+            replies = list(self._replies)
+            self._replies.clear()
+        for reply in replies:
+            reply.complete(exc=BTLEInternalError("Helper exited"))
+        self._localReplies().clear()
+
+    def _killHelper(self):
+        helper = self._helper
+        if helper is not None and helper.poll() is None:
+            helper.kill()
+        self._stopHelper()
+
+    def _restoreSession(self):
+        if self._secLevel is not None:
+            self.setSecurityLevel(self._secLevel)
+        if self._askedMTU is not None and self._wantMTU is None:
+            self.setMTU(self._askedMTU)
+        for (handle, val) in sorted(self._cccds.items()):
+            self.writeCharacteristic(handle, val, True)
+
+    def _cccdWritten(self, handle, val):
+        # Remembers enabled notifications and indications, to restore
+        if val.strip(b"\x00"):
+            self._cccds[handle] = bytes(val)
+        else:
+            self._cccds.pop(handle, None)
+
+    def withCache(self, cache):
+        # Serve discovery from cache (a GattCache) where it still holds
+        # for this device
+        self._cache = cache
+        self._cacheEntry = None
+        return self
+
+    def flushCache(self):
+        if self._cache is not None and self.addr is not None:
+            self._cache.flush(self.addr)
+        self._cacheEntry = None
+        self._resetIndex()
+
+    def _cached(self):
+        # This device's cache entry, checked against its fingerprint once
+        # per connection; None when not caching
+        if self._cache is None:
+            return None
+        if self._cacheEntry is None:
+            (fp, svcs) = self._fingerprint()
+            entry = self._cache.lookup(self.addr, fp)
+            if entry['svcs'] is None:
+                self._cache.misses += 1
+                if svcs is not None:
+                    self._cacheServices(entry, svcs)
+            else:
+                self._cache.hits += 1
+            self._cacheEntry = entry
+        return self._cacheEntry
+
+    def _fingerprint(self):
+        # The Database Hash characteristic if the device has one, else a
+        # digest of the primary service table, which is returned too
+        old = self._cache.load(self.addr)
+        if old is None or old['fp'].startswith('hash:'):
+            try:
+                rsp = self._readCharacteristicByUUID(DATABASE_HASH_UUID, 1, 0xFFFF)
+                return ('hash:' + binascii.b2a_hex(rsp['d'][0]).decode('ascii'), None)
+            except BTLEGattError:
+                pass
+        svcs = self._readServices()
+        digest = hashlib.sha1('|'.join(['%s:%X:%X' % s for s in svcs]).encode('ascii'))
+        return ('svcs:' + digest.hexdigest(), svcs)
+
+    def _cacheServices(self, entry, svcs):
+        entry['svcs'] = svcs
+        # Note where Service Changed would be indicated, so the entry can
+        # be dropped when it is
+        for (uuid, start, end) in svcs:
+            if UUID(uuid) == GATT_SERVICE_UUID:
+                chars = self._readCharacteristics(start, end, SERVICE_CHANGED_UUID)
+                if chars:
+                    entry['sc'] = chars[0][3]
+        self._cache.store(self.addr, entry)
+
+    def _notified(self, hnd, data):
+        self._metrics.notifications += 1
+        entry = self._cacheEntry
+        if entry is not None and hnd == entry['sc']:
+            DBG("Service Changed; flushing cache for", self.addr)
+            self.flushCache()
+            if self._values is not None:
+                self._values.drop()
+        elif self._values is not None:
+            self._values.put(hnd, data, True)
+        sub = self._subscriptions.get(hnd)
+        if sub is not None:
+            sub._add(time.time(), data)
+        else:
+            BluepyHelper._notified(self, hnd, data)
+
+    def _nextFlush(self):
+        due = None
+        for sub in self._subscriptions.values():
+            t = sub._deadline()
+            if t is not None and (due is None or t < due):
+                due = t
+        return due
+
+    def _flushDue(self):
+        now = time.time()
+        delivered = False
+        for sub in list(self._subscriptions.values()):
+            if sub._deliver(now):
+                delivered = True
+        return delivered
+
+    def _readServices(self):
         self._writeCmd("svcs\n")
         rsp = self._getResp('find')
         starts = rsp['hstart']
@@ -462,11 +1944,26 @@ class Peripheral(BluepyHelper):
         uuids  = rsp['uuid']
         nSvcs = len(uuids)
         assert(len(starts)==nSvcs and len(ends)==nSvcs)
+        return [(str(UUID(uuids[i])), starts[i], ends[i]) for i in range(nSvcs)]
+
+    def discoverServices(self):
+        entry = self._cached()
+        if entry is None:
+            svcs = self._readServices()
+        else:
+            if entry['svcs'] is None:
+                self._cacheServices(entry, self._readServices())
+            svcs = entry['svcs']
         self._serviceMap = {}
-        for i in range(nSvcs):
-            self._serviceMap[UUID(uuids[i])] = Service(self, uuids[i], starts[i], ends[i])
+        for (uuid, start, end) in svcs:
+            self._serviceMap[UUID(uuid)] = Service(self, uuid, start, end)
         return self._serviceMap
 
+    def status(self):
+        # Notifications may arrive first; pass them on rather than fail
+        self._writeCmd("stat\n")
+        return self._getResp(['stat'])
+
     def getState(self):
         status = self.status()
         return status['state'][0]
@@ -484,6 +1981,12 @@ class Peripheral(BluepyHelper):
         uuid = UUID(uuidVal)
         if self._serviceMap is not None and uuid in self._serviceMap:
             return self._serviceMap[uuid]
+        if self._cached() is not None:
+            # Whole service table is at hand
+            self.discoverServices()
+            if uuid in self._serviceMap:
+                return self._serviceMap[uuid]
+            raise BTLEGattError("Service %s not found" % (uuid.getCommonName()))
         self._writeCmd("svcs %s\n" % uuid)
         rsp = self._getResp('find')
         if 'hstart' not in rsp:
@@ -500,18 +2003,169 @@ class Peripheral(BluepyHelper):
         self._writeCmd("incl %X %X\n" % (startHnd, endHnd))
         return self._getResp('find')
 
-    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+    def _readCharacteristics(self, startHnd, endHnd, uuid):
         cmd = 'char %X %X' % (startHnd, endHnd)
         if uuid:
             cmd += ' %s' % UUID(uuid)
         self._writeCmd(cmd + "\n")
         rsp = self._getResp('find')
         nChars = len(rsp['hnd'])
-        return [Characteristic(self, rsp['uuid'][i], rsp['hnd'][i],
-                               rsp['props'][i], rsp['vhnd'][i])
+        return [(rsp['uuid'][i], rsp['hnd'][i], rsp['props'][i], rsp['vhnd'][i])
                 for i in range(nChars)]
 
-    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+    def _fromCache(self, table, key, query):
+        # table[key] from the cache entry, running query() and saving its
+        # result on a miss; just query() when not caching
+        entry = self._cached()
+        if entry is None:
+            return query()
+        rows = entry[table].get(key)
+        if rows is None:
+            self._cache.misses += 1
+            rows = query()
+            entry[table][key] = rows
+            self._cache.store(self.addr, entry)
+        else:
+            self._cache.hits += 1
+        return rows
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        if self._allChars is not None:
+            return self._knownCharacteristics(startHnd, endHnd, uuid)
+        key = '%X %X %s' % (startHnd, endHnd, UUID(uuid) if uuid else '')
+        rows = self._fromCache('chars', key,
+                    lambda: self._readCharacteristics(startHnd, endHnd, uuid))
+        chars = [self._characteristic(*row) for row in rows]
+        if not uuid:
+            _linkCharacteristics(chars, endHnd)
+            if startHnd <= 1 and endHnd >= 0xFFFF:
+                self._indexAll(list(chars))
+        return chars
+
+    def discoverAll(self):
+        # Every service in handle order, with its characteristics and
+        # theirs with their descriptors filled in. Helpers with 'dump'
+        # discover it all in one request; otherwise, or when discovery
+        # is served from a cache, it is walked a request at a time.
+        rows = None
+        if self._dumps is not False and self._cached() is None:
+            rows = self._readAll()
+        if rows is None:
+            svcs = sorted(self.services, key=lambda s: s.hndStart)
+            for svc in svcs:
+                for ch in svc.getCharacteristics():
+                    ch.getDescriptors()
+            return svcs
+        (svcRows, charRows, descRows) = rows
+        self._serviceMap = {}
+        for (uuid, start, end) in svcRows:
+            self._serviceMap[UUID(uuid)] = Service(self, uuid, start, end)
+        chars = [self._characteristic(*row) for row in charRows]
+        _linkCharacteristics(chars, 0xFFFF)
+        self._indexAll(list(chars))
+        descs = [Descriptor(self, *row) for row in descRows]
+        i = 0
+        for ch in chars:
+            ch.descs = []
+            while i < len(descs) and descs[i].handle <= ch.hndEnd:
+                if descs[i].handle > ch.valHandle:
+                    ch.descs.append(descs[i])
+                i += 1
+        svcs = sorted(self._serviceMap.values(), key=lambda s: s.hndStart)
+        for svc in svcs:
+            svc.chars = self._knownCharacteristics(svc.hndStart, svc.hndEnd, None)
+        return svcs
+
+    def _readAll(self):
+        # (services, characteristics, descriptors) rows from one 'dump',
+        # or None if the helper does not have it or its answer won't do.
+        # Its 'uuid' holds the services', then the characteristics',
+        # then the descriptors'; 'hnd' the characteristics', then the
+        # descriptors'.
+        self._writeCmd("dump\n")
+        rsp = self._getResp(['gatt', 'err'])
+        if rsp['rsp'][0] == 'err':
+            if rsp['code'][0] == 'badcmd':
+                self._dumps = False
+            elif rsp['code'][0] != 'eframe': # Too big for one frame
+                raise BluepyHelper._respError(rsp)
+            return None
+        self._dumps = True
+        (starts, ends) = (rsp.get('hstart', []), rsp.get('hend', []))
+        (uuids, hnds) = (rsp.get('uuid', []), rsp.get('hnd', []))
+        (props, vhnds) = (rsp.get('props', []), rsp.get('vhnd', []))
+        (nSvcs, nChars) = (len(starts), len(props))
+        if (len(ends) != nSvcs or len(vhnds) != nChars or len(hnds) < nChars
+                or len(uuids) != nSvcs + len(hnds)):
+            DBG("Inconsistent 'gatt' response; walking the table instead")
+            return None
+        svcs = [(uuids[i], starts[i], ends[i]) for i in range(nSvcs)]
+        chars = [(uuids[nSvcs+i], hnds[i], props[i], vhnds[i])
+                 for i in range(nChars)]
+        descs = [(uuids[nSvcs+i], hnds[i]) for i in range(nChars, len(hnds))]
+        return (svcs, chars, descs)
+
+    def _resetIndex(self):
+        self._chars = {} # Characteristics seen, by declaration and value handle
+        self._allChars = None # Every characteristic by handle, once listed
+        self._charHandles = [] # Their declaration handles
+        self._charsByUUID = {}
+
+    def _characteristic(self, uuid, hnd, props, vhnd):
+        # The Characteristic for a discovered row; the one seen before at
+        # this handle if it matches, keeping its end handle and descriptors
+        ch = self._chars.get(hnd)
+        if (ch is None or ch.handle != hnd or ch.valHandle != vhnd
+                or ch.properties != props or ch.uuid != UUID(uuid)):
+            ch = Characteristic(self, uuid, hnd, props, vhnd)
+            self._chars[hnd] = self._chars[vhnd] = ch
+        return ch
+
+    def _indexAll(self, chars):
+        # chars is the whole table: end the last of each service with it,
+        # where services are known, and answer later lookups from here
+        if self._serviceMap:
+            svcs = sorted((s.hndStart, s.hndEnd) for s in self._serviceMap.values())
+            starts = [start for (start, end) in svcs]
+            for ch in chars:
+                i = bisect.bisect_right(starts, ch.handle) - 1
+                if i >= 0 and ch.hndEnd > svcs[i][1] >= ch.handle:
+                    ch.hndEnd = svcs[i][1]
+        self._charHandles = [ch.handle for ch in chars]
+        self._charsByUUID = _uuidIndex(chars, None)[2]
+        self._allChars = chars
+
+    def _knownCharacteristics(self, startHnd, endHnd, uuid):
+        if uuid:
+            return [ch for ch in self._charsByUUID.get(UUID(uuid), ())
+                    if startHnd <= ch.handle <= endHnd]
+        lo = bisect.bisect_left(self._charHandles, startHnd)
+        hi = bisect.bisect_right(self._charHandles, endHnd)
+        return self._allChars[lo:hi]
+
+    def _characteristicEnd(self, char):
+        # Where char ends, from the characteristics of the service that
+        # holds it; 0xFFFF if there is no telling
+        for svc in self.services:
+            if svc.hndStart <= char.handle <= svc.hndEnd:
+                for ch in svc.getCharacteristics():
+                    if ch.handle == char.handle and ch.hndEnd is not None:
+                        return ch.hndEnd
+                return svc.hndEnd
+        return 0xFFFF
+
+    def getCharacteristicByHandle(self, handle):
+        # The characteristic declared, or with its value, at handle; the
+        # whole table is listed once if it has not been seen yet
+        ch = self._chars.get(handle)
+        if ch is None and self._allChars is None:
+            self.getCharacteristics()
+            ch = self._chars.get(handle)
+        if ch is None:
+            raise BTLEGattError("No characteristic at handle %X" % handle)
+        return ch
+
+    def _readDescriptors(self, startHnd, endHnd):
         self._writeCmd("desc %X %X\n" % (startHnd, endHnd) )
         # Historical note:
         # Certain Bluetooth LE devices are not capable of sending back all
@@ -523,13 +2177,41 @@ class Peripheral(BluepyHelper):
         # This was broken in earlier versions.
         resp = self._getResp('desc')
         ndesc = len(resp['hnd'])
-        return [Descriptor(self, resp['uuid'][i], resp['hnd'][i]) for i in range(ndesc)]
+        return [(resp['uuid'][i], resp['hnd'][i]) for i in range(ndesc)]
 
-    def readCharacteristic(self, handle):
+    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        rows = self._fromCache('descs', '%X %X' % (startHnd, endHnd),
+                    lambda: self._readDescriptors(startHnd, endHnd))
+        return [Descriptor(self, *row) for row in rows]
+
+    def readCharacteristic(self, handle, max_age=None):
+        values = self._values
+        if max_age is not None and values is not None:
+            val = values.get(handle, max_age)
+            if val is not None:
+                return val
         self._writeCmd("rd %X\n" % handle)
         resp = self._getResp('rd')
+        if values is not None:
+            values.put(handle, resp['d'][0])
         return resp['d'][0]
 
+    def readLong(self, handle, offset=0):
+        # The value from offset on, however many packets it takes: the
+        # helper follows up with Read Blob requests itself. (From the
+        # start, readCharacteristic() does the same.)
+        self._writeCmd("rdl %X %X\n" % (handle, offset))
+        resp = self._getResp(['rd', 'err'])
+        if resp['rsp'][0] == 'rd':
+            if offset == 0 and self._values is not None:
+                self._values.put(handle, resp['d'][0])
+            return resp['d'][0]
+        if resp['code'][0] != 'badcmd':
+            raise BluepyHelper._respError(resp)
+        if offset != 0:
+            raise BTLEInternalError("bluepy-helper can't read from an offset (rebuild it?)", resp)
+        return self.readCharacteristic(handle)
+
     def _readCharacteristicByUUID(self, uuid, startHnd, endHnd):
         # Not used at present
         self._writeCmd("rdu %s %X %X\n" % (UUID(uuid), startHnd, endHnd))
@@ -539,10 +2221,103 @@ class Peripheral(BluepyHelper):
         # Without response, a value too long for one packet will be truncated,
         # but with response, it will be sent as a queued write
         cmd = "wrr" if withResponse else "wr"
+        if self._values is not None:
+            self._values.drop(handle)
         self._writeCmd("%s %X %s\n" % (cmd, handle, binascii.b2a_hex(val).decode('utf-8')))
         return self._getResp('wr')
 
+    def writeStream(self, handle, chunks, window=16):
+        # Writes without response as fast as the link takes them. Each
+        # chunk (or chunks itself, if bytes) is split to fit the ATT MTU,
+        # and up to window writes are in flight at once: bluepy-helper
+        # returns each one's credit when it has gone to the kernel.
+        # Returns the bytes and writes sent, the seconds taken and the
+        # bytes per second.
+        if isinstance(chunks, (bytes, bytearray)):
+            chunks = [chunks]
+        size = self._attMTU() - 3
+        pieces = (chunk[i:i+size] for chunk in chunks
+                                  for i in range(0, len(chunk), size))
+        if self._values is not None:
+            self._values.drop(handle)
+        start = time.time()
+        (nbytes, writes) = (0, 0)
+        if not self._probeStream():
+            # Older helper: one acknowledged write at a time
+            for piece in pieces:
+                self.writeCharacteristic(handle, piece)
+                nbytes += len(piece)
+                writes += 1
+        else:
+            self._sentError = None
+            base = self._sentCount
+            done = False
+            while not done:
+                free = window - (writes - (self._sentCount - base))
+                if free <= 0:
+                    self._waitSent()
+                    continue
+                cmds = []
+                for piece in itertools.islice(pieces, free):
+                    cmds.append("wrs %X %s\n" % (handle, binascii.b2a_hex(piece).decode('ascii')))
+                    nbytes += len(piece)
+                done = len(cmds) < free
+                if cmds:
+                    self._writeCmd("".join(cmds), reply=False)
+                    writes += len(cmds)
+                if self._sentError is not None:
+                    break
+            # Every write sent returns its credit, failed or not; one left
+            # to come would be counted by the next stream
+            while self._sentCount - base < writes:
+                self._waitSent()
+            if self._sentError is not None:
+                raise BTLEGattError("Streamed write failed", self._sentError)
+        elapsed = time.time() - start
+        return { 'bytes' : nbytes, 'writes' : writes, 'seconds' : elapsed,
+                 'bytesPerSec' : nbytes / elapsed if elapsed > 0 else 0.0 }
+
+    def _attMTU(self):
+        if self._mtu is None:
+            self._mtu = self.status().get('mtu', [0])[0] or ATT_DEFAULT_MTU
+        return self._mtu
+
+    def _probeStream(self):
+        # Whether the helper has 'wrs'; older ones reject it as a bad
+        # command, newer ones reject a bare one as a bad parameter
+        if self._streamWrites is None:
+            self._writeCmd("wrs\n")
+            rsp = self._getResp('err')
+            self._streamWrites = (rsp['code'][0] != 'badcmd')
+        return self._streamWrites
+
+    def _waitSent(self):
+        # Waits for another streamed write's credit. No credit comes
+        # for writes dropped on disconnection, so check the link if
+        # none comes for a while.
+        if self._threaded:
+            end = time.time() + 2.0
+            with self._ntfyCond:
+                count = self._sentCount
+                while self._sentCount == count and self._threads is not None:
+                    remain = end - time.time()
+                    if remain <= 0:
+                        break
+                    self._ntfyCond.wait(remain)
+                if self._sentCount != count:
+                    return
+                if self._threads is None:
+                    raise BTLEInternalError("Helper exited")
+        else:
+            rsp = self._getResp('sent', 2.0)
+            if rsp is not None:
+                self._creditReturned(rsp)
+                return
+        if self.getState() != 'conn':
+            raise BTLEDisconnectError("Device disconnected")
+
     def setSecurityLevel(self, level):
+        self._secLevel = level
         self._writeCmd("secu %s\n" % level)
         return self._getResp('stat')
 
@@ -553,12 +2328,53 @@ class Peripheral(BluepyHelper):
         self._mgmtCmd("pair")
 
     def setMTU(self, mtu):
+        self._askedMTU = mtu
         self._writeCmd("mtu %x\n" % mtu)
-        return self._getResp('stat')
+        rsp = self._getResp('stat')
+        self._mtu = rsp.get('mtu', [0])[0] or None
+        return rsp
+
+    def withMTU(self, mtu=ATT_MAX_MTU):
+        # Exchange MTUs on every connect (and now, if connected), for the
+        # largest both sides take up to mtu. None stops it.
+        self._wantMTU = mtu
+        if mtu is not None and self._helper is not None:
+            self._exchangeMTU()
+        return self
+
+    def _exchangeMTU(self):
+        try:
+            self.setMTU(self._wantMTU)
+        except BTLEDisconnectError:
+            raise
+        except BTLEException as e:
+            # Not supported by the peer, or already exchanged
+            DBG("MTU exchange failed:", e)
+        DBG("ATT MTU", self._attMTU())
+
+    def getMTU(self):
+        return self._attMTU()
 
     def waitForNotifications(self, timeout):
-         resp = self._getResp(['ntfy','ind'], timeout)
-         return (resp != None)
+         if self._threaded:
+             sup = self._supervisor
+             if sup is not None and self._session and self._helperDead():
+                 self._recover(sup.generation, BTLEInternalError("Helper exited"))
+             return self._waitDispatched(timeout)
+         end = None if timeout is None else time.time() + timeout
+         while True:
+             # Wake up in time for subscription batches falling due
+             due = self._nextFlush()
+             if due is not None and (end is None or due < end):
+                 resp = self._getResp(['ntfy','ind'], max(0, due - time.time()))
+             else:
+                 resp = self._getResp(['ntfy','ind'], None if end is None else max(0, end - time.time()))
+             if resp is not None:
+                 return True
+             if self._flushDue():
+                 return True
+             if end is not None and time.time() >= end:
+                 return False
     def _setRemoteOOB(self, address, address_type, oob_data, iface=None):
         if self._helper is None:
             self._startHelper(iface)
@@ -629,7 +2445,511 @@ class Peripheral(BluepyHelper):
     def __del__(self):
         self.disconnect()
 
-class ScanEntry:
+# Connection slots in one bluepy-helper; slot 0 is left to the hub itself,
+# and scans on it (see HelperHub.scanner())
+HUB_SLOTS = 8
+# Scan reports kept for a hub's scanner while it isn't being read
+HUB_SCAN_BACKLOG = 4096
+
+class HelperHub(BluepyHelper):
+    """One bluepy-helper shared by several Peripherals"""
+    # hub.peripheral() returns a Peripheral that runs its commands on one
+    # of the helper's connection slots. Responses are sorted by slot, so
+    # views can be used in any order from one thread; a view's
+    # notifications wait until it next waits for a response, or until
+    # hub.waitForNotifications() hands them to its delegate.
+    # hub.scanner() returns a Scanner that scans on the same helper while
+    # the views are connected.
+    def __init__(self, iface=None):
+        BluepyHelper.__init__(self)
+        self.iface = iface
+        self._views = {} # Indexed by slot
+        self._inbox = {} # Responses not yet collected, by slot
+        self._scanner = None
+        self._scanMsgs = collections.deque() # Slot 0's, unparsed, for it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def peripheral(self, deviceAddr=None, addrType=ADDR_TYPE_PUBLIC, iface=None):
+        return _HubPeripheral(self, deviceAddr, addrType, iface)
+
+    def scanner(self):
+        # Scans on the hub's interface; only one scanner runs at a time
+        return _HubScanner(self)
+
+    def close(self):
+        for view in list(self._views.values()):
+            view.disconnect()
+        if self._scanner is not None:
+            self._scanner._stopHelper()
+        self._stopHelper()
+
+    def _startHelper(self, iface=None):
+        if self._helper is not None:
+            return
+        BluepyHelper._startHelper(self, self.iface)
+        # Older helpers reject the slot prefix as a bad command
+        self._writeCmd("@1 stat\n")
+        rsp = self._readResp(['stat', 'err'])
+        if rsp['rsp'][0] != 'stat':
+            self._stopHelper()
+            raise BTLEInternalError("bluepy-helper is out of date, rebuild it: "
+                                    "it has no connection slots", rsp)
+
+    def _openSlot(self, view):
+        self._startHelper()
+        for cid in range(1, HUB_SLOTS):
+            if cid not in self._views:
+                self._views[cid] = view
+                self._inbox[cid] = collections.deque()
+                return cid
+        raise BTLEInternalError("All %d connection slots in use" % (HUB_SLOTS - 1))
+
+    def _closeSlot(self, cid):
+        del self._views[cid]
+        del self._inbox[cid]
+
+    def _openScanner(self, scanner):
+        self._startHelper()
+        if self._scanner is not None and self._scanner is not scanner:
+            raise BTLEInternalError("The hub's helper is already scanning")
+        self._scanner = scanner
+
+    def _closeScanner(self):
+        self._scanner = None
+        self._scanMsgs.clear()
+
+    def _routeMsg(self, msg):
+        # Slot 0's messages (its responses carry no cid) are kept as read
+        # for the scanner, if there is one, which decodes them itself
+        (rspCode, data) = msg
+        if rspCode is None:
+            isScan = data.startswith(_scanLinePrefix)
+        else:
+            isScan = (rspCode == _scanFrameCode)
+        if self._scanner is None or not isScan:
+            resp = BluepyHelper.parseMsg(msg)
+            if self._scanner is None or 'cid' in resp:
+                self._route(resp)
+                return
+        elif len(self._scanMsgs) >= HUB_SCAN_BACKLOG:
+            DBG("Dropped scan report")
+            return
+        self._scanMsgs.append(msg)
+
+    def _nextScanMsg(self):
+        # Next message for the scanner among what has been read, or None
+        while not self._scanMsgs:
+            msg = self._nextMsg()
+            if msg is None:
+                return None
+            self._routeMsg(msg)
+        return self._scanMsgs.popleft()
+
+    def _route(self, resp):
+        respType = resp.get('rsp', [None])[0]
+        if respType == 'scan':
+            return
+        if respType == 'err' and resp['code'][0] == 'connfail':
+            # Follows the 'stat disc' that already reported it
+            return
+        inbox = self._inbox.get(resp.get('cid', [0])[0])
+        if inbox is None:
+            DBG("Dropped:", resp)
+        else:
+            inbox.append(resp)
+
+    def _nextResp(self, cid, timeout=None):
+        # Next response for slot cid, queueing any for other slots.
+        # Returns None on timeout.
+        inbox = self._inbox[cid]
+        while not inbox:
+            msg = self._nextMsg()
+            if msg is None:
+                if not self._readHelper(timeout):
+                    return None
+                continue
+            self._routeMsg(msg)
+        return inbox.popleft()
+
+    def _dispatchQueued(self):
+        found = False
+        for (cid, inbox) in list(self._inbox.items()):
+            if not any(r['rsp'][0] in ('ntfy', 'ind') for r in inbox):
+                continue
+            found = True
+            rest = collections.deque()
+            view = self._views[cid]
+            for resp in inbox:
+                if resp['rsp'][0] not in ('ntfy', 'ind'):
+                    rest.append(resp)
+                else:
+                    view._notified(resp['hnd'][0], resp['d'][0])
+            self._inbox[cid] = rest
+        return found
+
+    def _nextFlush(self):
+        due = None
+        for view in self._views.values():
+            t = view._nextFlush()
+            if t is not None and (due is None or t < due):
+                due = t
+        return due
+
+    def _flushDue(self):
+        delivered = False
+        for view in list(self._views.values()):
+            if view._flushDue():
+                delivered = True
+        return delivered
+
+    def waitForNotifications(self, timeout):
+        # Passes notifications for all views to their delegates
+        if self._dispatchQueued() or self._flushDue():
+            return True
+        if self._helper is None:
+            return False
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            msg = self._nextMsg()
+            if msg is None:
+                due = self._nextFlush()
+                if due is not None and (end is None or due < end):
+                    if not self._readHelper(max(0, due - time.time())):
+                        if self._flushDue():
+                            return True
+                        if end is not None and time.time() >= end:
+                            return False
+                elif not self._readHelper(None if end is None else max(0, end - time.time())):
+                    return False
+                continue
+            self._routeMsg(msg)
+            if self._dispatchQueued():
+                return True
+
+class _HubPeripheral(Peripheral):
+    # A Peripheral holding one connection slot of a HelperHub while
+    # connected
+    def __init__(self, hub, deviceAddr, addrType, iface):
+        self._hub = hub
+        self._cid = None
+        Peripheral.__init__(self, deviceAddr, addrType, iface)
+
+    def _startHelper(self, iface=None):
+        if self._cid is None:
+            self._cid = self._hub._openSlot(self)
+        self._helper = self._hub._helper
+        # Views count into the hub, which sees all of the pipe
+        self._metrics = self._hub._metrics
+
+    def _stopHelper(self):
+        if self._cid is not None:
+            self._hub._closeSlot(self._cid)
+            self._cid = None
+        self._helper = None
+
+    def withSupervision(self, *args, **kwargs):
+        raise BTLEInternalError("Peripherals of a HelperHub share its helper, and can't restart it")
+
+    def _writeCmd(self, cmd, reply=True):
+        if self._helper is None:
+            raise BTLEInternalError("Helper not started (did you call connect()?)")
+        prefix = "@%d " % self._cid
+        self._hub._writeCmd("".join([prefix + line for line in cmd.splitlines(True)]), reply)
+        if reply:
+            # Timed here, where its response is checked
+            (self._local.op, self._hub._local.op) = (self._hub._local.op, None)
+
+    def _waitResp(self, wantType, timeout=None):
+        while True:
+            resp = self._hub._nextResp(self._cid, timeout)
+            if resp is None:
+                return None
+            resp = self._checkResp(resp, wantType)
+            if resp is not None:
+                return resp
+
+class _PoolEntry:
+    # One device in a ConnectionManager: its Peripheral and health
+    def __init__(self, addr, addrType):
+        self.addr = addr
+        self.addrType = addrType
+        self.peripheral = None
+        self.lock = threading.RLock() # Held while connecting or in use
+        self.lastUsed = 0.0
+        self.connects = 0
+        self.failures = 0
+        self.retries = 0 # Failures since the last connect
+        self.lastError = None
+        self.nextAttempt = 0.0
+        self.connectTime = None
+        self.connectedAt = None
+        self.connecting = False # Counts against the pool meanwhile
+        self.leaving = False # Being disconnected to make room
+
+    def connected(self):
+        p = self.peripheral
+        return p is not None and p._helper is not None
+
+class ConnectionManager:
+    """Pooled connections to many Peripherals, by address"""
+    # get() returns a connected Peripheral, reusing the pooled one while
+    # it is still connected; map() connects many devices at once, each
+    # from its own thread with its own bluepy-helper. Failed connects
+    # are retried after a jittered exponential backoff, which carries
+    # over between calls so a missing device isn't hammered. At most
+    # maxConnections are kept: the least recently used idle one is
+    # disconnected to make room.
+    def __init__(self, factory=None, maxConnections=7, retries=3,
+                 backoff=0.5, maxBackoff=30.0, iface=None):
+        # factory(addr, addrType, iface) returns a connected Peripheral
+        # (or subclass); Peripheral by default
+        self.factory = factory if factory is not None else Peripheral
+        self.maxConnections = maxConnections
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.iface = iface
+        self._lock = threading.Lock()
+        self._left = threading.Condition(self._lock) # A device made room
+        self._entries = {} # Indexed by address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _entry(self, addr, addrType):
+        addr = addr.lower()
+        with self._lock:
+            entry = self._entries.get(addr)
+            if entry is None:
+                entry = self._entries[addr] = _PoolEntry(addr, addrType)
+            return entry
+
+    def get(self, addr, addrType=ADDR_TYPE_PUBLIC):
+        entry = self._entry(addr, addrType)
+        with entry.lock:
+            return self._ensure(entry)
+
+    @contextlib.contextmanager
+    def connection(self, addr, addrType=ADDR_TYPE_PUBLIC):
+        # As get(), holding the connection for the with block so it isn't
+        # given up to make room. A disconnect during the block drops it
+        # from the pool.
+        entry = self._entry(addr, addrType)
+        with entry.lock:
+            p = self._ensure(entry)
+            try:
+                yield p
+            except BTLEDisconnectError:
+                self._drop(entry)
+                raise
+            finally:
+                entry.lastUsed = time.time()
+
+    def map(self, fn, addrs, addrType=ADDR_TYPE_PUBLIC):
+        # Runs fn(peripheral) for each address, all at once (up to
+        # maxConnections), and returns the results by address. Where a
+        # device couldn't be connected, or fn raised, the result is the
+        # exception.
+        results = {}
+        slots = threading.Semaphore(self.maxConnections)
+        def work(addr):
+            with slots:
+                try:
+                    with self.connection(addr, addrType) as p:
+                        results[addr] = fn(p)
+                except Exception as e:
+                    results[addr] = e
+        threads = [threading.Thread(target=work, args=(addr,)) for addr in addrs]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def connectAll(self, addrs, addrType=ADDR_TYPE_PUBLIC):
+        return self.map(lambda p: p, addrs, addrType)
+
+    def _alive(self, entry):
+        if not entry.connected() or entry.peripheral._helper.poll() is not None:
+            return False
+        try:
+            return entry.peripheral.getState() == 'conn'
+        except (BTLEException, IOError, OSError):
+            return False
+
+    def _ensure(self, entry):
+        # The entry's Peripheral, connecting it if need be; called with
+        # entry.lock held
+        if self._alive(entry):
+            entry.lastUsed = time.time()
+            return entry.peripheral
+        self._makeRoom(entry)
+        try:
+            return self._connect(entry)
+        finally:
+            entry.connecting = False
+
+    def _connect(self, entry):
+        for attempt in range(self.retries + 1):
+            wait = entry.nextAttempt - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            start = time.time()
+            try:
+                p = entry.peripheral
+                if p is None:
+                    p = self.factory(entry.addr, entry.addrType, self.iface)
+                else:
+                    # A fresh helper, keeping the object (and its delegate)
+                    p._stopHelper()
+                    p.connect(entry.addr, entry.addrType, self.iface)
+            except BTLEException as e:
+                DBG("Connect to", entry.addr, "failed:", e)
+                entry.failures += 1
+                entry.lastError = e
+                delay = min(self.maxBackoff, self.backoff * (2 ** entry.retries))
+                entry.retries += 1
+                entry.nextAttempt = time.time() + delay * random.uniform(0.5, 1.0)
+                continue
+            entry.peripheral = p
+            entry.connects += 1
+            entry.retries = 0
+            entry.nextAttempt = 0.0
+            entry.connectedAt = entry.lastUsed = time.time()
+            entry.connectTime = entry.connectedAt - start
+            return p
+        raise entry.lastError
+
+    def _makeRoom(self, entry):
+        # Disconnects the least recently used idle device while the pool
+        # is full, then holds a place for this one. The pool lock is only
+        # held to choose; disconnecting takes a helper round trip.
+        while True:
+            with self._lock:
+                live = [e for e in self._entries.values()
+                        if e is not entry and (e.connected() or e.connecting)]
+                if len(live) < self.maxConnections:
+                    entry.connecting = True
+                    return
+                victim = None
+                for e in sorted(live, key=lambda e: e.lastUsed):
+                    if not e.leaving and e.lock.acquire(False):
+                        victim = e
+                        break
+                if victim is None:
+                    if any(e.leaving for e in live):
+                        # Room is on its way
+                        self._left.wait()
+                        continue
+                    raise BTLEInternalError("All %d connections in use" % self.maxConnections)
+                # Still counted until it is gone, but not chosen again
+                victim.leaving = True
+                victim.connectedAt = None
+            try:
+                self._drop(victim)
+            finally:
+                with self._lock:
+                    victim.leaving = False
+                    self._left.notify_all()
+                victim.lock.release()
+
+    def _drop(self, entry):
+        p = entry.peripheral
+        entry.connectedAt = None
+        if p is None:
+            return
+        # disconnect() drops the delegate, which a reconnect should keep
+        delegate = p.delegate
+        try:
+            if p._helper is not None and p._helper.poll() is None:
+                p.disconnect()
+        except BTLEException:
+            pass
+        p._stopHelper()
+        p.withDelegate(delegate)
+
+    def release(self, addr):
+        # Disconnects a device, keeping its health record
+        entry = self._entries.get(addr.lower())
+        if entry is not None:
+            with entry.lock:
+                self._drop(entry)
+
+    def close(self):
+        for entry in list(self._entries.values()):
+            with entry.lock:
+                self._drop(entry)
+
+    def health(self):
+        # By address: whether connected, connects and failed attempts so
+        # far, the last error, seconds until the next attempt is allowed,
+        # how long the last connect took and how long it has been up
+        now = time.time()
+        report = {}
+        for (addr, e) in list(self._entries.items()):
+            report[addr] = {
+                'connected' : e.connected(),
+                'connects' : e.connects,
+                'failures' : e.failures,
+                'lastError' : None if e.lastError is None else str(e.lastError),
+                'retryIn' : max(0.0, e.nextAttempt - now),
+                'connectTime' : e.connectTime,
+                'uptime' : None if e.connectedAt is None else now - e.connectedAt,
+            }
+        return report
+
+_adCache = {}
+
+def _splitAD(data):
+    # AD structures in an advertising payload, as ((sdid, value), ...).
+    # Devices repeat the same few payloads, so each is split once.
+    ad = _adCache.get(data)
+    if ad is None:
+        items = []
+        pos = 0
+        while len(data) - pos >= 2:
+            sdlen, sdid = struct.unpack_from('<BB', data, pos)
+            items.append((sdid, data[pos + 2 : pos + sdlen + 1]))
+            pos += sdlen + 1
+        ad = tuple(items)
+        if len(_adCache) >= 4096:
+            _adCache.clear()
+        _adCache[data] = ad
+    return ad
+
+_adConflicts = {}
+
+def _adConflict(a, b):
+    # Whether payloads a and b give some AD type different values
+    key = (a, b)
+    c = _adConflicts.get(key)
+    if c is None:
+        vals = dict(_splitAD(a))
+        c = any(vals.get(sdid, val) != val for (sdid, val) in dict(_splitAD(b)).items())
+        if len(_adConflicts) >= 4096:
+            _adConflicts.clear()
+        _adConflicts[key] = c
+    return c
+
+# AD types holding service UUIDs, and how wide they are
+_adUUIDWidths = { 0x02 : 2, 0x03 : 2, 0x04 : 4, 0x05 : 4, 0x06 : 16, 0x07 : 16,
+                  0x16 : 2, 0x20 : 4, 0x21 : 16 }
+_adServiceData = (0x16, 0x20, 0x21)
+
+class ScanEntry(object):
+    __slots__ = ('addr', 'iface', 'addrType', 'rssi', 'connectable',
+                 'rawData', 'updateCount', '_payloads', '_base', '_scanData',
+                 '_values', '_scanList')
+
     addrTypes = { 1 : ADDR_TYPE_PUBLIC,
                   2 : ADDR_TYPE_RANDOM
                 }
@@ -687,33 +3007,73 @@ class ScanEntry:
         self.rssi = None
         self.connectable = False
         self.rawData = None
-        self.scanData = {}
         self.updateCount = 0
+        self._payloads = {}   # data -> updateCount when last seen, first seen first
+        self._base = {}       # What payloads dropped from _payloads held
+        self._scanData = None # Merged from the two above by scanData
+        self._values = {}     # Decoded by getValue()
+        self._scanList = None # getScanData()
 
     def _update(self, resp):
-        addrType = self.addrTypes.get(resp['type'][0], None)
+        return self._updateFrom(resp['type'][0], resp['rssi'][0],
+                                resp['flag'][0], resp.get('d', [b''])[0])
+
+    def _updateFrom(self, rawType, rawRssi, flag, data):
+        addrType = self.addrTypes.get(rawType, None)
         if (self.addrType is not None) and (addrType != self.addrType):
             raise BTLEInternalError("Address type changed during scan, for address %s" % self.addr)
         self.addrType = addrType
-        self.rssi = -resp['rssi'][0]
-        self.connectable = ((resp['flag'][0] & 0x4) == 0)
-        data = resp.get('d', [''])[0]
+        self.rssi = -rawRssi
+        self.connectable = ((flag & 0x4) == 0)
+        self.updateCount += 1
+        if data == self.rawData:
+            return False
         self.rawData = data
-        
+
         # Note: bluez is notifying devices twice: once with advertisement data,
         # then with scan response data. Also, the device may update the
-        # advertisement or scan data
-        isNewData = False
-        while len(data) >= 2:
-            sdlen, sdid = struct.unpack_from('<BB', data)
-            val = data[2 : sdlen + 1]
-            if (sdid not in self.scanData) or (val != self.scanData[sdid]):
-                isNewData = True
-            self.scanData[sdid] = val
-            data = data[sdlen + 1:]
-
-        self.updateCount += 1
+        # advertisement or scan data. Payloads are kept as they came and
+        # only split into scanData when it is read.
+        payloads = self._payloads
+        seen = payloads.get(data)
+        if seen is not None:
+            # New data only if a payload since changed one of its values
+            isNewData = False
+            for (other, when) in payloads.items():
+                if when > seen:
+                    conflict = _adConflicts.get((data, other))
+                    if conflict is None:
+                        conflict = _adConflict(data, other)
+                    if conflict:
+                        isNewData = True
+                        break
+        else:
+            if len(payloads) >= 4:
+                self._base = self.scanData
+                payloads.clear()
+            isNewData = True
+        payloads[data] = self.updateCount
+        if isNewData:
+            self._scanData = None
+            self._values = {}
+            self._scanList = None
         return isNewData
+
+    @property
+    def scanData(self):
+        # AD type -> value, from every payload; the latest one to hold a
+        # type gives its value
+        if self._scanData is None:
+            payloads = self._payloads
+            vals = {}
+            for data in sorted(payloads, key=payloads.get):
+                vals.update(_splitAD(data))
+            scanData = dict(self._base)
+            for data in payloads:
+                for (sdid, val) in _splitAD(data):
+                    scanData[sdid] = vals[sdid]
+            self._scanData = scanData
+        return self._scanData
      
     def _decodeUUID(self, val, nbytes):
         if len(val) < nbytes:
@@ -736,6 +3096,13 @@ class ScanEntry:
         return self.dataTags.get(sdid, hex(sdid))
 
     def getValue(self, sdid):
+        val = self._values.get(sdid, self)
+        if val is self:
+            val = self._decodeValue(sdid)
+            self._values[sdid] = val
+        return list(val) if isinstance(val, list) else val
+
+    def _decodeValue(self, sdid):
         val = self.scanData.get(sdid, None)
         if val is None:
             return None
@@ -770,8 +3137,10 @@ class ScanEntry:
     
     def getScanData(self):
         '''Returns list of tuples [(tag, description, value)]'''
-        return [ (sdid, self.getDescription(sdid), self.getValueText(sdid))
-                    for sdid in self.scanData.keys() ]
+        if self._scanList is None:
+            self._scanList = [ (sdid, self.getDescription(sdid), self.getValueText(sdid))
+                                for sdid in self.scanData.keys() ]
+        return list(self._scanList)
          
  
 class Scanner(BluepyHelper):
@@ -780,14 +3149,70 @@ class Scanner(BluepyHelper):
         self.scanned = {}
         self.iface=iface
         self.passive=False
+        self._addrNames = {}
+        self._mgmtPending = collections.deque()
+        self._gapStart = None
+        self._resetStats()
+        self._filter = None
+        self._filterSeen = set()
+        self._helperFilters = False
+        self._scanParams = None
     
     def _cmd(self):
-        return "pasv" if self.passive else "scan"
+        # The kernel runs 'scan' with its own parameters; 'pasv' is run by
+        # the helper on HCI, and can take ours
+        return "pasv" if (self.passive or self._scanParams is not None) else "scan"
+
+    def setScanParameters(self, interval=None, window=None, filterDuplicates=False,
+                          ownAddrType=ADDR_TYPE_PUBLIC):
+        # Scan interval and window in milliseconds (2.5 to 10240, the
+        # window no longer than the interval), whether the controller
+        # drops duplicate adverts, and the address type of scan requests.
+        # Takes effect from the next start(). Scans with parameters need
+        # the same privileges as passive ones. No arguments restores the
+        # kernel's own scanning.
+        if interval is None and window is None and not filterDuplicates and \
+                ownAddrType == ADDR_TYPE_PUBLIC:
+            self._scanParams = None
+            return self
+        if ownAddrType not in (ADDR_TYPE_PUBLIC, ADDR_TYPE_RANDOM):
+            raise ValueError("Expected address type public or random, got {}".format(ownAddrType))
+        if interval is None:
+            interval = 10.0 if window is None else window
+        interval = int(round(interval / 0.625))
+        window = interval if window is None else int(round(window / 0.625))
+        if not (0x0004 <= window <= interval <= 0x4000):
+            raise ValueError("Scan window and interval must satisfy "
+                             "2.5 <= window <= interval <= 10240 (ms)")
+        self._scanParams = (interval, window, bool(filterDuplicates), ownAddrType)
+        return self
+
+    def _scanParamsCmd(self):
+        (interval, window, dup, own) = self._scanParams
+        return "scanp active=%d interval=0x%X window=0x%X dup=%d own=%s" % (
+                    0 if self.passive else 1, interval, window, dup, own)
+
+    def _setScanParams(self):
+        try:
+            self._mgmtCmd(self._scanParamsCmd())
+        except BTLEManagementError:
+            raise
+        except BTLEException:
+            self._stopHelper()
+            raise BTLEInternalError("bluepy-helper can't set scan parameters (rebuild it?)")
 
     def start(self, passive=False):
         self.passive = passive
+        self._mgmtPending.clear()
+        self._gapStart = None
+        self._resetStats()
         self._startHelper(iface=self.iface)
         self._mgmtCmd("le on")
+        self._helperFilters = self._probeFilter()
+        if not self._helperFilters and self._filter is not None:
+            _helperLacks("advert filtering", "adverts are filtered in Python")
+        if self._scanParams is not None:
+            self._setScanParams()
         self._writeCmd(self._cmd()+"\n")
         rsp = self._waitResp("mgmt")
         if rsp["code"][0] == "success":
@@ -800,53 +3225,526 @@ class Scanner(BluepyHelper):
             self._mgmtCmd(self._cmd())
 
     def stop(self):
-        self._mgmtCmd(self._cmd()+"end")
+        # Replies to scan restarts still in flight come before the one to
+        # 'scanend', and the controller may report 'disc' at any point
+        cmd = self._cmd()+"end"
+        self._sendScanCmd(cmd)
+        while self._mgmtPending:
+            rsp = self._waitResp(['mgmt', 'stat'])
+            if rsp['rsp'][0] != 'mgmt':
+                continue
+            if self._mgmtPending.popleft() == cmd and rsp['code'][0] != 'success':
+                self._stopHelper()
+                raise BTLEManagementError("Failed to execute management command '%s'" % (cmd), rsp)
         self._stopHelper()
 
     def clear(self):
         self.scanned = {}
 
-    def process(self, timeout=10.0):
+    def _addrName(self, key, hexAddr):
+        # Addresses repeat constantly while scanning, so the formatted
+        # string is kept (interned) per raw address
+        addr = self._addrNames.get(key)
+        if addr is None:
+            if len(self._addrNames) >= 4096:
+                self._addrNames.clear()
+            h = hexAddr.decode('ascii').lower()
+            addr = intern(str(':'.join([h[i:i+2] for i in range(0,12,2)])))
+            self._addrNames[key] = addr
+        return addr
+
+    def _scanRecord(self, msg):
+        # Decodes a scan report straight into an
+        # (addr, type, rssi, flag, data) record, without building a
+        # response dict. Returns None for anything else, including scan
+        # reports laid out differently, which take the parseMsg() path.
+        (rspCode, data) = msg
+        if rspCode is None:
+            if not data.startswith(_scanLinePrefix):
+                return None
+            fields = data.split(b'\x1e')
+            if (len(fields) < 5 or fields[1][:6] != b'addr=b' or
+                    fields[2][:6] != b'type=h' or fields[3][:6] != b'rssi=h' or
+                    fields[4][:6] != b'flag=h'):
+                return None
+            if len(fields) > 5:
+                if fields[5][:3] != b'd=b':
+                    return None
+                d = binascii.a2b_hex(fields[5][3:])
+            else:
+                d = b''
+            return (self._addrName(fields[1], fields[1][6:]),
+                    int(fields[2][6:], 16), int(fields[3][6:], 16),
+                    int(fields[4][6:], 16), d)
+
+        if rspCode != _scanFrameCode or len(data) < _scanFrame.size:
+            return None
+        (ha, rawAddr, ht, addrType, hr, rssi, hf, flag) = _scanFrame.unpack_from(data)
+        if (ha, ht, hr, hf) != _scanFrameHdrs:
+            return None
+        d = b''
+        if len(data) > _scanFrame.size:
+            (tag, vtype, dlen) = _frameItem.unpack_from(data, _scanFrame.size)
+            if tag != _scanFrameData or vtype != _VT_DATA:
+                return None
+            pos = _scanFrame.size + _frameItem.size
+            d = data[pos:pos+dlen]
+        return (self._addrName(rawAddr, binascii.b2a_hex(rawAddr)),
+                addrType, rssi, flag, d)
+
+    def _respRecord(self, resp):
+        # Same record as _scanRecord(), from a parsed 'scan' response
+        rawAddr = resp['addr'][0]
+        return (self._addrName(rawAddr, binascii.b2a_hex(rawAddr)),
+                resp['type'][0], resp['rssi'][0], resp['flag'][0],
+                resp.get('d', [b''])[0])
+
+    def _foundDevice(self, rec):
+        # Updates the ScanEntry for a scan record and tells the delegate.
+        # Returns (entry, isNewDev, isNewData).
+        (addr, addrType, rssi, flag, data) = rec
+        dev = self.scanned.get(addr)
+        if dev is None:
+            dev = ScanEntry(addr, self.iface)
+            self.scanned[addr] = dev
+        isNewData = dev._updateFrom(addrType, rssi, flag, data)
+        isNewDev = (dev.updateCount <= 1)
+        if self.delegate is not None:
+            self.delegate.handleDiscovery(dev, isNewDev, isNewData)
+        return (dev, isNewDev, isNewData)
+
+    def setFilter(self, addresses=None, min_rssi=None, service_uuids=None,
+                  connectable_only=False):
+        # Report only devices that are in addresses, at least min_rssi
+        # strong, advertising one of service_uuids, and connectable, as
+        # given; no arguments reports everything. Where bluepy-helper
+        # supports it the filter is applied there, so other adverts never
+        # reach Python.
+        addrs = frozenset(a.lower() for a in addresses) if addresses else None
+        uuids = frozenset(UUID(u) for u in service_uuids) if service_uuids else None
+        if addrs is None and min_rssi is None and uuids is None and not connectable_only:
+            self._filter = None
+        else:
+            self._filter = (addrs, min_rssi, uuids, bool(connectable_only))
+        self._filterSeen = set()
+        if self._helper is not None and self._helperFilters:
+            self._sendScanCmd(self._filterCmd())
+        return self
+
+    def _filterCmd(self):
+        if self._filter is None:
+            return "filt"
+        (addrs, minRssi, uuids, connOnly) = self._filter
+        cmd = ["filt"]
+        if minRssi is not None:
+            cmd.append("rssi=%d" % minRssi)
+        if connOnly:
+            cmd.append("conn=1")
+        if addrs:
+            cmd.append("addr=" + ",".join(sorted(addrs)))
+        if uuids:
+            cmd.append("uuid=" + ",".join(sorted(binascii.b2a_hex(u.binVal).decode('ascii')
+                                                   for u in uuids)))
+        return " ".join(cmd)
+
+    def _probeFilter(self):
+        # Sets the helper's filter; False if it's too old to have one
+        self._writeCmd(self._filterCmd() + "\n")
+        try:
+            rsp = self._waitResp('mgmt')
+        except BTLEException as e:
+            DBG("Helper can't filter adverts:", e)
+            return False
+        if rsp['code'][0] != 'success':
+            raise BTLEManagementError("Bad advert filter", rsp)
+        return True
+
+    def _passes(self, rec):
+        # The filter as bluepy-helper applies it, for older helpers and
+        # for reports already on their way when it changes
+        (addrs, minRssi, uuids, connOnly) = self._filter
+        (addr, addrType, rawRssi, flag, data) = rec
+        if minRssi is not None and -rawRssi < minRssi:
+            return False
+        if connOnly and (flag & 0x4):
+            return False
+        if addrs is not None and addr not in addrs:
+            return False
+        if uuids is not None and addr not in self._filterSeen:
+            if not any(u in uuids for u in self._advertisedUUIDs(data)):
+                return False
+            # Let its scan responses through from now on
+            if len(self._filterSeen) >= 4096:
+                self._filterSeen.clear()
+            self._filterSeen.add(addr)
+        return True
+
+    @staticmethod
+    def _advertisedUUIDs(data):
+        for (sdid, val) in _splitAD(data):
+            width = _adUUIDWidths.get(sdid)
+            if width is None:
+                continue
+            if sdid in _adServiceData:
+                val = val[:width]
+            for i in range(0, len(val) - width + 1, width):
+                chunk = val[i:i+width]
+                if width == 16:
+                    yield UUID(chunk[::-1])
+                else:
+                    yield UUID(struct.unpack('<H' if width == 2 else '<I', chunk)[0])
+
+    def _resetStats(self):
+        self._stats = { 'reports' : 0, 'restarts' : 0, 'gapLast' : 0.0,
+                        'gapMax' : 0.0, 'gapTotal' : 0.0 }
+
+    def _restartScan(self):
+        # The controller stopped scanning (it does so every few seconds).
+        # Ask for it again without waiting for the reply, so reports
+        # keep being read meanwhile; _scanMgmt() handles the reply.
+        if self._gapStart is None:
+            self._gapStart = time.time()
+        self._stats['restarts'] += 1
+        self._sendScanCmd(self._cmd())
+
+    def _sendScanCmd(self, cmd):
+        self._writeCmd(cmd + "\n")
+        self._mgmtPending.append(cmd)
+
+    def _scanMgmt(self, resp):
+        # Reply to a command sent by _sendScanCmd()
+        cmd = self._mgmtPending.popleft() if self._mgmtPending else None
+        code = resp['code'][0]
+        if cmd is not None and cmd.startswith("filt"):
+            if code != 'success':
+                # The helper has dropped its filter, leaving _passes()
+                DBG("Helper rejected", cmd)
+                warnings.warn("bluepy-helper rejected the advert filter (%s), so adverts "
+                              "are filtered in Python" % code, RuntimeWarning)
+            return
+        if cmd != self._cmd():
+            return
+        if code == 'success':
+            if self._gapStart is not None:
+                gap = time.time() - self._gapStart
+                self._gapStart = None
+                st = self._stats
+                st['gapLast'] = gap
+                st['gapTotal'] += gap
+                st['gapMax'] = max(st['gapMax'], gap)
+        elif code == 'busy':
+            # Previous scan still winding down; ending it brings another
+            # 'disc', which restarts it
+            self._sendScanCmd(self._cmd()+"end")
+        else:
+            self._stopHelper()
+            raise BTLEManagementError("Failed to restart scan", resp)
+
+    def _nextScanRecord(self, deadline=None):
+        # Reads until the next scan record, restarting the scan whenever
+        # it ends. Returns None once the deadline (a time.time() value)
+        # has passed.
+        while True:
+            rec = self._bufferedRecord()
+            if rec is not None:
+                return rec
+            if deadline is not None:
+                remain = deadline - time.time()
+                if remain <= 0.0:
+                    return None
+            else:
+                remain = None
+            if not self._readHelper(remain):
+                return None
+
+    def _bufferedRecord(self):
+        # The next scan record among what has been read from the helper,
+        # or None if more must be read first
+        while True:
+            msg = self._nextMsg()
+            if msg is None:
+                return None
+
+            rec = self._scanRecord(msg)
+            if rec is None:
+                resp = self._checkResp(BluepyHelper.parseMsg(msg), ['scan', 'stat', 'mgmt'])
+                if resp is None:
+                    continue
+
+                respType = resp['rsp'][0]
+                if respType == 'stat':
+                    # if scan ended, restart it
+                    if resp['state'][0] == 'disc':
+                        self._restartScan()
+                    continue
+                if respType == 'mgmt':
+                    self._scanMgmt(resp)
+                    continue
+
+                rec = self._respRecord(resp)
+
+            self._metrics.adverts += 1
+            if self._filter is not None and not self._passes(rec):
+                continue
+            self._stats['reports'] += 1
+            return rec
+
+    def _checkScanning(self):
         if self._helper is None:
             raise BTLEInternalError(
                                 "Helper not started (did you call start()?)")
-        start = time.time()
+        if self._threaded:
+            raise BTLEInternalError("Scanner reads the helper itself; "
+                                    "don't use withReaderThread()")
+
+    def process(self, timeout=10.0):
+        self._checkScanning()
+        deadline = (time.time() + timeout) if timeout else None
         while True:
-            if timeout:
-                remain = start + timeout - time.time()
-                if remain <= 0.0: 
-                    break
-            else:
-                remain = None
-            resp = self._waitResp(['scan', 'stat'], remain)
-            if resp is None:
+            rec = self._nextScanRecord(deadline)
+            if rec is None:
                 break
+            self._foundDevice(rec)
+
+    def updates(self, idle=None):
+        # Yields the ScanEntry for every scan report, for as long as the
+        # scanner runs; start() it once and keep reading. With idle set,
+        # yields None after that many seconds without a report, so the
+        # caller gets a chance to do other work.
+        self._checkScanning()
+        while self._helper is not None:
+            deadline = (time.time() + idle) if idle else None
+            rec = self._nextScanRecord(deadline)
+            if rec is None:
+                yield None
+            else:
+                yield self._foundDevice(rec)[0]
 
-            respType = resp['rsp'][0]
-            if respType == 'stat':
-                # if scan ended, restart it
-                if resp['state'][0] == 'disc':
-                    self._mgmtCmd(self._cmd())
-
-            elif respType == 'scan':
-                # device found
-                addr = binascii.b2a_hex(resp['addr'][0]).decode('utf-8')
-                addr = ':'.join([addr[i:i+2] for i in range(0,12,2)])
-                if addr in self.scanned:
-                    dev = self.scanned[addr]
-                else:
-                    dev = ScanEntry(addr, self.iface)
-                    self.scanned[addr] = dev
-                isNewData = dev._update(resp)
-                if self.delegate is not None:
-                    self.delegate.handleDiscovery(dev, (dev.updateCount <= 1), isNewData)
-                 
+    def scanStats(self):
+        # Counts since start(): scan reports read, scan restarts, and the
+        # time scanning was off while restarting (seconds)
+        return dict(self._stats)
+
+    def getDevices(self):
+        return self.scanned.values()
+
+    def getDeviceTable(self):
+        # The scanned devices as columns, row i of each being the same
+        # device: 'addr' (a list), and arrays 'rssi', 'connectable' and
+        # 'updateCount'
+        devs = list(self.scanned.values())
+        return { 'addr' : [dev.addr for dev in devs],
+                 'rssi' : array.array('h', [dev.rssi for dev in devs]),
+                 'connectable' : array.array('B', [dev.connectable for dev in devs]),
+                 'updateCount' : array.array('I', [dev.updateCount for dev in devs]) }
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.start(passive=passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
+
+
+class _HubScanner(Scanner):
+    # A Scanner on slot 0 of a HelperHub, sharing its helper with the
+    # hub's connections
+    def __init__(self, hub):
+        Scanner.__init__(self, 0 if hub.iface is None else hub.iface)
+        self._hub = hub
+
+    def _startHelper(self, iface=None):
+        self._hub._openScanner(self)
+        self._helper = self._hub._helper
+        self._metrics = self._hub._metrics
+
+    def _stopHelper(self):
+        # Leaves the hub's helper running
+        if self._hub._scanner is self:
+            self._hub._closeScanner()
+        self._helper = None
+
+    def _writeCmd(self, cmd, reply=True):
+        if self._helper is None:
+            raise BTLEInternalError("Helper not started (did you call start()?)")
+        self._hub._writeCmd(cmd, reply)
+        if reply:
+            (self._local.op, self._hub._local.op) = (self._hub._local.op, None)
+
+    def _checkResp(self, resp, wantType):
+        # Slot 0 never connects: a 'stat' it isn't waiting for only says
+        # that scanning stopped, maybe for an earlier scanner
+        if resp.get('rsp', [None])[0] == 'stat' and 'stat' not in wantType:
+            return None
+        return Scanner._checkResp(self, resp, wantType)
+
+    def _nextMsg(self):
+        return self._hub._nextScanMsg()
+
+    def _readHelper(self, timeout=None):
+        return self._hub._readHelper(timeout)
+
+
+class MultiScanner:
+    """Scans on several adapters at once, merging what they see"""
+    # Runs a Scanner (and so a bluepy-helper) per hciN and reads them all
+    # from one loop. Devices are kept once, by address: a device's rssi
+    # is the strongest reading any adapter has made of it within
+    # maxAge seconds, and its iface the adapter that made it.
+    def __init__(self, ifaces=(0, 1), maxAge=5.0):
+        if not ifaces:
+            raise ValueError("Need at least one adapter")
+        self.scanners = [Scanner(iface) for iface in ifaces]
+        self.maxAge = maxAge
+        self.scanned = {}
+        self.delegate = DefaultDelegate()
+        self._readings = {} # Indexed by address, then iface: (rssi, time)
+        self._poller = None
+        self._byFd = {}
+        self._next = 0
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def setFilter(self, *args, **kwargs):
+        for sc in self.scanners:
+            sc.setFilter(*args, **kwargs)
+        return self
+
+    def setScanParameters(self, *args, **kwargs):
+        for sc in self.scanners:
+            sc.setScanParameters(*args, **kwargs)
+        return self
+
+    def start(self, passive=False):
+        started = []
+        try:
+            for sc in self.scanners:
+                sc.start(passive=passive)
+                started.append(sc)
+        except:
+            for sc in started:
+                sc._stopHelper()
+            raise
+        self._poller = select.poll()
+        self._byFd = {}
+        for sc in self.scanners:
+            fd = sc._helper.stdout.fileno()
+            self._byFd[fd] = sc
+            self._poller.register(fd, select.POLLIN)
+
+    def stop(self):
+        self._poller = None
+        error = None
+        for sc in self.scanners:
+            try:
+                sc.stop()
+            except BTLEException as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def clear(self):
+        self.scanned = {}
+        self._readings = {}
+
+    def _nextScanRecord(self, deadline=None):
+        # As Scanner._nextScanRecord(), from whichever adapter has a
+        # record ready; returns (scanner, record). Adapters take turns
+        # so a busy one can't hold up the others.
+        scanners = self.scanners
+        while True:
+            for i in range(len(scanners)):
+                sc = scanners[(self._next + i) % len(scanners)]
+                rec = sc._bufferedRecord()
+                if rec is not None:
+                    self._next = (self._next + i + 1) % len(scanners)
+                    return (sc, rec)
+            if deadline is not None:
+                remain = deadline - time.time()
+                if remain <= 0.0:
+                    return None
+                fds = self._poller.poll(remain * 1000)
+            else:
+                fds = self._poller.poll()
+            if not fds:
+                return None
+            for (fd, event) in fds:
+                self._byFd[fd]._readHelper(0)
+
+    def _foundDevice(self, sc, rec):
+        (addr, addrType, rawRssi, flag, data) = rec
+        now = time.time()
+        readings = self._readings.get(addr)
+        if readings is None:
+            readings = self._readings[addr] = {}
+        readings[sc.iface] = (-rawRssi, now)
+        (best, bestIface) = (-rawRssi, sc.iface)
+        for (iface, (rssi, when)) in readings.items():
+            if rssi > best and now - when <= self.maxAge:
+                (best, bestIface) = (rssi, iface)
+        dev = self.scanned.get(addr)
+        if dev is None:
+            dev = ScanEntry(addr, bestIface)
+            self.scanned[addr] = dev
+        isNewData = dev._updateFrom(addrType, rawRssi, flag, data)
+        dev.rssi = best
+        dev.iface = bestIface
+        isNewDev = (dev.updateCount <= 1)
+        if self.delegate is not None:
+            self.delegate.handleDiscovery(dev, isNewDev, isNewData)
+        return (dev, isNewDev, isNewData)
+
+    def _checkScanning(self):
+        if self._poller is None:
+            raise BTLEInternalError("Scanners not started (did you call start()?)")
+
+    def process(self, timeout=10.0):
+        self._checkScanning()
+        deadline = (time.time() + timeout) if timeout else None
+        while True:
+            found = self._nextScanRecord(deadline)
+            if found is None:
+                break
+            self._foundDevice(*found)
+
+    def updates(self, idle=None):
+        # As Scanner.updates()
+        self._checkScanning()
+        while self._poller is not None:
+            deadline = (time.time() + idle) if idle else None
+            found = self._nextScanRecord(deadline)
+            if found is None:
+                yield None
             else:
-                raise BTLEInternalError("Unexpected response: " + respType, resp)
+                yield self._foundDevice(*found)[0]
+
+    def getRssi(self, addr):
+        # Each adapter's latest reading of a device, by iface, leaving
+        # out those older than maxAge
+        now = time.time()
+        return dict((iface, rssi) for (iface, (rssi, when))
+                    in self._readings.get(addr, {}).items()
+                    if now - when <= self.maxAge)
+
+    def scanStats(self):
+        # Scanner.scanStats() for each adapter, by iface
+        return dict((sc.iface, sc.scanStats()) for sc in self.scanners)
 
     def getDevices(self):
         return self.scanned.values()
 
+    def getDeviceTable(self):
+        # As Scanner.getDeviceTable(), plus 'iface', each device's best
+        # adapter
+        devs = list(self.scanned.values())
+        return { 'addr' : [dev.addr for dev in devs],
+                 'rssi' : array.array('h', [dev.rssi for dev in devs]),
+                 'iface' : array.array('H', [dev.iface for dev in devs]),
+                 'connectable' : array.array('B', [dev.connectable for dev in devs]),
+                 'updateCount' : array.array('I', [dev.updateCount for dev in devs]) }
+
     def scan(self, timeout=10, passive=False):
         self.clear()
         self.start(passive=passive)
@@ -861,24 +3759,116 @@ def capitaliseName(descr):
     capWords += [ w[0:1].upper() + w[1:].lower() for w in words[1:] ]
     return "".join(capWords)
 
-class _UUIDNameMap:
-    # Constructor sets self.currentTimeService, self.txPower, and so on
-    # from names.
-    def __init__(self, idList):
-        self.idMap = {}
+# Assigned numbers index: a compact form of uuids.json, written next to
+# it as uuids.idx and rebuilt whenever the JSON file's size or mtime
+# changes. After the header come the numbers (sorted) and, for each
+# attribute name (sorted), the number's position times two plus 1 if
+# it comes from the long name. Then three newline-separated lists:
+# short names and long names in number order, and attribute names.
+_NAMES_MAGIC = b'BPAN'
+_namesHeader = struct.Struct('<4sHIIIIIQd')
+
+def _buildNameIndex(jsonFile, size, mtime):
+    with open(jsonFile, "rb") as fp:
+        uuid_data = json.loads(fp.read().decode("utf-8"))
+    entries = {}
+    attrs = {}
+    for k in uuid_data.keys():
+        for number,cname,name in uuid_data[k]:
+            entries[number] = (cname, name)
+            # Later entries win, as they did when these were attributes
+            attrs[capitaliseName(cname)] = (number, 0)
+            attrs[capitaliseName(name)] = (number, 1)
+    numbers = sorted(entries)
+    pos = dict((n, i) for (i, n) in enumerate(numbers))
+    attrNames = sorted(attrs)
+    cnames = '\n'.join([entries[n][0] for n in numbers]).encode('utf-8')
+    names = '\n'.join([entries[n][1] for n in numbers]).encode('utf-8')
+    attrList = '\n'.join(attrNames).encode('utf-8')
+    refs = [pos[attrs[a][0]]*2 + attrs[a][1] for a in attrNames]
+    return b''.join([
+        _namesHeader.pack(_NAMES_MAGIC, 1, len(numbers), len(refs),
+                          len(cnames), len(names), len(attrList), size, mtime),
+        struct.pack('<%dI' % len(numbers), *numbers),
+        struct.pack('<%dI' % len(refs), *refs),
+        cnames, names, attrList ])
+
+def _loadNameIndex(jsonFile, indexFile):
+    # Returns the index data for jsonFile, rebuilding it if need be
+    st = os.stat(jsonFile)
+    try:
+        with open(indexFile, "rb") as fp:
+            data = fp.read()
+        hdr = _namesHeader.unpack_from(data)
+        if (hdr[0], hdr[1], hdr[7], hdr[8]) == (_NAMES_MAGIC, 1, st.st_size, st.st_mtime):
+            return data
+    except (IOError, OSError, struct.error):
+        pass
+    DBG("Rebuilding", indexFile)
+    data = _buildNameIndex(jsonFile, st.st_size, st.st_mtime)
+    try:
+        tmp = indexFile + '.%d' % os.getpid()
+        with open(tmp, "wb") as fp:
+            fp.write(data)
+        os.rename(tmp, indexFile)
+    except (IOError, OSError):
+        pass # Read-only install: just use it this time
+    return data
 
-        for uuid in idList:
-            attrName = capitaliseName(uuid.commonName)
-            vars(self) [attrName] = uuid
-            self.idMap[uuid] = uuid
+class _UUIDNameMap:
+    # Gives self.currentTimeService, self.txPower, and so on from names,
+    # looked up in the assigned numbers index. Nothing is read until
+    # first used.
+    def __init__(self, jsonFile, indexFile):
+        self._files = (jsonFile, indexFile)
+        self._numbers = None
+
+    def _load(self):
+        data = _loadNameIndex(*self._files)
+        (_, _, nNums, nAttrs, lcn, ln, la, _, _) = _namesHeader.unpack_from(data)
+        pos = _namesHeader.size
+        self._numbers = struct.unpack_from('<%dI' % nNums, data, pos)
+        pos += 4 * nNums
+        self._refs = struct.unpack_from('<%dI' % nAttrs, data, pos)
+        pos += 4 * nAttrs
+        self._cnames = data[pos:pos+lcn].decode('utf-8').split('\n')
+        pos += lcn
+        self._names = data[pos:pos+ln].decode('utf-8').split('\n')
+        pos += ln
+        self._attrs = data[pos:pos+la].decode('utf-8').split('\n')
+
+    def _uuid(self, ref):
+        i = ref >> 1
+        return UUID(self._numbers[i], (self._names if ref & 1 else self._cnames)[i])
+
+    def __getattr__(self, attrName):
+        if attrName.startswith('_'):
+            raise AttributeError(attrName)
+        if self._numbers is None:
+            self._load()
+        if attrName == 'idMap':
+            uuids = [self._uuid(2*i + 1) for i in range(len(self._numbers))]
+            val = dict((u, u) for u in uuids)
+        else:
+            i = bisect.bisect_left(self._attrs, attrName)
+            if i == len(self._attrs) or self._attrs[i] != attrName:
+                raise AttributeError(attrName)
+            val = self._uuid(self._refs[i])
+        setattr(self, attrName, val)
+        return val
 
     def getCommonName(self, uuid):
-        if uuid in self.idMap:
-            return self.idMap[uuid].commonName
+        if self._numbers is None:
+            self._load()
+        n = UUID(uuid)._short
+        if n is None:
+            return None
+        i = bisect.bisect_left(self._numbers, n)
+        if i < len(self._numbers) and self._numbers[i] == n:
+            return self._names[i]
         return None
 
 def get_json_uuid():
-    import json
     with open(os.path.join(script_path, 'uuids.json'),"rb") as fp:
         uuid_data = json.loads(fp.read().decode("utf-8"))
     for k in uuid_data.keys():
@@ -886,7 +3876,8 @@ def get_json_uuid():
             yield UUID(number, cname)
             yield UUID(number, name)
 
-AssignedNumbers = _UUIDNameMap( get_json_uuid() )
+AssignedNumbers = _UUIDNameMap(os.path.join(script_path, 'uuids.json'),
+                               os.path.join(script_path, 'uuids.idx'))
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
@@ -344,8 +344,10 @@ class BatterySensor(SensorBase):
         return val
 
 class SensorTag(Peripheral):
-    def __init__(self,addr,version=AUTODETECT):
+    def __init__(self,addr,version=AUTODETECT,cache=None):
         Peripheral.__init__(self,addr)
+        if cache is not None:
+            self.withCache(cache)
         if version==AUTODETECT:
             svcs = self.discoverServices()
             if _TI_UUID(0xAA70) in svcs:
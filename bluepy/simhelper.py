@@ -0,0 +1,929 @@
+#!/usr/bin/env python
+"""A simulated bluepy-helper, for testing and load testing without a radio
+
+Speaks bluepy-helper's stdin/stdout protocol (text or binary framed,
+with connection slots) for a population of made-up devices: they
+advertise at a set rate with RSSI on a random walk, accept connections,
+and have GATT tables to discover, read and write, with notifications
+streaming once subscribed. Select it with BLUEPY_HELPER=sim in the
+environment, or in code:
+
+    from bluepy import btle, simhelper
+    btle.helperExe = simhelper.configure(devices=500, advRate=20)
+    p = btle.Peripheral(simhelper.deviceAddress(3), btle.ADDR_TYPE_RANDOM)
+
+It is configured through BLUEPY_SIM, which holds JSON or the path of a
+JSON file with any of DEFAULTS (configure() sets it).
+"""
+from __future__ import print_function
+
+import sys
+import os
+import json
+import time
+import random
+import select
+import struct
+import binascii
+import heapq
+
+DEFAULTS = {
+    'devices' : 20,         # How many devices
+    'seed' : 1,
+    'advRate' : 10.0,       # Adverts per second, per device
+    'rssi' : [-90, -40],    # Range of the RSSI random walk (dBm)
+    'rssiStep' : 2.0,       # Most it moves per advert
+    'connectable' : 0.8,    # Fraction of devices that accept connections
+    'connLatency' : 0.0,    # Seconds to connect
+    'connFail' : 0.0,       # Chance a connect fails
+    'linkLoss' : 0.0,       # Mean seconds before a link is lost (0: never)
+    'attInterval' : 0.0,    # Seconds per ATT request and response
+    'mtu' : 247,            # Largest ATT MTU the devices accept
+    'services' : 2,         # Custom services, besides GAP, GATT and battery
+    'chars' : 4,            # Characteristics per custom service
+    'notifyRate' : 10.0,    # Notifications per second, per subscription
+    'notifyLen' : 20,
+    'writeRate' : 0.0,      # Writes without response per second (0: no limit)
+    'scanTimeout' : 0.0,    # Seconds before a 'scan' ends (10.24 like the kernel)
+}
+
+# As in bluepy-helper.c; frame codes are positions in these
+RSPS = ('err', 'stat', 'ntfy', 'ind', 'find', 'desc', 'rd', 'wr',
+        'mgmt', 'scan', 'oob', 'bin', 'sent', 'gatt')
+TAGS = ('rsp', 'code', 'estat', 'emsg', 'hnd', 'uuid', 'd', 'state',
+        'sec', 'mtu', 'dst', 'hstart', 'hend', 'props', 'vhnd', 'addr',
+        'type', 'rssi', 'flag', 'cid')
+FRAME_MAGIC = 0xBE
+FRAME_MAX_PAYLOAD = 0xFFFF
+
+ATT_DEFAULT_MTU = 23
+ATT_ECODE_INVALID_HANDLE = 0x01
+ATT_ECODE_WRITE_NOT_PERM = 0x03
+ATT_ECODE_INVALID_OFFSET = 0x07
+ATT_ECODE_ATTR_NOT_FOUND = 0x0A
+ATT_ECODE_UNLIKELY = 0x0E
+_attErrors = { ATT_ECODE_INVALID_HANDLE : "Invalid handle",
+               ATT_ECODE_WRITE_NOT_PERM : "Attribute can't be written",
+               ATT_ECODE_INVALID_OFFSET : "Offset past the end of the attribute",
+               ATT_ECODE_ATTR_NOT_FOUND : "No attribute found within the given range",
+               ATT_ECODE_UNLIKELY : "Request attribute has encountered an unlikely error" }
+
+MGMT_STATUS_REJECTED = 0x0B
+BDADDR_LE_RANDOM = 2
+MGMT_DEV_FOUND_NOT_CONNECTABLE = 0x04
+MAX_CONNS = 8
+
+PROP_READ = 0x02
+PROP_WRITE_NR = 0x04
+PROP_WRITE = 0x08
+PROP_NOTIFY = 0x10
+PROP_INDICATE = 0x20
+
+_baseUUID = "-0000-1000-8000-00805f9b34fb"
+_hexDigits = frozenset("0123456789abcdefABCDEF")
+
+def configure(**params):
+    # Sets BLUEPY_SIM for helpers started from now on (they inherit the
+    # environment), and returns the path to set btle.helperExe to
+    for key in params:
+        if key not in DEFAULTS:
+            raise ValueError("Unknown simulation parameter %s" % key)
+    os.environ['BLUEPY_SIM'] = json.dumps(params)
+    return os.path.abspath(__file__).replace('.pyc', '.py')
+
+def loadConfig():
+    cfg = dict(DEFAULTS)
+    spec = os.environ.get('BLUEPY_SIM', '').strip()
+    if spec:
+        if not spec.startswith('{'):
+            with open(spec) as fp:
+                spec = fp.read()
+        cfg.update(json.loads(spec))
+    return cfg
+
+def deviceAddress(i):
+    # Address of device i (static random addresses)
+    return "c0:5e:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF,
+                                          (i >> 8) & 0xFF, i & 0xFF)
+
+def _isAddress(s):
+    # As bachk() in bluez would take it
+    parts = s.split(':')
+    return len(parts) == 6 and all(len(p) == 2 and all(c in _hexDigits for c in p)
+                                   for p in parts)
+
+def fullUUID(val):
+    # Canonical string form, as bluepy-helper reports UUIDs
+    val = val.lower()
+    if len(val) <= 8 and '-' not in val:
+        return "%08x" % int(val, 16) + _baseUUID
+    return val
+
+def uuidBytes(uuid):
+    # Little-endian value, 16-bit if it is one
+    if uuid.endswith(_baseUUID) and uuid.startswith("0000"):
+        return struct.pack('<H', int(uuid[4:8], 16))
+    return binascii.a2b_hex(uuid.replace('-', ''))[::-1]
+
+def _hexUpper(data):
+    return binascii.b2a_hex(data).decode('ascii').upper()
+
+
+class GattTable:
+    """The attributes of one kind of device, by handle"""
+    # Devices share a table and keep their own values. Each attribute is
+    # (handle, type UUID, props, value UUID); services are
+    # (start, end, UUID) and characteristics (declaration handle, props,
+    # value handle, UUID).
+    def __init__(self, cfg):
+        self.attrs = []
+        self.services = []
+        self.chars = []
+        self.values = {} # Initial values, by handle
+        self.cccds = {} # Value handle by CCCD handle
+        self._service("1800", [("2a00", PROP_READ, None),
+                               ("2a01", PROP_READ, b'\x00\x00')])
+        self._service("1801", [("2a05", PROP_INDICATE, b'\x01\x00\xff\xff')])
+        self._service("180f", [("2a19", PROP_READ | PROP_NOTIFY, b'\x64')])
+        for s in range(cfg['services']):
+            self._service("5eed%04x-b1e5-4a9c-8f3e-00000000c0de" % s,
+                          [("5eed%04x-b1e5-4a9c-8f3e-%012x" % (s, c + 1),
+                            PROP_READ | PROP_WRITE | PROP_WRITE_NR | PROP_NOTIFY,
+                            b'\x00' * 4)
+                           for c in range(cfg['chars'])])
+        self.handles = dict((a[0], a) for a in self.attrs)
+
+    def _add(self, typeUUID, props=0, valueUUID=None):
+        hnd = len(self.attrs) + 1
+        self.attrs.append((hnd, fullUUID(typeUUID), props, valueUUID))
+        return hnd
+
+    def _service(self, uuid, chars):
+        uuid = fullUUID(uuid)
+        start = self._add("2800", 0, uuid)
+        for (cuuid, props, value) in chars:
+            cuuid = fullUUID(cuuid)
+            decl = self._add("2803", props, cuuid)
+            vhnd = self._add(cuuid, props)
+            self.chars.append((decl, props, vhnd, cuuid))
+            self.values[vhnd] = value
+            if props & (PROP_NOTIFY | PROP_INDICATE):
+                cccd = self._add("2902", PROP_READ | PROP_WRITE)
+                self.values[cccd] = b'\x00\x00'
+                self.cccds[cccd] = vhnd
+        self.services.append((start, len(self.attrs), uuid))
+
+    def declValue(self, hnd):
+        (_, typ, props, uuid) = self.handles[hnd]
+        if typ == fullUUID("2800"):
+            return uuidBytes(uuid)
+        char = [c for c in self.chars if c[0] == hnd][0]
+        return struct.pack('<BH', props, char[2]) + uuidBytes(uuid)
+
+
+class Device:
+    """One simulated device"""
+    def __init__(self, index, cfg, rng):
+        self.index = index
+        self.addr = deviceAddress(index)
+        self.name = "Sim-%04d" % index
+        self.connectable = rng.random() < cfg['connectable']
+        (self.rssiMin, self.rssiMax) = cfg['rssi']
+        self.rssi = rng.uniform(self.rssiMin, self.rssiMax)
+        self.values = None # Made on first connection
+        # Flags, battery service, name and the index as manufacturer data
+        name = self.name.encode('ascii')
+        self.advData = (b'\x02\x01\x06' + b'\x03\x03\x0f\x18' +
+                        struct.pack('BB', len(name) + 1, 0x09) + name +
+                        struct.pack('<BBHI', 7, 0xFF, 0xFFFF, index))
+        self.serviceUUIDs = set([fullUUID("180f")])
+        self._frame = None
+
+    def gattValues(self, table):
+        if self.values is None:
+            self.values = dict(table.values)
+            self.values[3] = self.name.encode('ascii')
+        return self.values
+
+
+class Slot:
+    """A connection slot, as in bluepy-helper"""
+    def __init__(self, cid):
+        self.cid = cid
+        self.state = 'disc'
+        self.dst = None
+        self.device = None
+        self.mtu = 0
+        self.sec = 'low'
+        self.busyUntil = 0.0 # When its last ATT request completes
+        self.nextWrite = 0.0
+        self.epoch = 0 # Bumped on disconnection, so old timers lapse
+        self.pending = 0 # ATT requests not yet answered
+        self.subscribed = {} # 'ntfy' or 'ind', by value handle
+
+
+class SimHelper:
+    def __init__(self, cfg, out=None):
+        self.cfg = cfg
+        self.rng = random.Random(cfg['seed'])
+        self.devices = [Device(i, cfg, self.rng) for i in range(cfg['devices'])]
+        self.byAddr = dict((d.addr, d) for d in self.devices)
+        self.table = GattTable(cfg)
+        self.slots = [Slot(i) for i in range(MAX_CONNS)]
+        self.binary = False
+        self.out = out if out is not None else sys.stdout
+        self._outFd = self.out.fileno()
+        self._pending = []
+        self._timers = []
+        self._timerSeq = 0
+        # Scanning; 'scan' through mgmt, 'pasv' on HCI
+        self.scanning = None
+        self.scanParams = { 'dup' : False }
+        self.filt = None
+        self._scanStart = 0.0
+        self._advSent = 0
+        self._advOrder = list(range(len(self.devices)))
+        self.rng.shuffle(self._advOrder)
+        self._advPos = 0
+        self._reported = set()
+        self._scanEpoch = 0
+
+    # Output
+
+    def send(self, slot, rsp, items=()):
+        # items are (tag, type, value): '$' symbol, "'" string, 'h' uint,
+        # 'b' data
+        if slot is not None and slot.cid:
+            items = [('cid', 'h', slot.cid)] + list(items)
+        if self.binary:
+            payload = b''.join([self._frameItem(tag, vt, val) for (tag, vt, val) in items])
+            if len(payload) > FRAME_MAX_PAYLOAD:
+                # As bluepy-helper: fail the response, not truncate it
+                self.error(slot, 'eframe')
+                return
+            self._pending.append(struct.pack('<BBH', FRAME_MAGIC, RSPS.index(rsp), len(payload)) + payload)
+        else:
+            parts = ['rsp=$' + rsp]
+            for (tag, vt, val) in items:
+                if vt == 'h':
+                    parts.append('%s=h%X' % (tag, val))
+                elif vt == 'b':
+                    parts.append('%s=b%s' % (tag, _hexUpper(val)))
+                else:
+                    parts.append('%s=%s%s' % (tag, vt, val))
+            self._pending.append(('\x1e'.join(parts) + '\n').encode('utf-8'))
+
+    @staticmethod
+    def _frameItem(tag, vt, val):
+        if vt == 'h':
+            val = struct.pack('<I', val & 0xFFFFFFFF)
+        elif vt != 'b':
+            val = val.encode('utf-8')
+        return struct.pack('<BBH', TAGS.index(tag), ord(vt), len(val)) + val
+
+    def flush(self):
+        if not self._pending:
+            return
+        data = b''.join(self._pending)
+        self._pending = []
+        while data:
+            data = data[os.write(self._outFd, data):]
+
+    def status(self, slot):
+        items = [('state', '$', slot.state)]
+        if slot.state != 'disc':
+            items.append(('dst', "'", slot.dst))
+        items += [('mtu', 'h', slot.mtu), ('sec', "'", slot.sec)]
+        self.send(slot, 'stat', items)
+
+    def error(self, slot, code, msg=None):
+        items = [('code', '$', code)]
+        if msg is not None:
+            items.append(('emsg', "'", msg))
+        self.send(slot, 'err', items)
+
+    def attError(self, slot, status):
+        self.send(slot, 'err', [('code', '$', 'atterr'), ('estat', 'h', status),
+                                ('emsg', "'", _attErrors[status])])
+
+    def mgmt(self, slot, code):
+        self.send(slot, 'mgmt', [('code', '$', code)])
+
+    # Timers
+
+    def at(self, when, fn, *args):
+        self._timerSeq += 1
+        heapq.heappush(self._timers, (when, self._timerSeq, fn, args))
+
+    def _runTimers(self, now):
+        while self._timers and self._timers[0][0] <= now:
+            (_, _, fn, args) = heapq.heappop(self._timers)
+            fn(*args)
+
+    def _attReply(self, slot, pdus, fn, *args):
+        # Replies once the link has carried pdus more request/response
+        # pairs after any already queued
+        start = max(time.time(), slot.busyUntil)
+        slot.busyUntil = start + self.cfg['attInterval'] * pdus
+        slot.pending += 1
+        self.at(slot.busyUntil, self._attReplied, slot, slot.epoch, fn, args)
+
+    def _attReplied(self, slot, epoch, fn, args):
+        if slot.epoch == epoch:
+            slot.pending -= 1
+        self._ifConnected(slot, epoch, fn, args)
+
+    def _ifConnected(self, slot, epoch, fn, args):
+        if slot.epoch == epoch and slot.state == 'conn':
+            fn(*args)
+
+    def _attMTU(self, slot):
+        return slot.mtu or ATT_DEFAULT_MTU
+
+    def _pdus(self, slot, count, entrySize):
+        # Requests a discovery of count entries takes, ending with the
+        # one answered 'not found'
+        perPdu = max(1, (self._attMTU(slot) - 2) // entrySize)
+        return (count + perPdu - 1) // perPdu + 1
+
+    # Commands
+
+    def command(self, line):
+        args = line.split()
+        if not args:
+            return True
+        slot = self.slots[0]
+        if args[0].startswith('@'):
+            try:
+                cid = int(args[0][1:])
+            except ValueError:
+                cid = -1
+            if not 0 <= cid < MAX_CONNS or len(args) < 2:
+                self.error(slot, 'badparam')
+                return True
+            slot = self.slots[cid]
+            args = args[1:]
+        verb = args[0].lower()
+        if verb == 'quit':
+            return False
+        handler = getattr(self, 'cmd_' + verb, None)
+        if handler is None:
+            self.error(slot, 'badcmd')
+        else:
+            handler(slot, args[1:])
+        return True
+
+    def cmd_stat(self, slot, args):
+        self.status(slot)
+
+    def cmd_bin(self, slot, args):
+        if not args or args[0] == 'on':
+            self.binary = True
+        elif args[0] == 'off':
+            self.binary = False
+        else:
+            self.error(slot, 'badparam')
+            return
+        self.send(slot, 'bin', [('code', '$', 'success')])
+
+    def cmd_le(self, slot, args):
+        self.mgmt(slot, 'success' if args and args[0] in ('on', 'off') else 'badparam')
+
+    def cmd_conn(self, slot, args):
+        if slot.state != 'disc':
+            return
+        if not args:
+            self.error(slot, 'badparam')
+            return
+        slot.dst = args[0].lower()
+        slot.state = 'tryconn'
+        self.status(slot)
+        self.at(time.time() + self.cfg['connLatency'], self._connected, slot, slot.epoch)
+
+    def _connected(self, slot, epoch):
+        if slot.epoch != epoch or slot.state != 'tryconn':
+            return
+        dev = self.byAddr.get(slot.dst)
+        if dev is None or not dev.connectable or self.rng.random() < self.cfg['connFail']:
+            slot.state = 'disc'
+            slot.epoch += 1
+            self.status(slot)
+            self.send(slot, 'err', [('code', '$', 'connfail'),
+                                    ('emsg', "'", "Connection refused (111)")])
+            return
+        slot.device = dev
+        dev.gattValues(self.table)
+        slot.state = 'conn'
+        slot.mtu = 0
+        slot.busyUntil = 0.0
+        self.status(slot)
+        if self.cfg['linkLoss']:
+            self.at(time.time() + self.rng.expovariate(1.0 / self.cfg['linkLoss']),
+                    self._ifConnected, slot, slot.epoch, self._disconnect, (slot,))
+
+    def _disconnect(self, slot):
+        # As in bluepy-helper, requests still waiting for the device
+        # are answered with an error after the state change
+        (pending, slot.pending) = (slot.pending, 0)
+        slot.state = 'disc'
+        slot.device = None
+        slot.mtu = 0
+        slot.subscribed.clear()
+        slot.epoch += 1
+        self.status(slot)
+        for _ in range(pending):
+            self.attError(slot, ATT_ECODE_UNLIKELY)
+
+    def cmd_disc(self, slot, args):
+        if slot.state != 'disc':
+            self._disconnect(slot)
+
+    def _connectedOr(self, slot):
+        # True if connected, else answers badstate
+        if slot.state != 'conn':
+            self.error(slot, 'badstate')
+            return False
+        return True
+
+    def _handles(self, slot, args, count):
+        # Up to count handle arguments (hex), or None after answering
+        # badparam
+        vals = []
+        for a in args[:count]:
+            try:
+                vals.append(int(a, 16))
+            except ValueError:
+                self.error(slot, 'badparam')
+                return None
+        return vals
+
+    def cmd_svcs(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        svcs = self.table.services
+        if args:
+            uuid = fullUUID(args[0])
+            found = [s for s in svcs if s[2] == uuid]
+            items = []
+            for s in found:
+                items += [('hstart', 'h', s[0]), ('hend', 'h', s[1])]
+            self._attReply(slot, 1 + len(found), self.send, slot, 'find', items)
+            return
+        items = []
+        for s in svcs:
+            items += [('hstart', 'h', s[0]), ('hend', 'h', s[1]), ('uuid', "'", s[2])]
+        self._attReply(slot, self._pdus(slot, len(svcs), 20), self.send, slot, 'find', items)
+
+    def cmd_incl(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        self._attReply(slot, 1, self.send, slot, 'find', [])
+
+    def cmd_char(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        hnds = self._handles(slot, args, 2)
+        if hnds is None:
+            return
+        (start, end) = (hnds + [0x0001, 0xFFFF][len(hnds):])[:2]
+        uuid = fullUUID(args[2]) if len(args) > 2 else None
+        found = [c for c in self.table.chars if start <= c[0] <= end and
+                 (uuid is None or c[3] == uuid)]
+        if not found:
+            self._attReply(slot, 1, self.attError, slot, ATT_ECODE_ATTR_NOT_FOUND)
+            return
+        items = []
+        for c in found:
+            items += [('hnd', 'h', c[0]), ('props', 'h', c[1]),
+                      ('vhnd', 'h', c[2]), ('uuid', "'", c[3])]
+        self._attReply(slot, self._pdus(slot, len(found), 21), self.send, slot, 'find', items)
+
+    def cmd_desc(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        hnds = self._handles(slot, args, 2)
+        if hnds is None:
+            return
+        (start, end) = (hnds + [0x0001, 0xFFFF][len(hnds):])[:2]
+        found = [a for a in self.table.attrs if start <= a[0] <= end]
+        if not found:
+            self._attReply(slot, 1, self.attError, slot, ATT_ECODE_ATTR_NOT_FOUND)
+            return
+        items = []
+        for a in found:
+            items += [('hnd', 'h', a[0]), ('uuid', "'", a[1])]
+        self._attReply(slot, self._pdus(slot, len(found), 18), self.send, slot, 'desc', items)
+
+    def cmd_dump(self, slot, args):
+        # As 'svcs', one 'char' over the whole table and a 'desc' for
+        # each characteristic with handles after its value, in one reply
+        if not self._connectedOr(slot):
+            return
+        table = self.table
+        pdus = (self._pdus(slot, len(table.services), 20) +
+                self._pdus(slot, len(table.chars), 21))
+        items = []
+        for s in table.services:
+            items += [('hstart', 'h', s[0]), ('hend', 'h', s[1]), ('uuid', "'", s[2])]
+        for c in table.chars:
+            items += [('hnd', 'h', c[0]), ('props', 'h', c[1]),
+                      ('vhnd', 'h', c[2]), ('uuid', "'", c[3])]
+        for (i, c) in enumerate(table.chars):
+            end = [s[1] for s in table.services if s[0] <= c[0] <= s[1]][0]
+            if i + 1 < len(table.chars):
+                end = min(end, table.chars[i + 1][0] - 1)
+            if end <= c[2]:
+                continue
+            found = [a for a in table.attrs if c[2] < a[0] <= end]
+            pdus += self._pdus(slot, len(found), 18)
+            for a in found:
+                items += [('hnd', 'h', a[0]), ('uuid', "'", a[1])]
+        self._attReply(slot, pdus, self.send, slot, 'gatt', items)
+
+    def _value(self, slot, hnd):
+        values = slot.device.values
+        if hnd in values:
+            return values[hnd]
+        if hnd in self.table.handles:
+            return self.table.declValue(hnd)
+        return None
+
+    def _readPdus(self, slot, length):
+        return 1 + length // (self._attMTU(slot) - 1)
+
+    def cmd_rd(self, slot, args):
+        self._read(slot, args[:1], None)
+
+    def cmd_rdl(self, slot, args):
+        self._read(slot, args[:1], None if len(args) < 2 else args[1])
+
+    def _read(self, slot, args, offset):
+        if not self._connectedOr(slot):
+            return
+        if not args:
+            self.error(slot, 'badparam')
+            return
+        hnds = self._handles(slot, args, 1)
+        if hnds is None:
+            return
+        try:
+            offset = int(offset, 16) if offset is not None else 0
+        except ValueError:
+            self.error(slot, 'badparam')
+            return
+        val = self._value(slot, hnds[0])
+        if val is None:
+            self._attReply(slot, 1, self.attError, slot, ATT_ECODE_INVALID_HANDLE)
+        elif offset > len(val):
+            self._attReply(slot, 1, self.attError, slot, ATT_ECODE_INVALID_OFFSET)
+        else:
+            val = val[offset:]
+            self._attReply(slot, self._readPdus(slot, len(val)),
+                           self.send, slot, 'rd', [('d', 'b', val)])
+
+    def cmd_rdu(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        if not args:
+            self.error(slot, 'badparam')
+            return
+        uuid = fullUUID(args[0])
+        hnds = self._handles(slot, args[1:], 2)
+        if hnds is None:
+            return
+        (start, end) = (hnds + [0x0001, 0xFFFF][len(hnds):])[:2]
+        items = []
+        for c in self.table.chars:
+            if c[3] == uuid and start <= c[2] <= end:
+                items += [('hnd', 'h', c[2]), ('d', 'b', slot.device.values[c[2]])]
+        if not items:
+            self._attReply(slot, 1, self.attError, slot, ATT_ECODE_ATTR_NOT_FOUND)
+        else:
+            self._attReply(slot, len(items) // 2, self.send, slot, 'rd', items)
+
+    def cmd_wr(self, slot, args):
+        self._write(slot, args, 'wr')
+
+    def cmd_wrr(self, slot, args):
+        self._write(slot, args, 'wrr')
+
+    def cmd_wrs(self, slot, args):
+        self._write(slot, args, 'wrs')
+
+    def _writeError(self, slot, mode, code):
+        if mode == 'wrs':
+            self.send(slot, 'sent', [('code', '$', code)])
+        else:
+            self.error(slot, code)
+
+    def _write(self, slot, args, mode):
+        if not args:
+            self.error(slot, 'badparam')
+            return
+        if slot.state != 'conn':
+            self._writeError(slot, mode, 'badstate')
+            return
+        try:
+            hnd = int(args[0], 16)
+            val = binascii.a2b_hex(args[1]) if len(args) > 1 else b''
+        except (ValueError, TypeError):
+            self._writeError(slot, mode, 'badparam')
+            return
+        if hnd <= 0:
+            self._writeError(slot, mode, 'badparam')
+            return
+        if mode == 'wrr':
+            self._attReply(slot, 1, self._written, slot, hnd, val, True)
+            return
+        if mode == 'wr':
+            self.send(slot, 'wr')
+            self._written(slot, hnd, val, False)
+            return
+        # Streamed: 'sent' once the write has gone, at the write rate
+        rate = self.cfg['writeRate']
+        now = time.time()
+        if rate:
+            slot.nextWrite = max(now, slot.nextWrite) + 1.0 / rate
+            when = slot.nextWrite
+        else:
+            when = now
+        self._written(slot, hnd, val, False)
+        self.at(when, self._ifConnected, slot, slot.epoch, self.send,
+                (slot, 'sent', [('code', '$', 'success')]))
+
+    def _written(self, slot, hnd, val, reply):
+        attr = self.table.handles.get(hnd)
+        if attr is None:
+            if reply:
+                self.attError(slot, ATT_ECODE_INVALID_HANDLE)
+            return
+        if hnd in self.table.cccds:
+            self._subscribe(slot, self.table.cccds[hnd], val)
+        elif not attr[2] & (PROP_WRITE | PROP_WRITE_NR) or hnd not in slot.device.values:
+            if reply:
+                self.attError(slot, ATT_ECODE_WRITE_NOT_PERM)
+            return
+        slot.device.values[hnd] = val
+        if reply:
+            self.send(slot, 'wr')
+
+    def _subscribe(self, slot, vhnd, val):
+        kind = None
+        if val[:1] == b'\x01':
+            kind = 'ntfy'
+        elif val[:1] == b'\x02':
+            kind = 'ind'
+        was = slot.subscribed.get(vhnd)
+        if kind is None:
+            slot.subscribed.pop(vhnd, None)
+        else:
+            slot.subscribed[vhnd] = kind
+        if kind is not None and was is None and self.cfg['notifyRate']:
+            self.at(time.time() + 1.0 / self.cfg['notifyRate'], self._ifConnected,
+                    slot, slot.epoch, self._notify, (slot, vhnd, 0))
+
+    def _notify(self, slot, vhnd, count):
+        kind = slot.subscribed.get(vhnd)
+        if kind is None:
+            return
+        data = struct.pack('<I', count & 0xFFFFFFFF)
+        data = (data + b'\x00' * self.cfg['notifyLen'])[:max(self.cfg['notifyLen'], 1)]
+        self.send(slot, kind, [('hnd', 'h', vhnd), ('d', 'b', data)])
+        self.at(time.time() + 1.0 / self.cfg['notifyRate'], self._ifConnected,
+                slot, slot.epoch, self._notify, (slot, vhnd, count + 1))
+
+    def cmd_secu(self, slot, args):
+        if not args or args[0] not in ('low', 'medium', 'high'):
+            self.error(slot, 'badparam')
+            return
+        slot.sec = args[0]
+        if slot.state == 'conn':
+            self.status(slot)
+
+    def cmd_mtu(self, slot, args):
+        if not self._connectedOr(slot):
+            return
+        if not args:
+            self.error(slot, 'badparam')
+            return
+        if slot.mtu:
+            self.error(slot, 'badstate')
+            return
+        try:
+            mtu = int(args[0], 16)
+        except ValueError:
+            mtu = 0
+        if mtu < ATT_DEFAULT_MTU:
+            self.error(slot, 'badparam')
+            return
+        slot.mtu = min(mtu, self.cfg['mtu'])
+        self._attReply(slot, 1, self.status, slot)
+
+    # Scanning
+
+    def cmd_scan(self, slot, args):
+        self._scanCmd(slot, args, 'scan', True)
+
+    def cmd_scanend(self, slot, args):
+        self._scanCmd(slot, args, 'scan', False)
+
+    def cmd_pasv(self, slot, args):
+        self._scanCmd(slot, args, 'pasv', True)
+
+    def cmd_pasvend(self, slot, args):
+        self._scanCmd(slot, args, 'pasv', False)
+
+    def _scanCmd(self, slot, args, kind, start):
+        if args or slot.cid:
+            self.mgmt(slot, 'badparam')
+            return
+        if start and self.scanning is not None:
+            self.mgmt(slot, 'busy')
+            return
+        if not start and self.scanning is None:
+            if kind == 'scan':
+                self.send(slot, 'mgmt', [('code', '$', 'mgmterr'),
+                                         ('estat', 'h', MGMT_STATUS_REJECTED),
+                                         ('emsg', "'", "Rejected")])
+            else:
+                self.mgmt(slot, 'success')
+                self._scanEnded()
+            return
+        self.mgmt(slot, 'success')
+        if start:
+            self.scanning = kind
+            self._scanStart = time.time()
+            self._advSent = 0
+            self._reported.clear()
+            self._scanEpoch += 1
+            if slot.state == 'disc':
+                slot.state = 'scan'
+                slot.dst = ''
+            self.status(slot)
+            timeout = self.cfg['scanTimeout']
+            if kind == 'scan' and timeout:
+                self.at(self._scanStart + timeout, self._scanTimedOut, self._scanEpoch)
+        else:
+            self._scanEnded()
+
+    def _scanTimedOut(self, epoch):
+        if self.scanning is not None and epoch == self._scanEpoch:
+            self._scanEnded()
+
+    def _scanEnded(self):
+        self.scanning = None
+        slot = self.slots[0]
+        if slot.state == 'scan':
+            slot.state = 'disc'
+        self.status(slot)
+
+    def cmd_scanp(self, slot, args):
+        params = { 'active' : 0, 'interval' : 0x10, 'window' : 0x10, 'dup' : 0, 'own' : 0 }
+        for arg in args:
+            (key, _, val) = arg.partition('=')
+            if key not in params:
+                self.mgmt(slot, 'badparam')
+                return
+            try:
+                params[key] = int(val, 0)
+            except ValueError:
+                if key != 'own' or val not in ('public', 'random'):
+                    self.mgmt(slot, 'badparam')
+                    return
+        if not (4 <= params['interval'] <= 0x4000 and 4 <= params['window'] <= params['interval']):
+            self.mgmt(slot, 'badparam')
+            return
+        self.scanParams = { 'dup' : bool(params['dup']) }
+        self.mgmt(slot, 'success')
+
+    def cmd_filt(self, slot, args):
+        filt = { 'rssi' : None, 'conn' : False, 'addr' : None, 'uuid' : None }
+        for arg in args:
+            (key, _, val) = arg.partition('=')
+            if not val or key not in filt:
+                self.filt = None
+                self.mgmt(slot, 'badparam')
+                return
+            if key == 'rssi':
+                filt['rssi'] = int(val)
+            elif key == 'conn':
+                filt['conn'] = int(val) != 0
+            elif key == 'addr':
+                filt['addr'] = set(a.lower() for a in val.split(','))
+                if not all(_isAddress(a) for a in filt['addr']):
+                    self.filt = None
+                    self.mgmt(slot, 'badparam')
+                    return
+            else:
+                filt['uuid'] = set('%s-%s-%s-%s-%s' % (u[0:8], u[8:12], u[12:16], u[16:20], u[20:32])
+                                   for u in (v.lower() for v in val.split(',')))
+        self.filt = filt if args else None
+        self.mgmt(slot, 'success')
+
+    def _passes(self, dev, rssi):
+        filt = self.filt
+        if filt['rssi'] is not None and rssi < filt['rssi']:
+            return False
+        if filt['conn'] and not dev.connectable:
+            return False
+        if filt['addr'] is not None and dev.addr not in filt['addr']:
+            return False
+        if filt['uuid'] is not None and not (filt['uuid'] & dev.serviceUUIDs):
+            return False
+        return True
+
+    def _scanFrame(self, dev):
+        # Report for dev as (head, tail), for the RSSI to go between
+        if dev._frame is None or dev._frame[0] != self.binary:
+            hexAddr = dev.addr.replace(':', '').upper()
+            flag = 0 if dev.connectable else (-MGMT_DEV_FOUND_NOT_CONNECTABLE & 0xFFFFFFFF)
+            if self.binary:
+                items = (self._frameItem('addr', 'b', binascii.a2b_hex(hexAddr)) +
+                         self._frameItem('type', 'h', BDADDR_LE_RANDOM))
+                head = items + struct.pack('<BBH', TAGS.index('rssi'), ord('h'), 4)
+                tail = (self._frameItem('flag', 'h', flag) +
+                        self._frameItem('d', 'b', dev.advData))
+                plen = len(head) + 4 + len(tail)
+                head = struct.pack('<BBH', FRAME_MAGIC, RSPS.index('scan'), plen) + head
+            else:
+                head = ('rsp=$scan\x1eaddr=b%s\x1etype=h%X\x1erssi=h' %
+                        (hexAddr, BDADDR_LE_RANDOM)).encode('ascii')
+                tail = ('\x1eflag=h%X\x1ed=b%s\n' %
+                        (flag, _hexUpper(dev.advData))).encode('ascii')
+            dev._frame = (self.binary, head, tail)
+        return dev._frame
+
+    def _advertise(self, now):
+        # Sends the adverts due by now, devices taking turns
+        if self.scanning is None or not self.devices:
+            return None
+        rate = self.cfg['advRate'] * len(self.devices)
+        if rate <= 0:
+            return None
+        due = int((now - self._scanStart) * rate) - self._advSent
+        if due > rate:
+            # Far behind (the client isn't reading): drop, as a
+            # controller would
+            self._advSent += due - int(rate)
+            due = int(rate)
+        (step, rng, order) = (self.cfg['rssiStep'], self.rng, self._advOrder)
+        dedup = self.scanning == 'pasv' and self.scanParams['dup']
+        pending = self._pending
+        for _ in range(due):
+            dev = self.devices[order[self._advPos]]
+            self._advPos = (self._advPos + 1) % len(order)
+            rssi = dev.rssi + rng.uniform(-step, step)
+            dev.rssi = rssi = min(max(rssi, dev.rssiMin), dev.rssiMax)
+            irssi = int(round(rssi))
+            if dedup:
+                if dev.index in self._reported:
+                    continue
+                self._reported.add(dev.index)
+            if self.filt is not None and not self._passes(dev, irssi):
+                continue
+            (binary, head, tail) = self._scanFrame(dev)
+            if binary:
+                pending.append(head + struct.pack('<I', -irssi & 0xFFFFFFFF) + tail)
+            else:
+                pending.append(head + ('%X' % (-irssi & 0xFFFFFFFF)).encode('ascii') + tail)
+        self._advSent += max(due, 0)
+        return self._scanStart + (self._advSent + 1) / rate
+
+    # Main loop
+
+    def run(self, inp=None):
+        inFd = (inp if inp is not None else sys.stdin).fileno()
+        buf = b''
+        tick = 0.002 # Shortest wait between advert batches
+        while True:
+            now = time.time()
+            self._runTimers(now)
+            nextAdv = self._advertise(now)
+            self.flush()
+            due = [t for t in (nextAdv, self._timers[0][0] if self._timers else None)
+                   if t is not None]
+            timeout = max(min(due) - time.time(), tick if nextAdv else 0) if due else None
+            if select.select([inFd], [], [], timeout)[0]:
+                data = os.read(inFd, 65536)
+                if not data:
+                    break
+                buf += data
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    if not self.command(line.decode('utf-8', 'replace')):
+                        self.flush()
+                        return
+                self.flush()
+
+
+def main():
+    helper = SimHelper(loadConfig())
+    # The interface argument is accepted and ignored
+    try:
+        helper.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
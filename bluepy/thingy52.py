@@ -543,6 +543,11 @@ class SoundService():
             sample_str = "{:02X}".format(sample)
             self.speaker_data_char.write(binascii.a2b_hex(sample_str), False)
 
+    def stream_speaker_data(self, data, window=16):
+        """ Stream audio data (speaker mode 0x01 or 0x02) to the speaker; returns the transfer statistics. """
+        if self.speaker_data_char is not None:
+            return self.speaker_data_char.writeStream(data, window)
+
     def set_speaker_status_notification(self, state):
         if self.speaker_status_char_cccd is not None:
             if state == True:
@@ -574,82 +579,83 @@ class SoundService():
 
 class MyDelegate(DefaultDelegate):
     
+    # Printed label for notifications shown as plain hex, by handle name
+    _hex_labels = {
+        'e_color_handle': 'Color',
+        'm_orient_handle': 'Orient',
+        'm_quaternion_handle': 'Quaternion',
+        'm_stepcnt_handle': 'Step Count',
+        'm_rawdata_handle': 'Raw data',
+        'm_euler_handle': 'Euler',
+        'm_rotation_handle': 'Rotation matrix',
+        'm_heading_handle': 'Heading',
+        'm_gravity_handle': 'Gravity',
+        's_speaker_status_handle': 'Speaker Status',
+        's_microphone_handle': 'Microphone',
+    }
+
+    def __init__(self):
+        DefaultDelegate.__init__(self)
+        self._handlers = {}
+
+    def _build_handlers(self):
+        """ Map the handles enabled so far to their printing functions. """
+        g = globals()
+        handlers = {
+            e_temperature_handle: self._temperature,
+            e_pressure_handle: self._pressure,
+            e_humidity_handle: self._humidity,
+            e_gas_handle: self._gas,
+            ui_button_handle: self._button,
+            m_tap_handle: self._tap,
+        }
+        for name, label in self._hex_labels.items():
+            handlers[g[name]] = lambda data, label=label: self._hex(label, data)
+        handlers.pop(None, None)
+        self._handlers = handlers
+
     def handleNotification(self, hnd, data):
         #Debug print repr(data)
-        if (hnd == e_temperature_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Temp received:  {}.{} degCelcius'.format(
-                        self._str_to_int(teptep[:-2]), int(teptep[-2:], 16)))
-            
-        elif (hnd == e_pressure_handle):
-            pressure_int, pressure_dec = self._extract_pressure_data(data)
-            print('Notification: Press received: {}.{} hPa'.format(
-                        pressure_int, pressure_dec))
-
-        elif (hnd == e_humidity_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Humidity received: {} %'.format(self._str_to_int(teptep)))
-
-        elif (hnd == e_gas_handle):
-            eco2, tvoc = self._extract_gas_data(data)
-            print('Notification: Gas received: eCO2 ppm: {}, TVOC ppb: {} %'.format(eco2, tvoc))
-
-        elif (hnd == e_color_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Color: {}'.format(teptep))            
-
-        elif (hnd == ui_button_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Button state [1 -> released]: {}'.format(self._str_to_int(teptep)))
-
-        elif (hnd == m_tap_handle):
-            direction, count = self._extract_tap_data(data)
-            print('Notification: Tap: direction: {}, count: {}'.format(direction, self._str_to_int(count)))
-
-        elif (hnd == m_orient_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Orient: {}'.format(teptep))
-
-        elif (hnd == m_quaternion_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Quaternion: {}'.format(teptep))
-
-        elif (hnd == m_stepcnt_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Step Count: {}'.format(teptep))
-
-        elif (hnd == m_rawdata_handle):
+        handler = self._handlers.get(hnd)
+        if handler is None:
+            # Services may have been enabled since the table was built
+            self._build_handlers()
+            handler = self._handlers.get(hnd)
+        if handler is not None:
+            handler(data)
+        else:
             teptep = binascii.b2a_hex(data)
-            print('Notification: Raw data: {}'.format(teptep))
+            print('Notification: UNKOWN: hnd {}, data {}'.format(hnd, teptep))
 
-        elif (hnd == m_euler_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Euler: {}'.format(teptep))
+    def _temperature(self, data):
+        teptep = binascii.b2a_hex(data)
+        print('Notification: Temp received:  {}.{} degCelcius'.format(
+                    self._str_to_int(teptep[:-2]), int(teptep[-2:], 16)))
 
-        elif (hnd == m_rotation_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Rotation matrix: {}'.format(teptep))
+    def _pressure(self, data):
+        pressure_int, pressure_dec = self._extract_pressure_data(data)
+        print('Notification: Press received: {}.{} hPa'.format(
+                    pressure_int, pressure_dec))
 
-        elif (hnd == m_heading_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Heading: {}'.format(teptep))
+    def _humidity(self, data):
+        teptep = binascii.b2a_hex(data)
+        print('Notification: Humidity received: {} %'.format(self._str_to_int(teptep)))
 
-        elif (hnd == m_gravity_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Gravity: {}'.format(teptep))        
+    def _gas(self, data):
+        eco2, tvoc = self._extract_gas_data(data)
+        print('Notification: Gas received: eCO2 ppm: {}, TVOC ppb: {} %'.format(eco2, tvoc))
 
-        elif (hnd == s_speaker_status_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Speaker Status: {}'.format(teptep))
+    def _button(self, data):
+        teptep = binascii.b2a_hex(data)
+        print('Notification: Button state [1 -> released]: {}'.format(self._str_to_int(teptep)))
 
-        elif (hnd == s_microphone_handle):
-            teptep = binascii.b2a_hex(data)
-            print('Notification: Microphone: {}'.format(teptep))
+    def _tap(self, data):
+        direction, count = self._extract_tap_data(data)
+        print('Notification: Tap: direction: {}, count: {}'.format(direction, self._str_to_int(count)))
 
-        else:
-            teptep = binascii.b2a_hex(data)
-            print('Notification: UNKOWN: hnd {}, data {}'.format(hnd, teptep))
-            
+    def _hex(self, label, data):
+        teptep = binascii.b2a_hex(data)
+        print('Notification: {}: {}'.format(label, teptep))
 
     def _str_to_int(self, s):
         """ Transform hex str into int. """
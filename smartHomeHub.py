@@ -301,6 +301,27 @@ def processBlynkRun():
     while True:
         blynk.run()
 
+#----------------------------------------------------------------------------
+# This reads the scanner for the life of the program in a separate thread and
+# records when each BLE tile was last heard. Reading it all the time means
+# reports don't queue up in the Bluetooth helper while the main program is
+# busy taking a video or sleeping, so the main program never sees old ones.
+#----------------------------------------------------------------------------
+lastSeen = {}
+lastSeenLock = threading.Lock()
+
+def processScanUpdates(scanner):
+    for dev in scanner.updates():
+        with lastSeenLock:
+            lastSeen[dev.addr] = (time.time(), dev)
+
+#----------------------------------------------------------------------------
+# Returns the BLE tiles heard since the given time
+#----------------------------------------------------------------------------
+def devicesSeenSince(since):
+    with lastSeenLock:
+        return [dev for (seen, dev) in lastSeen.values() if seen >= since]
+
 #----------------------------------------------------------------------------
 # Start of processing
 #----------------------------------------------------------------------------
@@ -350,6 +371,19 @@ if __name__ == "__main__":
     thread = threading.Thread(target=processBlynkRun)  
     thread.start()
 
+    #----------------------------------------------------------------------------
+    # Starts one scanning session for the life of the program. The scanner keeps
+    # the Bluetooth helper running and restarts the scan itself whenever the
+    # controller ends it, so there is no start up cost or gap on each loop.
+    # Only the two BLE tiles are reported; the Bluetooth helper drops
+    # everything else in range before it reaches this program.
+    #----------------------------------------------------------------------------
+    scanner = Scanner().withDelegate(ScanDelegate())
+    scanner.setFilter(addresses=[Child.childTileAddr, Adult.adultTileAddr])
+    scanner.start()
+    scanThread = threading.Thread(target=processScanUpdates, args=(scanner,))
+    scanThread.start()
+
 
     #----------------------------------------------------------------------------
     # This is the main processing in the program which will be continually executed.
@@ -362,10 +396,11 @@ if __name__ == "__main__":
         adult.adultInRoom = False
         
         #----------------------------------------------------------------------------
-        # Scans for any Bluetooth devices in range
+        # Waits 10 seconds, then takes the BLE tiles heard in that time
         #----------------------------------------------------------------------------
-        scanner = Scanner().withDelegate(ScanDelegate())
-        devices = scanner.scan(10.0)
+        windowStart = time.time()
+        time.sleep(10.0)
+        devices = devicesSeenSince(windowStart)
         
         #----------------------------------------------------------------------------
         # This method checks who is currenly in the room by searching for the child and
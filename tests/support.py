@@ -0,0 +1,53 @@
+"""Running btle against the simulated bluepy-helper, for the tests here"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bluepy import btle, simhelper
+
+
+def olderHelper(*cmds):
+    # Path of a script running simhelper without cmds, as an older
+    # bluepy-helper would answer them: with a badcmd error
+    fd, path = tempfile.mkstemp(suffix='.py')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write("import sys\n"
+                 "sys.path.insert(0, %r)\n"
+                 "from bluepy import simhelper\n" % os.path.dirname(btle.script_path))
+        for cmd in cmds:
+            fp.write("del simhelper.SimHelper.cmd_%s\n" % cmd)
+        fp.write("simhelper.main()\n")
+    return path
+
+
+class SimTestCase(unittest.TestCase):
+    # Each test configures simhelper as it needs; the module settings it
+    # changes are put back afterwards
+
+    def setUp(self):
+        self._saved = (btle.helperExe, btle.BinaryFraming, os.environ.get('BLUEPY_SIM'))
+        self._scripts = []
+
+    def tearDown(self):
+        (btle.helperExe, btle.BinaryFraming, sim) = self._saved
+        if sim is None:
+            os.environ.pop('BLUEPY_SIM', None)
+        else:
+            os.environ['BLUEPY_SIM'] = sim
+        for path in self._scripts:
+            os.remove(path)
+
+    def configure(self, **params):
+        btle.helperExe = simhelper.configure(**params)
+
+    def useOlderHelper(self, *cmds):
+        btle.helperExe = olderHelper(*cmds)
+        self._scripts.append(btle.helperExe)
+
+    def connect(self, i, cls=None):
+        p = (cls or btle.Peripheral)(simhelper.deviceAddress(i), btle.ADDR_TYPE_RANDOM)
+        self.addCleanup(p.disconnect)
+        return p
@@ -0,0 +1,61 @@
+"""AsyncScanner filters and scan parameters, as Scanner has them"""
+import asyncio
+import unittest
+import warnings
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+from bluepy.asyncbtle import AsyncScanner
+
+
+class AsyncScannerTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=8, advRate=20)
+
+    def scanned(self, scanner):
+        return dict((d.addr, d) for d in asyncio.run(scanner.scan(0.5)))
+
+    def test_filter(self):
+        want = set([simhelper.deviceAddress(2), simhelper.deviceAddress(5)])
+        scanner = AsyncScanner().setFilter(addresses=want)
+        self.assertEqual(set(self.scanned(scanner)), want)
+        self.assertTrue(scanner._helperFilters)
+
+        self.useOlderHelper('filt')
+        btle._helperLacking.discard("advert filtering")
+        scanner = AsyncScanner().setFilter(addresses=want)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            found = self.scanned(scanner)
+        self.assertFalse(scanner._helperFilters)
+        self.assertEqual(set(found), want)
+        self.assertEqual(len([w for w in caught if "advert filtering" in str(w.message)]), 1)
+
+    def test_filter_while_scanning(self):
+        want = simhelper.deviceAddress(3)
+        scanner = AsyncScanner()
+        async def run():
+            await scanner.start()
+            await asyncio.sleep(0.2)
+            scanner.setFilter(addresses=[want])
+            await asyncio.sleep(0.2)
+            scanner.clear()
+            await asyncio.sleep(0.3)
+            await scanner.stop()
+        asyncio.run(run())
+        self.assertEqual([d.addr for d in scanner.getDevices()], [want])
+
+    def test_scan_parameters(self):
+        scanner = AsyncScanner().setScanParameters(interval=20, window=10, filterDuplicates=True)
+        self.assertEqual([d.updateCount for d in self.scanned(scanner).values()], [1] * 8)
+
+        self.useOlderHelper('scanp')
+        scanner = AsyncScanner().setScanParameters(interval=20)
+        self.assertRaises(btle.BTLEInternalError, asyncio.run, scanner.start())
+        self.assertIsNone(scanner._helper)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""ConnectionManager: pooled connections to many devices"""
+import threading
+import time
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class ConnectionManagerTest(SimTestCase):
+
+    class SlowDisconnect(btle.Peripheral):
+        def disconnect(self):
+            time.sleep(0.5)
+            btle.Peripheral.disconnect(self)
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=6, connectable=1.0)
+        self.addrs = [simhelper.deviceAddress(i) for i in range(6)]
+        self.cm = btle.ConnectionManager(factory=self.SlowDisconnect, maxConnections=2)
+        self.addCleanup(self.cm.close)
+
+    def get(self, i):
+        return self.cm.get(self.addrs[i], btle.ADDR_TYPE_RANDOM)
+
+    def getIfRoom(self, i):
+        try:
+            self.get(i)
+        except btle.BTLEInternalError:
+            pass
+
+    def connected(self):
+        return set(addr for (addr, h) in self.cm.health().items() if h['connected'])
+
+    def test_least_recently_used_is_evicted(self):
+        self.get(0)
+        self.get(1)
+        self.get(0)
+        self.get(2)
+        self.assertEqual(self.connected(), set([self.addrs[0], self.addrs[2]]))
+
+    def test_eviction_does_not_block_the_pool(self):
+        self.get(0)
+        self.get(1)
+        t = threading.Thread(target=self.get, args=(2,))
+        t.start()
+        time.sleep(0.1)
+        # Device 0 is being disconnected; device 1 stays usable meanwhile
+        start = time.time()
+        self.get(1)
+        self.assertLess(time.time() - start, 0.3)
+        # Two more at once: with both pool places taken by connects in
+        # progress, one may find no room
+        threads = [threading.Thread(target=self.getIfRoom, args=(i,)) for i in (3, 4)]
+        for x in threads:
+            x.start()
+        for x in [t] + threads:
+            x.join()
+        self.assertEqual(len(self.connected()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
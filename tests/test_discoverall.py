@@ -0,0 +1,50 @@
+"""Peripheral.discoverAll(): the whole GATT database in one request"""
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+def _tree(svcs):
+    # What discovery found, as plain values
+    return [(str(s.uuid), s.hndStart, s.hndEnd,
+             [(c.handle, c.valHandle, c.properties, str(c.uuid),
+               [(d.handle, str(d.uuid)) for d in c.getDescriptors()])
+              for c in s.getCharacteristics()])
+            for s in svcs]
+
+
+class DiscoverAllTest(SimTestCase):
+    # discoverAll() finds the tree a request-at-a-time walk does
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=2, connectable=1.0, services=3, chars=5)
+
+    def walked(self):
+        p = self.connect(1)
+        p._dumps = False
+        return _tree(p.discoverAll())
+
+    def test_dump(self):
+        for binary in (False, True):
+            btle.BinaryFraming = binary
+            p = self.connect(0)
+            tree = _tree(p.discoverAll())
+            self.assertTrue(p._dumps)
+            self.assertEqual(len(tree), 3 + 3)
+            self.assertEqual([s[1] for s in tree], sorted(s[1] for s in tree))
+            self.assertEqual(tree, self.walked())
+            # Later lookups are served from what it found
+            self.assertEqual(_tree(sorted(p.getServices(), key=lambda s: s.hndStart)), tree)
+
+    def test_without_dump(self):
+        tree = self.walked()
+        self.useOlderHelper('dump')
+        p = self.connect(0)
+        self.assertEqual(_tree(p.discoverAll()), tree)
+        self.assertIs(p._dumps, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Responses read back from text and binary framed helper output"""
+import os
+import unittest
+
+import support # For the tree on sys.path
+from bluepy import btle, simhelper
+
+
+class FrameTest(unittest.TestCase):
+    # Responses as simhelper writes them, read back by BluepyHelper
+
+    def setUp(self):
+        self._devnull = open(os.devnull, 'w')
+        self.sim = simhelper.SimHelper(simhelper.loadConfig(), out=self._devnull)
+
+    def tearDown(self):
+        self._devnull.close()
+
+    def written(self, binary, *responses):
+        self.sim.binary = binary
+        for (slot, rsp, items) in responses:
+            self.sim.send(slot, rsp, items)
+        (data, self.sim._pending) = (b''.join(self.sim._pending), [])
+        return data
+
+    def readBack(self, data, chunk=65536):
+        # Messages parsed from data, as read chunk bytes at a time
+        h = btle.BluepyHelper()
+        msgs = []
+        for pos in range(0, len(data), chunk):
+            h._rxbuf += data[pos:pos+chunk]
+            while True:
+                msg = h._nextMsg()
+                if msg is None:
+                    break
+                msgs.append(msg)
+        self.assertEqual(h._rxpos, len(h._rxbuf))
+        return msgs
+
+    def test_text_and_frames_agree(self):
+        responses = [(self.sim.slots[0], 'rd', [('d', 'b', b'\x00\xff\x1e\n')]),
+                     (self.sim.slots[2], 'err', [('code', '$', 'atterr'), ('estat', 'h', 10),
+                                                 ('emsg', "'", 'Attribute not found')]),
+                     (self.sim.slots[0], 'stat', [('state', '$', 'disc'), ('mtu', 'h', 0)])]
+        expected = [{'rsp': ['rd'], 'd': [b'\x00\xff\x1e\n']},
+                    {'rsp': ['err'], 'cid': [2], 'code': ['atterr'], 'estat': [10],
+                     'emsg': ['Attribute not found']},
+                    {'rsp': ['stat'], 'state': ['disc'], 'mtu': [0]}]
+        for binary in (False, True):
+            msgs = self.readBack(self.written(binary, *responses))
+            self.assertEqual([btle.BluepyHelper.parseMsg(m) for m in msgs], expected)
+
+    def test_split_frames(self):
+        data = self.written(True, *[(self.sim.slots[1], 'ntfy', [('hnd', 'h', 0x10 + i),
+                                                                 ('d', 'b', b'x' * i)])
+                                    for i in range(20)])
+        msgs = self.readBack(data, chunk=3)
+        self.assertEqual([btle.BluepyHelper.parseMsg(m)['hnd'] for m in msgs],
+                         [[0x10 + i] for i in range(20)])
+
+    def test_oversized_frame(self):
+        data = self.written(True, (self.sim.slots[0], 'rd', [('d', 'b', b'\0' * 0x8000)] * 2))
+        (msg,) = self.readBack(data)
+        self.assertEqual(btle.BluepyHelper.parseMsg(msg)['code'], ['eframe'])
+
+    def test_malformed_frame(self):
+        for payload in (b'\x06\x62', b'\x06\x7a\x01\x00a'):
+            self.assertRaises(btle.BTLEInternalError, btle.BluepyHelper.parseFrame,
+                              6, payload)
+
+    def test_scan_records(self):
+        # The fast path decodes scan reports as parseMsg() does
+        scanner = btle.Scanner()
+        adverts = [(self.sim.slots[0], 'scan', [('addr', 'b', b'\x01\x02\x03\x04\x05\xc6'),
+                                                ('type', 'h', 1), ('rssi', 'h', 67),
+                                                ('flag', 'h', 4)] + data)
+                   for data in ([], [('d', 'b', b'\x02\x01\x06\x03\x03\x0f\x18')])]
+        for binary in (False, True):
+            for msg in self.readBack(self.written(binary, *adverts)):
+                rec = scanner._scanRecord(msg)
+                self.assertIsNotNone(rec)
+                self.assertEqual(rec, scanner._respRecord(btle.BluepyHelper.parseMsg(msg)))
+                self.assertEqual(rec[0], '01:02:03:04:05:c6')
+
+
+if __name__ == '__main__':
+    unittest.main()
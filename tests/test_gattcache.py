@@ -0,0 +1,62 @@
+"""Peripheral.withCache(): discovery served from a GattCache"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class GattCacheTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=2, connectable=1.0, services=2)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def discovered(self, cache):
+        # Services and characteristics of device 0, found through cache
+        p = self.connect(0).withCache(cache)
+        svcs = sorted((str(s.uuid), s.hndStart, s.hndEnd) for s in p.getServices())
+        chars = [(c.handle, str(c.uuid)) for c in p.getCharacteristics()]
+        p.disconnect()
+        return (svcs, chars)
+
+    def test_warm_cache(self):
+        found = self.discovered(btle.GattCache(self.dir))
+        # A new cache object reads what the first one stored
+        cache = btle.GattCache(self.dir)
+        self.assertEqual(self.discovered(cache), found)
+        # Both the service table and the characteristics
+        self.assertEqual(cache.stats(), {'hits' : 2, 'misses' : 0})
+
+    def test_changed_database(self):
+        (svcs, chars) = self.discovered(btle.GattCache(self.dir))
+        self.configure(devices=2, connectable=1.0, services=3)
+        cache = btle.GattCache(self.dir)
+        (newSvcs, newChars) = self.discovered(cache)
+        self.assertEqual(cache.stats(), {'hits' : 0, 'misses' : 2})
+        self.assertEqual(len(newSvcs), len(svcs) + 1)
+
+    def test_service_changed(self):
+        cache = btle.GattCache(self.dir)
+        p = self.connect(0).withCache(cache)
+        p.getServices()
+        sc = p._cacheEntry['sc']
+        self.assertIsNotNone(sc)
+        p._notified(sc, b'\x01\x00\xff\xff')
+        self.assertIsNone(cache.load(simhelper.deviceAddress(0)))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_flush_before_connect(self):
+        self.discovered(btle.GattCache(self.dir))
+        cache = btle.GattCache(self.dir)
+        p = btle.Peripheral().withCache(cache)
+        p.flushCache()
+        self.assertIsNotNone(cache.load(simhelper.deviceAddress(0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
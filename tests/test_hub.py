@@ -0,0 +1,75 @@
+"""HelperHub: several connections and a scanner on one bluepy-helper"""
+import os
+import tempfile
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class HubTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=6, connectable=1.0)
+        self.hub = btle.HelperHub()
+        self.addCleanup(self.hub.close)
+
+    def test_peripherals_share_one_helper(self):
+        ps = [self.hub.peripheral(simhelper.deviceAddress(i), btle.ADDR_TYPE_RANDOM)
+              for i in range(3)]
+        self.assertEqual(len(set(p._cid for p in ps)), 3)
+        self.assertEqual(set(p._helper for p in ps), set([self.hub._helper]))
+        # Responses go to the slot that asked, in any order
+        names = [p.readCharacteristic(3) for p in reversed(ps)]
+        self.assertEqual(names, [("Sim-%04d" % i).encode('ascii') for i in (2, 1, 0)])
+        ps[1].disconnect()
+        self.assertEqual(ps[0].status()['state'], ['conn'])
+        self.assertEqual(len(self.hub._views), 2)
+
+    def test_slots_run_out(self):
+        self.configure(devices=btle.HUB_SLOTS, connectable=1.0)
+        for i in range(btle.HUB_SLOTS - 1):
+            self.hub.peripheral(simhelper.deviceAddress(i), btle.ADDR_TYPE_RANDOM)
+        self.assertRaises(btle.BTLEInternalError, self.hub.peripheral,
+                          simhelper.deviceAddress(btle.HUB_SLOTS - 1), btle.ADDR_TYPE_RANDOM)
+
+    def test_helper_without_slots(self):
+        # One that rejects every command, as a helper from before slots
+        # rejects the slot prefix
+        fd, path = tempfile.mkstemp(suffix='.py')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write("import sys\n"
+                     "for line in sys.stdin:\n"
+                     "    if line.startswith('quit'):\n"
+                     "        break\n"
+                     "    sys.stdout.write('rsp=$err\\x1ecode=$badcmd\\n')\n"
+                     "    sys.stdout.flush()\n")
+        self._scripts.append(path)
+        btle.helperExe = path
+        with self.assertRaises(btle.BTLEInternalError) as cm:
+            self.hub.peripheral(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        self.assertIn("out of date, rebuild it", str(cm.exception))
+        self.assertIsNone(self.hub._helper)
+
+
+class HubScannerTest(SimTestCase):
+
+    def test_scan_while_connected(self):
+        self.configure(devices=6, connectable=1.0, advRate=20)
+        hub = btle.HelperHub()
+        self.addCleanup(hub.close)
+        scanner = hub.scanner()
+        scanner.start()
+        p = hub.peripheral(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        self.assertTrue(p.getServices())
+        scanner.process(0.5)
+        scanner.stop()
+        self.assertEqual(len(scanner.getDevices()), 6)
+        # The hub's helper keeps running, and scans again
+        self.assertEqual(len(hub.scanner().scan(0.3)), 6)
+        self.assertEqual(p.status()['state'], ['conn'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Peripheral.readLong() and withMTU()"""
+import time
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+CHAR_UUID = "5eed0000-b1e5-4a9c-8f3e-000000000001"
+VALUE = bytes(bytearray(range(200))) * 2
+
+
+class LongValueTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=1, connectable=1.0, mtu=247, attInterval=0.01)
+
+    def connectWithValue(self, p=None):
+        # p (a new Peripheral by default) connected, with a long value
+        # written to the first custom characteristic
+        if p is None:
+            p = self.connect(0)
+        (char,) = p.getCharacteristics(uuid=CHAR_UUID)
+        char.write(VALUE, True)
+        return (p, char.valHandle)
+
+    def test_read_long(self):
+        (p, hnd) = self.connectWithValue()
+        self.assertEqual(p.readCharacteristic(hnd), VALUE)
+        self.assertEqual(p.readLong(hnd), VALUE)
+        self.assertEqual(p.readLong(hnd, 150), VALUE[150:])
+        self.assertEqual(p.readLong(hnd, len(VALUE)), b'')
+        self.assertRaises(btle.BTLEGattError, p.readLong, hnd, len(VALUE) + 1)
+
+    def test_older_helper(self):
+        self.useOlderHelper('rdl')
+        (p, hnd) = self.connectWithValue()
+        self.assertEqual(p.readLong(hnd), VALUE)
+        self.assertRaises(btle.BTLEInternalError, p.readLong, hnd, 10)
+
+    def test_mtu(self):
+        (p, hnd) = self.connectWithValue()
+        self.assertEqual(p.getMTU(), btle.ATT_DEFAULT_MTU)
+        start = time.time()
+        p.readCharacteristic(hnd)
+        small = time.time() - start
+
+        p = btle.Peripheral().withMTU()
+        self.addCleanup(p.disconnect)
+        p.connect(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        self.assertEqual(p.getMTU(), 247)
+        (p, hnd) = self.connectWithValue(p)
+        start = time.time()
+        self.assertEqual(p.readCharacteristic(hnd), VALUE)
+        # 2 packets instead of 19
+        self.assertLess(time.time() - start, small / 2)
+
+    def test_mtu_limit(self):
+        p = btle.Peripheral().withMTU(100)
+        self.addCleanup(p.disconnect)
+        p.connect(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        self.assertEqual(p.getMTU(), 100)
+        # Already exchanged for this connection: nothing changes
+        p.withMTU(200)
+        self.assertEqual(p.getMTU(), 100)
+        # The next connection exchanges again
+        p.disconnect()
+        p.connect(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        self.assertEqual(p.getMTU(), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""BluepyHelper.withReaderThread(): requests from several threads"""
+import threading
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class ReaderThreadTest(SimTestCase):
+
+    def inThreads(self, fn, count):
+        # fn(i) in count threads at once; their results or exceptions
+        results = [None] * count
+        def run(i):
+            try:
+                results[i] = fn(i)
+            except btle.BTLEException as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_answers_go_to_their_requests(self):
+        self.configure(devices=2, connectable=1.0, attInterval=0.01)
+        p = btle.Peripheral().withReaderThread()
+        self.addCleanup(p.disconnect)
+        p.connect(simhelper.deviceAddress(1), btle.ADDR_TYPE_RANDOM)
+        # Handle 3 holds the name; 0x30 doesn't exist
+        results = self.inThreads(lambda i: p.readCharacteristic(3 if i % 2 else 0x30), 8)
+        for (i, r) in enumerate(results):
+            if i % 2:
+                self.assertEqual(r, b"Sim-0001")
+            else:
+                self.assertIsInstance(r, btle.BTLEGattError)
+        self.assertEqual(p.status()['state'], ['conn'])
+
+    def test_link_loss_fails_every_request(self):
+        # The helper reports the link loss, then still answers each read
+        # with an error; none of those answer a later request
+        self.configure(devices=2, connectable=1.0, attInterval=2.0, linkLoss=0.1)
+        p = btle.Peripheral().withReaderThread()
+        self.addCleanup(p.disconnect)
+        p.connect(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+        results = self.inThreads(lambda i: p.readCharacteristic(3), 3)
+        for r in results:
+            self.assertIsInstance(r, btle.BTLEDisconnectError)
+
+    def test_reply_matching(self):
+        disc = {'rsp': ['stat'], 'state': ['disc']}
+        rd = btle._Reply('rd')
+        self.assertFalse(rd.answeredBy(disc))
+        self.assertTrue(rd.answeredBy({'rsp': ['rd'], 'd': [b'']}))
+        self.assertTrue(rd.answeredBy({'rsp': ['err'], 'code': ['atterr']}))
+        conn = btle._Reply('conn')
+        self.assertFalse(conn.answeredBy(disc))
+        conn.started = True
+        self.assertTrue(conn.answeredBy(disc))
+        self.assertTrue(btle._Reply('local_oob').answeredBy({'rsp': ['oob']}))
+        self.assertTrue(btle._Reply('help').answeredBy(disc))
+
+
+if __name__ == '__main__':
+    unittest.main()
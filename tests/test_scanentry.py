@@ -0,0 +1,68 @@
+"""ScanEntry: advertising payloads merged into scanData when read"""
+import random
+import struct
+import unittest
+
+import support # For the tree on sys.path
+from bluepy import btle
+
+
+def _ad(sdid, val):
+    return struct.pack('<BB', len(val) + 1, sdid) + val
+
+
+class ScanEntryTest(unittest.TestCase):
+
+    def test_payloads_merged(self):
+        adv = _ad(0x01, b'\x06') + _ad(0x09, b'sim')
+        rsp = _ad(0xFF, b'\x4c\x00\x01') + _ad(0x0A, b'\x04')
+        dev = btle.ScanEntry('c0:5e:00:00:00:01', 0)
+        self.assertTrue(dev._updateFrom(1, 50, 0, adv))
+        self.assertTrue(dev._updateFrom(1, 50, 0, rsp))
+        # The same two again add nothing
+        self.assertFalse(dev._updateFrom(1, 50, 0, adv))
+        self.assertFalse(dev._updateFrom(1, 50, 0, rsp))
+        self.assertEqual(dev.getValueText(btle.ScanEntry.COMPLETE_LOCAL_NAME), 'sim')
+        self.assertEqual([sdid for (sdid, desc, val) in dev.getScanData()],
+                         [0x01, 0x09, 0xFF, 0x0A])
+        # A changed scan response replaces the values it holds
+        self.assertTrue(dev._updateFrom(1, 50, 0, _ad(0xFF, b'\x4c\x00\x02')))
+        self.assertEqual(dev.getValue(btle.ScanEntry.MANUFACTURER), b'\x4c\x00\x02')
+        self.assertEqual(dev.getValue(btle.ScanEntry.TX_POWER), b'\x04')
+        self.assertTrue(dev._updateFrom(1, 50, 0, rsp))
+        self.assertEqual(dev.getValue(btle.ScanEntry.MANUFACTURER), b'\x4c\x00\x01')
+
+    def test_as_merged_up_front(self):
+        # Against merging each payload into scanData as it comes, for
+        # payloads drawn from a few that share AD types
+        rnd = random.Random(1)
+        items = [(sdid, val) for sdid in (0x01, 0x09, 0x16, 0xFF) for val in (b'a', b'bb')]
+        pool = [b''.join(_ad(*item) for item in rnd.sample(items, rnd.randint(1, 3)))
+                for _ in range(8)]
+        for trial in range(20):
+            dev = btle.ScanEntry('c0:5e:00:00:00:01', 0)
+            (merged, order, seen, last) = ({}, [], set(), None)
+            for _ in range(200):
+                data = rnd.choice(pool[:rnd.randint(2, len(pool))])
+                changed = False
+                for (sdid, val) in btle._splitAD(data):
+                    if sdid not in merged:
+                        order.append(sdid)
+                    if merged.get(sdid) != val:
+                        changed = True
+                        merged[sdid] = val
+                isNewData = dev._updateFrom(1, 50, 0, data)
+                if data == last:
+                    self.assertFalse(isNewData)
+                elif changed or data not in seen:
+                    # A payload not seen before counts as new data; one
+                    # seen before may too, but no change goes unreported
+                    self.assertTrue(isNewData)
+                (last, _) = (data, seen.add(data))
+                if rnd.random() < 0.2:
+                    self.assertEqual(dev.scanData, merged)
+                    self.assertEqual([sdid for (sdid, desc, val) in dev.getScanData()], order)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Scanner.setFilter(), in bluepy-helper and in Python"""
+import unittest
+import warnings
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class ScanFilterTest(SimTestCase):
+    # The same devices are reported whether bluepy-helper filters adverts
+    # or Scanner falls back to doing so
+
+    def scanFiltered(self, **filt):
+        scanner = btle.Scanner().setFilter(**filt)
+        devs = scanner.scan(0.5)
+        return (scanner, dict((d.addr, d) for d in devs))
+
+    def test_address_filter(self):
+        want = set([simhelper.deviceAddress(1), simhelper.deviceAddress(4)])
+        self.configure(devices=8, advRate=20)
+        (scanner, found) = self.scanFiltered(addresses=want)
+        self.assertTrue(scanner._helperFilters)
+        self.assertEqual(set(found), want)
+
+        self.useOlderHelper('filt')
+        btle._helperLacking.discard("advert filtering")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            (scanner, found) = self.scanFiltered(addresses=want)
+            self.scanFiltered(addresses=want)
+        self.assertFalse(scanner._helperFilters)
+        self.assertEqual(set(found), want)
+        self.assertEqual(len([w for w in caught if "advert filtering" in str(w.message)]), 1)
+
+    def test_rssi_filter(self):
+        self.configure(devices=20, advRate=20)
+        for older in (False, True):
+            if older:
+                self.useOlderHelper('filt')
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                (scanner, found) = self.scanFiltered(min_rssi=-60)
+            self.assertEqual(scanner._helperFilters, not older)
+            self.assertTrue(found)
+            for dev in found.values():
+                self.assertGreaterEqual(dev.rssi, -60)
+
+    def test_connectable_filter(self):
+        self.configure(devices=10, advRate=20, connectable=0.5)
+        for older in (False, True):
+            if older:
+                self.useOlderHelper('filt')
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                (scanner, found) = self.scanFiltered(connectable_only=True)
+            self.assertTrue(found)
+            self.assertTrue(all(dev.connectable for dev in found.values()))
+
+    def test_uuid_filter(self):
+        self.configure(devices=4, advRate=20)
+        for uuids in (["180f"], ["180d"]):
+            (scanner, found) = self.scanFiltered(service_uuids=uuids)
+            self.assertEqual(len(found), 4 if uuids == ["180f"] else 0)
+
+    def test_no_filter_no_warning(self):
+        self.useOlderHelper('filt')
+        btle._helperLacking.discard("advert filtering")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(len(btle.Scanner().scan(0.3)), 20)
+        self.assertEqual([w for w in caught if w.category is RuntimeWarning], [])
+
+
+class FilterChangeTest(SimTestCase):
+    # setFilter() while scanning
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=8, advRate=20)
+        self.scanner = btle.Scanner()
+        self.scanner.start()
+        self.addCleanup(self.scanner.stop)
+        self.scanner.process(0.2)
+
+    def test_new_filter_applies(self):
+        want = simhelper.deviceAddress(3)
+        self.scanner.setFilter(addresses=[want])
+        self.scanner.clear()
+        self.scanner.process(0.3)
+        self.assertEqual(list(self.scanner.scanned), [want])
+        self.assertFalse(self.scanner._mgmtPending)
+
+    def test_rejected_filter_falls_back(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.scanner.setFilter(addresses=["c0:5e:00:00:00:03", "not-an-address"])
+            self.scanner.clear()
+            self.scanner.process(0.3)
+        self.assertEqual(len([w for w in caught if "rejected" in str(w.message)]), 1)
+        # Applied in Python instead
+        self.assertEqual(list(self.scanner.scanned), ["c0:5e:00:00:00:03"])
+
+
+class PassesTest(unittest.TestCase):
+    # The Python fallback on its own
+
+    def setUp(self):
+        self.scanner = btle.Scanner()
+
+    def record(self, addr, rssi=-50, connectable=True, data=b''):
+        return (addr, 1, -rssi, 0 if connectable else 4, data)
+
+    def test_rssi_and_connectable(self):
+        self.scanner.setFilter(min_rssi=-60, connectable_only=True)
+        passes = self.scanner._passes
+        self.assertTrue(passes(self.record('aa:aa:aa:aa:aa:01', -60)))
+        self.assertFalse(passes(self.record('aa:aa:aa:aa:aa:01', -61)))
+        self.assertFalse(passes(self.record('aa:aa:aa:aa:aa:01', connectable=False)))
+
+    def test_uuid_lets_scan_responses_through(self):
+        self.scanner.setFilter(service_uuids=["180f"])
+        passes = self.scanner._passes
+        self.assertTrue(passes(self.record('aa:aa:aa:aa:aa:02', data=b'\x03\x03\x0f\x18')))
+        # Its scan response names no services
+        self.assertTrue(passes(self.record('aa:aa:aa:aa:aa:02', data=b'\x02\x0a\x00')))
+        self.assertFalse(passes(self.record('aa:aa:aa:aa:aa:03', data=b'\x02\x0a\x00')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+"""Scanner.setScanParameters()"""
+import unittest
+import warnings
+
+from support import SimTestCase
+from bluepy import btle
+
+
+class ScanParametersTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=5, advRate=20)
+
+    def test_duplicates_filtered(self):
+        scanner = btle.Scanner().setScanParameters(interval=20, window=10, filterDuplicates=True)
+        devs = scanner.scan(0.5)
+        self.assertEqual(len(devs), 5)
+        self.assertEqual([d.updateCount for d in devs], [1] * 5)
+
+    def test_kernel_parameters(self):
+        scanner = btle.Scanner().setScanParameters(interval=20)
+        self.assertEqual(scanner._cmd(), "pasv")
+        scanner.setScanParameters()
+        self.assertEqual(scanner._cmd(), "scan")
+        devs = scanner.scan(0.5)
+        self.assertGreater(max(d.updateCount for d in devs), 1)
+
+    def test_bad_parameters(self):
+        scanner = btle.Scanner()
+        self.assertRaises(ValueError, scanner.setScanParameters, interval=10, window=20)
+        self.assertRaises(ValueError, scanner.setScanParameters, interval=1)
+        self.assertRaises(ValueError, scanner.setScanParameters, ownAddrType="other")
+
+    def test_older_helper(self):
+        # Without 'scanp' the scan fails, rather than running with the
+        # kernel's parameters
+        self.useOlderHelper('scanp')
+        scanner = btle.Scanner().setScanParameters(interval=20)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertRaises(btle.BTLEInternalError, scanner.start)
+        self.assertIsNone(scanner._helper)
+        self.assertEqual([w for w in caught if w.category is RuntimeWarning], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Characteristic.subscribe(): notifications in batches"""
+import time
+import unittest
+
+from support import SimTestCase
+from bluepy import btle
+
+CHAR_UUID = "5eed0000-b1e5-4a9c-8f3e-000000000001"
+
+
+class QueueTest(unittest.TestCase):
+    # A Subscription on its own, values added by hand
+
+    def subscription(self, callback=None, batch=1, maxLatency=None, maxQueue=1024,
+                     overflow=btle.OVERFLOW_DROP_OLDEST):
+        return btle.Subscription(None, 0, callback, batch, maxLatency, maxQueue, overflow)
+
+    def test_full_batches(self):
+        batches = []
+        sub = self.subscription(batches.append, batch=3)
+        for i in range(7):
+            sub._add(float(i), b'%d' % i)
+        self.assertEqual([[data for (stamp, data) in b] for b in batches],
+                         [[b'0', b'1', b'2'], [b'3', b'4', b'5']])
+        self.assertEqual(sub.pending(), 1)
+        # The rest goes when the subscription ends
+        sub._deliver(None)
+        self.assertEqual(batches[-1], [(6.0, b'6')])
+
+    def test_max_latency(self):
+        batches = []
+        sub = self.subscription(batches.append, batch=10, maxLatency=0.5)
+        sub._add(1.0, b'a')
+        sub._add(1.2, b'b')
+        self.assertEqual(sub._deadline(), 1.5)
+        self.assertFalse(sub._deliver(1.4))
+        self.assertTrue(sub._deliver(1.5))
+        self.assertEqual(batches, [[(1.0, b'a'), (1.2, b'b')]])
+        self.assertIsNone(sub._deadline())
+
+    def test_overflow(self):
+        for (overflow, kept) in ((btle.OVERFLOW_DROP_OLDEST, [b'2', b'3', b'4']),
+                                 (btle.OVERFLOW_DROP_NEWEST, [b'0', b'1', b'2'])):
+            sub = self.subscription(maxQueue=3, overflow=overflow)
+            for i in range(5):
+                sub._add(float(i), b'%d' % i)
+            self.assertEqual((sub.received, sub.dropped), (5, 2))
+            self.assertEqual([data for (stamp, data) in sub.get()], kept)
+            self.assertEqual(sub.get(), [])
+
+
+class SubscribeTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=1, connectable=1.0, notifyRate=50.0)
+        self.p = self.connect(0)
+        (self.char,) = self.p.getCharacteristics(uuid=CHAR_UUID)
+
+    def test_batches(self):
+        batches = []
+        self.char.subscribe(batches.append, batch=5)
+        end = time.time() + 5.0
+        while len(batches) < 3 and time.time() < end:
+            self.p.waitForNotifications(0.1)
+        self.assertGreaterEqual(len(batches), 3)
+        self.assertEqual([len(b) for b in batches], [5] * len(batches))
+        stamps = [stamp for b in batches for (stamp, data) in b]
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_latency_bound(self):
+        # Batches too big to fill still arrive, within max_latency
+        batches = []
+        self.char.subscribe(batches.append, batch=1000, max_latency=0.1)
+        end = time.time() + 5.0
+        while len(batches) < 2 and time.time() < end:
+            self.p.waitForNotifications(1.0)
+            if batches:
+                self.assertLess(time.time() - batches[-1][0][0], 0.3)
+        self.assertGreaterEqual(len(batches), 2)
+
+    def test_unsubscribe(self):
+        sub = self.char.subscribe()
+        self.p.waitForNotifications(0.3)
+        self.assertGreater(sub.pending(), 0)
+        sub.cancel()
+        received = sub.received
+        self.p.waitForNotifications(0.3)
+        self.assertEqual(sub.received, received)
+        self.assertEqual(self.p.readCharacteristic(sub.cccdHandle), b'\x00\x00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Peripheral.withSupervision(): sessions restored after the helper dies"""
+import threading
+import time
+import unittest
+
+from support import SimTestCase
+from bluepy import btle, simhelper
+
+
+class SupervisorTest(SimTestCase):
+    # A supervised Peripheral restores its session when the helper dies
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=2, connectable=1.0, attInterval=0.3)
+        self.p = btle.Peripheral().withSupervision()
+        self.addCleanup(self.p.disconnect)
+        self.p.connect(simhelper.deviceAddress(0), btle.ADDR_TYPE_RANDOM)
+
+    def killHelperSoon(self):
+        helper = self.p._helper
+        def kill():
+            time.sleep(0.1)
+            helper.kill()
+        t = threading.Thread(target=kill)
+        t.start()
+        self.addCleanup(t.join)
+
+    def test_read_is_replayed(self):
+        self.killHelperSoon()
+        self.assertEqual(len(self.p.readCharacteristic(3)), len(self.p.readCharacteristic(3)))
+        self.assertEqual(self.p.stats()['supervisor']['recoveries'], 1)
+
+    def test_write_is_not_replayed(self):
+        self.killHelperSoon()
+        self.assertRaises(btle.BTLEDisconnectError,
+                          self.p.writeCharacteristic, 3, b'x', True)
+        # The session was restored for what follows
+        self.p.readCharacteristic(3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Peripheral.withValueCache(): reads given a max_age"""
+import time
+import unittest
+
+from support import SimTestCase
+from bluepy import btle
+
+CHAR_UUID = "5eed0000-b1e5-4a9c-8f3e-000000000001"
+
+
+class ValueCacheTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=1, connectable=1.0, attInterval=0.05, notifyRate=20.0)
+        self.p = self.connect(0).withValueCache()
+        (self.char,) = self.p.getCharacteristics(uuid=CHAR_UUID)
+
+    def cacheStats(self):
+        stats = self.p.stats()['valueCache']
+        return (stats['hits'], stats['misses'])
+
+    def test_fresh_value(self):
+        value = self.char.read()
+        start = time.time()
+        self.assertEqual(self.char.read(max_age=5.0), value)
+        self.assertLess(time.time() - start, 0.04)
+        self.assertEqual(self.cacheStats(), (1, 0))
+        # Without max_age the device is asked
+        self.char.read()
+        self.assertEqual(self.cacheStats(), (1, 0))
+
+    def test_stale_value(self):
+        self.char.read()
+        time.sleep(0.2)
+        self.char.read(max_age=0.1)
+        self.assertEqual(self.cacheStats(), (0, 1))
+        self.char.read(max_age=0.1)
+        self.assertEqual(self.cacheStats(), (1, 1))
+
+    def test_write_drops_value(self):
+        self.char.read()
+        self.char.write(b'new!', True)
+        self.assertEqual(self.char.read(max_age=5.0), b'new!')
+        self.assertEqual(self.cacheStats(), (0, 1))
+
+    def test_notified_value(self):
+        sub = self.char.subscribe()
+        while not sub.pending():
+            self.p.waitForNotifications(1.0)
+        (stamp, data) = sub.get()[-1]
+        self.assertEqual(self.char.read(max_age=5.0), data)
+        self.assertEqual(self.cacheStats(), (1, 0))
+        self.assertGreater(self.p.stats()['valueCache']['notified'], 0)
+
+    def test_not_caching(self):
+        p = self.connect(0)
+        (char,) = p.getCharacteristics(uuid=CHAR_UUID)
+        char.read()
+        start = time.time()
+        char.read(max_age=5.0)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+        self.assertNotIn('valueCache', p.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
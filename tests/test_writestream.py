@@ -0,0 +1,49 @@
+"""Peripheral.writeStream(): writes without response, paced by credit"""
+import unittest
+
+from support import SimTestCase
+from bluepy import btle
+
+CHAR_UUID = "5eed0000-b1e5-4a9c-8f3e-000000000001"
+
+
+class WriteStreamTest(SimTestCase):
+
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.configure(devices=1, connectable=1.0, writeRate=200.0)
+        self.p = self.connect(0)
+        (self.char,) = self.p.getCharacteristics(uuid=CHAR_UUID)
+
+    def test_pieces_fit_the_mtu(self):
+        data = bytes(bytearray(range(100)))
+        result = self.char.writeStream([data, data[:30]])
+        # 20 bytes a write at the default ATT MTU
+        self.assertEqual((result['bytes'], result['writes']), (130, 5 + 2))
+        self.assertEqual(self.char.read(), data[20:30])
+
+    def test_window_paces_writes(self):
+        # With 4 writes in flight, 40 at 200 a second can't finish before
+        # the last 36 credits come back
+        result = self.char.writeStream([b'x'] * 40, window=4)
+        self.assertEqual(result['writes'], 40)
+        self.assertGreaterEqual(result['seconds'], 36 / 200.0)
+        self.assertEqual(self.p._sentCount, 40)
+
+    def test_failed_write(self):
+        self.assertRaises(btle.BTLEGattError, self.p.writeStream, 0, [b'x'] * 3)
+        # The link is still usable
+        self.char.writeStream(b'ok')
+        self.assertEqual(self.char.read(), b'ok')
+
+    def test_older_helper(self):
+        self.useOlderHelper('wrs')
+        p = self.connect(0)
+        result = p.writeStream(self.char.valHandle, [b'a' * 25, b'b'])
+        self.assertFalse(p._streamWrites)
+        self.assertEqual((result['bytes'], result['writes']), (26, 3))
+        self.assertEqual(p.readCharacteristic(self.char.valHandle), b'b')
+
+
+if __name__ == '__main__':
+    unittest.main()